@@ -1,24 +1,127 @@
-from flask import Flask, request, jsonify, send_from_directory
-import os, sys, json, subprocess, shutil, traceback
+from flask import Flask, Response, g, request, jsonify, send_file, send_from_directory
+import io, os, sys, json, time, hashlib, subprocess, shutil, traceback
 from pathlib import Path
 from datetime import datetime
-from logic.extractor import extract_book_info, extract_page_image
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from logic.extractor import extract_book_info
+from logic.chapter_engine import get_engine
+from logic.chapterlistcreator import STRATEGIES
+from logic.page_renderer import get_renderer, parse_variant, mime_type
+from logic.generation_jobs import get_job_queue, DONE, ERROR
+from logic.gemini_generation import (
+    gemini_available, extract_text_from_pdf, extract_chapter_info, resolve_chapters, plan_generation, OVERSIZE_POLICIES
+)
+from logic.gemini_client import get_gemini_service, PRIORITY_INTERACTIVE
+from logic.text_store import open_sidecar
+from logic.generation_cache import get_generation_cache
+from logic.blob_store import store_stream, find_blob, alias_book, release_alias
+from logic.span_index import index_path
+from logic.catalog import get_catalog, read_manifest, write_manifest
+from logic.search_index import get_search_index, SEARCH_PAGE_SIZE
+from logic.virtual_chapters import get_chapter_buffers, export_chapter, source_pdf
+from logic.static_assets import get_asset_store
+from logic.metrics import (
+    REGISTRY, HTTP_SECONDS, HTTP_BYTES, SUBPROCESSES, REQUEST_ID_HEADER, REQUEST_ID_ENV,
+    new_request_id, set_request_id, reset_request_id, log_event, stage,
+)
 
 app = Flask(__name__)
+FRONTEND_DIR = Path(app.root_path) / "frontend"
+ASSETS_DIR = Path(app.root_path) / "assets"
 book_temp = Path("bookstore") / "booktemp"
+PREVIEW_MAX_AGE = 3600  # previews revalidate through their ETag after an hour
+LIBRARY_PAGE_SIZE = 200
+CHAPTERS_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+RAW_BOOK_TYPES = {"application/pdf": ".pdf", "application/epub+zip": ".epub"}
+BOOK_EXTENSIONS = set(RAW_BOOK_TYPES.values())
+
+
+@app.before_request
+def start_request():
+    # a caller's id (proxy, frontend) is kept so its logs and ours can be joined
+    g.request_id = request.headers.get(REQUEST_ID_HEADER) or new_request_id()
+    g.request_id_token = set_request_id(g.request_id)
+    g.request_start = time.perf_counter()
+
+
+@app.after_request
+def finish_request(response):
+    start = g.get("request_start")
+    if start is None:
+        return response
+    # the rule, not the path: /api/book-image/<bookname>/<int:page_number> is one series
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    elapsed = time.perf_counter() - start
+    HTTP_SECONDS.observe(elapsed, route=route, method=request.method, status=response.status_code)
+    if response.content_length is not None:
+        HTTP_BYTES.inc(response.content_length, route=route)
+    response.headers[REQUEST_ID_HEADER] = g.request_id
+    log_event("request", method=request.method, route=route, path=request.path,
+              status=response.status_code, ms=round(elapsed * 1000, 2), bytes=response.content_length)
+    return response
+
+
+@app.teardown_request
+def end_request(error=None):
+    token = g.pop("request_id_token", None)
+    if token is not None:
+        reset_request_id(token)
+
+
+def _lookups(stats):
+    return {("hits",): stats["hits"], ("misses",): stats["misses"]}
+
+
+# computed at scrape time from the stats the subsystems already keep. With several server workers
+# (logic/metrics.py): running totals of a process are "all", what reads a store shared by every
+# worker is "max", in-flight state of a process "live"
+REGISTRY.gauge("arb_preview_cache_lookups", "Preview cache lookups by result", ("result",),
+               lambda: _lookups(get_renderer().stats()), mode="all")
+REGISTRY.ratio("arb_preview_cache_hit_ratio", "Preview cache hit ratio", "arb_preview_cache_lookups")
+REGISTRY.gauge("arb_preview_cache_bytes", "Bytes of cached preview images", (),
+               lambda: {(): get_renderer().stats()["bytes"]}, mode="max")
+REGISTRY.gauge("arb_generation_cache_lookups", "Generation cache lookups by result", ("result",),
+               lambda: _lookups(get_generation_cache().stats()), mode="all")
+REGISTRY.ratio("arb_generation_cache_hit_ratio", "Generation cache hit ratio", "arb_generation_cache_lookups")
+REGISTRY.gauge("arb_chapter_buffer_bytes", "Bytes of virtual chapters kept in memory", (),
+               lambda: {(): get_chapter_buffers().stats()["bytes"]})
+REGISTRY.gauge("arb_generation_jobs", "Generation jobs by status", ("status",),
+               lambda: {(status,): n for status, n in get_job_queue().depth().items()}, mode="max")
+REGISTRY.gauge("arb_engine_queue_depth", "Chapter detections waiting for an engine thread", (),
+               lambda: {(): get_engine().queue_depth()})
+REGISTRY.gauge("arb_open_documents", "PDF handles kept open by the engine", (),
+               lambda: {(): get_engine().documents.size()})
+REGISTRY.gauge("arb_gemini_requests", "Gemini requests in flight and waiting for a slot", ("state",),
+               lambda: {(k,): v for k, v in get_gemini_service().stats().items() if k in ("inflight", "queued")})
+REGISTRY.gauge("arb_gemini_retries", "Gemini requests retried since start", (),
+               lambda: {(): get_gemini_service().stats()["retries"]}, mode="all")
+REGISTRY.gauge("arb_gemini_throttled_seconds", "Seconds Gemini requests waited on the rate limits", (),
+               lambda: {(): get_gemini_service().stats()["throttledSeconds"]}, mode="all")
+
 @app.route("/")
 def index():
-    return send_from_directory("frontend", "index.html")
+    # CSS/JS links carry ?v=<content hash>, so the page itself always revalidates
+    html = get_asset_store(FRONTEND_DIR).render_index()
+    response = Response(html, mimetype="text/html")
+    response.set_etag(hashlib.sha256(html.encode("utf-8")).hexdigest()[:20])
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
 
 
 @app.route("/<path:filename>")
 def static_files(filename):
-    return send_from_directory("frontend", filename)
+    return get_asset_store(FRONTEND_DIR).send(filename)
 
 
 @app.route("/assets/<path:filename>")
 def assets_files(filename):
-    return send_from_directory("assets", filename)
+    return get_asset_store(ASSETS_DIR).send(filename)
+
+
+@app.route("/metrics")
+def metrics():
+    return Response(REGISTRY.render(), mimetype="text/plain; version=0.0.4")
 
 
 @app.route("/api/health")
@@ -31,6 +134,8 @@ def health():
 @app.route("/api/cleanup", methods=["POST"])
 def cleanup_pending_books():
     try:
+        get_engine().documents.clear()
+        get_renderer().reset()
         for item in book_temp.iterdir():
             if item.is_file() or item.is_symlink():
                 item.unlink()
@@ -41,25 +146,44 @@ def cleanup_pending_books():
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def page_args(default_limit):
+    """limit/offset query args of the paginated listings."""
+    limit = int(request.args.get("limit", default_limit))
+    offset = int(request.args.get("offset", 0))
+    if not 1 <= limit <= MAX_PAGE_SIZE or offset < 0:
+        raise ValueError(f"limit must be 1-{MAX_PAGE_SIZE} and offset not negative")
+    return limit, offset
+
+
+def page_info(limit, offset, returned, total):
+    next_offset = offset + returned
+    return {"total": total, "limit": limit, "offset": offset, "nextOffset": next_offset if next_offset < total else None}
+
+
 @app.route("/api/library", methods=["GET"])
 def get_library():
     try:
-        books_dir = Path("bookstore") / "elaboratebook"
+        limit, offset = page_args(LIBRARY_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    try:
+        rows, total = get_catalog().books(limit, offset)
         books = []
-        if books_dir.exists():
-            for item in books_dir.iterdir():
-                display_name = item.name.replace("_", " ").title()
-                description = f"Libro completo con tutti i capitoli elaborati. {display_name} è stato processato e suddiviso in capitoli per una lettura facilitata."
-                
-                books.append(
-                    {
-                        "name": item.name,
-                        "id": item.name,
-                        "displayName": display_name,
-                        "description": description,
-                    }
-                )
-        return jsonify({"success": True, "books": books})
+        for row in rows:
+            display_name = row["name"].replace("_", " ").title()
+            description = f"Libro completo con tutti i capitoli elaborati. {display_name} è stato processato e suddiviso in capitoli per una lettura facilitata."
+
+            books.append(
+                {
+                    "name": row["name"],
+                    "id": row["name"],
+                    "displayName": display_name,
+                    "description": description,
+                    "author": row["author"],
+                    "chapterCount": row["chapter_count"],
+                }
+            )
+        return jsonify({"success": True, "books": books, **page_info(limit, offset, len(books), total)})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -71,6 +195,8 @@ def delete_book(book_id):
         book_path = books_dir / book_id
         
         if not book_path.exists():
+            get_catalog().remove_book(book_id)  # stale entry of a directory removed by hand
+            get_search_index().remove_book(book_id)
             return jsonify({"success": False, "error": "Book not found"}), 404
             
         # Remove the book directory and all its contents
@@ -78,30 +204,60 @@ def delete_book(book_id):
             shutil.rmtree(book_path)
         else:
             book_path.unlink()
+        get_generation_cache().invalidate_book(book_id)
+        get_catalog().remove_book(book_id)
+        get_search_index().remove_book(book_id)
+        release_alias(book_id)
             
         return jsonify({"success": True, "message": "Book deleted successfully"})
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
-@app.route("/api/upload-book", methods=["POST"])
+@app.route("/api/upload-book", methods=["POST", "PUT"])
 def upload_book():
+    """Store an uploaded book once per content and alias it under its title.
+
+    Accepts a multipart form (book-file, title, author), a raw PDF/EPUB body with title, author
+    and ext (.pdf/.epub, else taken from the Content-Type) in the query string, or just a sha256
+    field to reuse a book the server already has.
+    """
     try:
-        if "book-file" not in request.files:
-            return jsonify({"success": False, "error": "No file"}), 400
-        file = request.files["book-file"]
-        title = request.form.get("title", "").strip()
-        author = request.form.get("author", "Unknown Author").strip()
-        if not title or file.filename == "":
+        content_type = (request.content_type or "").split(";")[0]
+        raw_ext = request.args.get("ext", "").lower()
+        if raw_ext in BOOK_EXTENSIONS or content_type in RAW_BOOK_TYPES:
+            fields = request.args
+            stream = request.stream
+            ext = raw_ext if raw_ext in BOOK_EXTENSIONS else RAW_BOOK_TYPES[content_type]
+        else:
+            fields = request.form
+            file = request.files.get("book-file")
+            stream = file.stream if file and file.filename else None
+            ext = ".pdf" if stream and file.filename.lower().endswith(".pdf") else ".epub"
+        title = fields.get("title", "").strip()
+        author = fields.get("author", "Unknown Author").strip()
+        sha256 = fields.get("sha256", "").strip().lower()
+        if not title or (stream is None and not sha256):
             return jsonify({"success": False, "error": "Missing title or file"}), 400
         import re
 
         bookname = re.sub(r"[^a-z0-9_]", "", title.lower().replace(" ", "_"))
-        ext = ".pdf" if file.filename.lower().endswith(".pdf") else ".epub"
-        book_dir = Path("bookstore") / "booktemp"
-        book_dir.mkdir(parents=True, exist_ok=True)
-        file_path = book_dir / f"{bookname}{ext}"
-        file.save(str(file_path))
+        if stream is None:
+            # hash probe: the client sends the file only if its content is unknown
+            blob, ext = find_blob(sha256) if re.fullmatch(r"[0-9a-f]{64}", sha256) else (None, None)
+            if blob is None:
+                return jsonify({"success": False, "needsFile": True})
+            known = True
+        else:
+            sha256, blob, known = store_stream(stream, ext)
+        reused_from = alias_book(bookname, sha256, ext, title, author)
+        if reused_from:
+            get_catalog().copy_book(reused_from, bookname, title, author)
+            get_search_index().index_book(bookname)
+        file_path = book_temp / f"{bookname}{ext}"
+        if ext == ".pdf" and not index_path(file_path).exists():
+            # span index for chapter detection is built while the user picks a reference page
+            get_engine().submit_index(bookname)
         return jsonify(
             {
                 "success": True,
@@ -109,6 +265,9 @@ def upload_book():
                 "title": title,
                 "author": author,
                 "path": str(file_path),
+                "sha256": sha256,
+                "knownBook": known,
+                "reusedChapters": reused_from,
             }
         )
     except Exception as e:
@@ -124,12 +283,12 @@ def book_elaboration():
         return jsonify({"error": "Bookname required"}), 400
     try:
         if page:
-            filename, _ = extract_page_image(bookname, int(page))
-            return jsonify({"success": True, "filename": filename})
+            image_file = get_renderer().get(bookname, int(page))
+            return jsonify({"success": True, "filename": image_file.name})
         info = extract_book_info(bookname)
         if info["status"] != "ok":
             return jsonify({"error": info["message"]}), 500
-        return jsonify({"success": True, "pages": info["pages"]})
+        return jsonify({"success": True, "pages": info["pages"], "format": info["format"], "outline": info["outline"]})
     except Exception as e:
         app.logger.error(e)
         return jsonify({"error": str(e)}), 500
@@ -137,41 +296,80 @@ def book_elaboration():
 
 @app.route("/api/book-image/<bookname>/<int:page_number>")
 def book_image(bookname, page_number):
-    cache_dir = (
-        Path("bookstore") / "booktemp" / "cache" / bookname
-    )
-    image_filename = f"page_{page_number:03d}.png"
-    image_file = cache_dir / image_filename
     try:
-        if not image_file.exists():
-            extract_page_image(bookname, page_number)
-        return send_from_directory(cache_dir, image_filename)
+        variant = parse_variant(request.args)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        renderer = get_renderer()
+        image_file = renderer.get(bookname, page_number, variant)
+        return send_from_directory(
+            image_file.parent.resolve(),
+            image_file.name,
+            mimetype=mime_type(image_file.name),
+            etag=renderer.etag(bookname, image_file.name),
+            max_age=PREVIEW_MAX_AGE,
+        )
+    except Exception as e:
+        app.logger.error(e)
+        return jsonify({"error": str(e)}), 500
+
+
+@app.route("/api/book-thumbnails/<bookname>")
+def book_thumbnails(bookname):
+    try:
+        start = int(request.args.get("start", 1))
+        end = int(request.args.get("end", start + 19))
+        columns = int(request.args.get("columns", 10))
+        variant = parse_variant({"size": "thumb", "format": "jpeg", **request.args.to_dict()})
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        renderer = get_renderer()
+        sprite_file, layout = renderer.get_sprite(bookname, start, end, columns, variant)
+        response = send_from_directory(
+            sprite_file.parent.resolve(),
+            sprite_file.name,
+            mimetype=mime_type(sprite_file.name),
+            etag=renderer.etag(bookname, sprite_file.name),
+            max_age=PREVIEW_MAX_AGE,
+        )
+        response.headers["X-Sprite-Start"] = str(start)
+        response.headers["X-Sprite-End"] = str(end)
+        response.headers["X-Sprite-Columns"] = str(layout["columns"])
+        response.headers["X-Sprite-Rows"] = str(layout["rows"])
+        response.headers["X-Sprite-Tile-Width"] = str(layout["tileWidth"])
+        return response
     except Exception as e:
         app.logger.error(e)
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/book-image/stats")
+def book_image_stats():
+    return jsonify({"success": True, **get_renderer().stats()})
+
+
 @app.route("/api/analyze-chapter", methods=["POST"])
 def analyze_chapter():
     data = request.get_json()
     bookname = data.get("bookname")
     reference_page = data.get("pageNumber")
-    if not bookname or not reference_page:
+    strategy = data.get("strategy", "auto")
+    # the reference page is only needed by the font scan (books without a usable outline)
+    if not bookname or (strategy == "font-scan" and not reference_page):
         return jsonify({"success": False, "message": "Missing data"}), 400
+    if strategy not in STRATEGIES:
+        return jsonify({"success": False, "error": f"Unknown strategy '{strategy}'"}), 400
     try:
-        cmd = [
-            sys.executable,
-            "logic/chapterlistcreator.py",
-            bookname,
-            str(reference_page),
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
-        if result.returncode != 0 or not result.stdout.strip():
-            return jsonify({"success": False, "error": result.stderr}), 500
-        chapters_data = json.loads(result.stdout)
+        chapters_data = get_engine().run(
+            bookname, int(reference_page) if reference_page else None, timeout=30, strategy=strategy
+        )
         if chapters_data.get("status") != "success":
             return jsonify({"success": False, "error": chapters_data.get("message")}), 500
         return jsonify({"success": True, **chapters_data})
+    except FutureTimeoutError:
+        return jsonify({"success": False, "error": "Chapter analysis timed out"}), 504
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
@@ -179,35 +377,76 @@ def analyze_chapter():
 @app.route("/api/book-chapters/<bookname>", methods=["GET"])
 def get_book_chapters(bookname):
     try:
-        book_dir = Path("bookstore") / "elaboratebook" / bookname
+        limit, offset = page_args(CHAPTERS_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    try:
+        catalog = get_catalog()
         chapters = []
-        if book_dir.exists():
-            import re
-
-            for pdf_file in book_dir.glob("cap*.pdf"):
-                match = re.match(r"cap(\d+)\[(.+)\]", pdf_file.stem)
-                if match:
-                    chapter_number = int(match.group(1))
-                    chapter_title = match.group(2).replace("_", " ")
-                    
-                    # Genera una descrizione per il capitolo
-                    description = f"Capitolo {chapter_number}: {chapter_title}. Questo capitolo è stato estratto e ottimizzato per una lettura facilitata."
-                    
-                    chapters.append(
-                        {
-                            "number": chapter_number,
-                            "title": chapter_title,
-                            "filename": pdf_file.name,
-                            "id": f"{bookname}_cap{chapter_number}",
-                            "description": description,
-                        }
-                    )
-            chapters.sort(key=lambda x: x["number"])
-        return jsonify({"success": True, "bookname": bookname, "chapters": chapters})
+        total = 0
+        if catalog.ensure_book(bookname):
+            rows, total = catalog.chapters(bookname, limit, offset)
+            for row in rows:
+                chapter_number = row["number"]
+                chapter_title = row["title"]
+
+                # Genera una descrizione per il capitolo
+                description = f"Capitolo {chapter_number}: {chapter_title}. Questo capitolo è stato estratto e ottimizzato per una lettura facilitata."
+
+                chapters.append(
+                    {
+                        "number": chapter_number,
+                        "title": chapter_title,
+                        "filename": row["filename"],
+                        "id": f"{bookname}_cap{chapter_number}",
+                        "description": description,
+                        "pageCount": row["page_count"],
+                        "startPage": row["start_page"],
+                        "endPage": row["end_page"],
+                        "virtual": bool(row["virtual"]),
+                    }
+                )
+        return jsonify(
+            {"success": True, "bookname": bookname, "chapters": chapters, **page_info(limit, offset, len(chapters), total)}
+        )
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
 
+def generation_plan(data):
+    """(plan, error response) of a generation request body, checked before anything is sent."""
+    bookname = data.get("bookname")
+    selected = data.get("selectedChapters", [])
+    strategy = data.get("strategy", "single")
+    oversize = data.get("oversize", "chunk")
+    if not bookname or not selected:
+        return None, (jsonify({"success": False, "error": "Missing data"}), 400)
+    if strategy not in ("single", "mapreduce"):
+        return None, (jsonify({"success": False, "error": "Strategy must be 'single' or 'mapreduce'"}), 400)
+    if oversize not in OVERSIZE_POLICIES:
+        return None, (jsonify({"success": False, "error": "Oversize must be 'chunk' or 'refuse'"}), 400)
+    found = resolve_chapters(bookname, selected)
+    if not found:
+        return None, (jsonify({"success": False, "error": "No selected chapter found"}), 404)
+    plan = plan_generation(bookname, found, data.get("mode", "Summarization"), strategy)
+    if plan["oversize"] and oversize == "refuse":
+        error = f"Selection of ~{plan['totalTokens']} tokens exceeds the budget of {plan['budget']} per request"
+        return None, (jsonify({"success": False, "error": error, "estimate": plan}), 413)
+    return plan, None
+
+
+@app.route("/api/generation-estimate", methods=["POST"])
+def generation_estimate():
+    data = request.get_json(silent=True) or {}
+    try:
+        plan, error = generation_plan({**data, "oversize": "chunk"})
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+    if error:
+        return error
+    return jsonify({"success": True, **plan})
+
+
 @app.route("/api/gemini-generation", methods=["POST"])
 def gemini_generation():
     # Leggi il body JSON senza esplodere se manca l'header giusto
@@ -217,70 +456,237 @@ def gemini_generation():
     selected = data.get("selectedChapters", [])
     mode = data.get("mode", "Summarization")
 
-    # Validazioni minime
-    if not bookname or not selected:
-        return jsonify({"success": False, "error": "Missing data"}), 400
+    # Validazioni minime, poi il budget di token prima di qualsiasi chiamata
+    plan, error = generation_plan(data)
+    if error:
+        return error
+    strategy = plan["strategy"]
 
-    if not os.environ.get("GEMINI_API_KEY"):
+    if not gemini_available():
         return jsonify({"success": False, "error": "Missing API key"}), 500
 
-    chapters_json = json.dumps(selected)
-    env = os.environ.copy()
+    # In-process, through the shared Gemini client: someone is waiting, so it goes before queued jobs
+    generation_data = extract_chapter_info(bookname, selected, mode, strategy=strategy, priority=PRIORITY_INTERACTIVE)
+
+    if generation_data.get("status") == "error":
+        return jsonify({"success": False, "error": generation_data.get("message")}), 500
+
+    return jsonify({"success": True, "data": generation_data, "estimate": plan})
 
-    # Niente try/except: non usiamo check=True per evitare eccezioni automatiche
-    result = subprocess.run(
-        [sys.executable, "logic/gemini_generation.py", bookname, chapters_json, mode],
-        capture_output=True,
-        text=True,
-        check=False,
-        env=env,
+@app.route("/api/generation-jobs", methods=["POST"])
+def submit_generation_job():
+    data = request.get_json(silent=True) or {}
+    bookname = data.get("bookname")
+    selected = data.get("selectedChapters", [])
+    mode = data.get("mode", "Summarization")
+
+    plan, error = generation_plan(data)
+    if error:
+        return error
+    if not gemini_available():
+        return jsonify({"success": False, "error": "Missing API key"}), 500
+
+    # an oversized single request runs as a chunked map-reduce
+    job_id = get_job_queue().submit(bookname, selected, mode, plan["strategy"])
+    return jsonify({"success": True, "jobId": job_id, "status": "queued", "estimate": plan}), 202
+
+
+@app.route("/api/generation-jobs/<job_id>", methods=["GET"])
+def generation_job_status(job_id):
+    job = get_job_queue().status(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    return jsonify(
+        {
+            "success": True,
+            "jobId": job_id,
+            "status": job["status"],
+            "bookname": job["bookname"],
+            "mode": job["mode"],
+            "partial": job["partial"],
+            "error": job["error"],
+            "createdAt": job["created_at"],
+            "updatedAt": job["updated_at"],
+        }
     )
 
-    # Se il processo è fallito, ritorna stderr
-    if result.returncode != 0:
-        return jsonify({"success": False, "error": result.stderr or "Subprocess failed"}), 500
-
-    out = (result.stdout or "").strip()
-    if not out:
-        return jsonify({"success": False, "error": "No output from gemini_generation.py"}), 500
-
-    # Prova a isolare JSON pulito: (1) ultima riga non vuota se sembra JSON, altrimenti (2) blocco tra { ... }
-    json_text = ""
-    lines = [ln for ln in out.splitlines() if ln.strip()]
-    if lines and (lines[-1].lstrip().startswith("{") and lines[-1].rstrip().endswith("}")):
-        json_text = lines[-1]
-    else:
-        start = out.find("{")
-        end = out.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            json_text = out[start:end+1]
-
-    if not json_text:
-        return jsonify({
-            "success": False,
-            "error": "Invalid JSON from subprocess (no JSON block found)",
-            "raw_stdout": out[:1000]
-        }), 500
-
-    # ATTENZIONE: se il JSON è malformato qui Flask tornerà 500 (come richiesto, senza try/except)
-    generation_data = json.loads(json_text)
 
-    if generation_data.get("status") == "error":
-        return jsonify({"success": False, "error": generation_data.get("message")}), 500
+@app.route("/api/generation-jobs/<job_id>/events", methods=["GET"])
+def generation_job_events(job_id):
+    # Server-Sent Events: status changes, output chunks as Gemini produces them, then done/error
+    events = get_job_queue().events(job_id)
+
+    def stream():
+        for event, data in events:
+            if event == "ping":
+                yield ": ping\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(
+        stream(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/api/generation-jobs/<job_id>/result", methods=["GET"])
+def generation_job_result(job_id):
+    job = get_job_queue().status(job_id)
+    if job is None:
+        return jsonify({"success": False, "error": "Job not found"}), 404
+    if job["status"] == ERROR:
+        return jsonify({"success": False, "status": ERROR, "error": job["error"]}), 500
+    if job["status"] != DONE:
+        return jsonify({"success": False, "status": job["status"], "partial": job["partial"]}), 202
+    return jsonify({"success": True, "status": DONE, "data": job["result"]})
+
+
+@app.route("/api/gemini-client/stats")
+def gemini_client_stats():
+    return jsonify({"success": True, **get_gemini_service().stats()})
+
+
+@app.route("/api/generation-cache/stats")
+def generation_cache_stats():
+    return jsonify({"success": True, **get_generation_cache().stats()})
 
-    return jsonify({"success": True, "data": generation_data})
 
 @app.route("/api/chapter-file/<bookname>/<filename>")
 def serve_chapter_file(bookname, filename):
     try:
         chapter_dir = Path("bookstore") / "elaboratebook" / bookname
         if not (chapter_dir / filename).exists():
-            return jsonify({"error": "Not found"}), 404
-        return send_from_directory(chapter_dir, filename)
+            chapter = get_catalog().chapter_by_filename(bookname, filename)
+            if chapter is None or not chapter["virtual"]:
+                return jsonify({"error": "Not found"}), 404
+            # virtual chapter: built from the source book (or taken from the buffer LRU);
+            # its content hash is a strong validator, byte ranges work on the buffer as on a file
+            if request.if_none_match.contains(chapter["sha256"]):
+                return Response(status=304, headers={"ETag": f'"{chapter["sha256"]}"', "Cache-Control": "no-cache"})
+            data = get_chapter_buffers().get(bookname, chapter)
+            return send_file(
+                io.BytesIO(data),
+                mimetype="application/pdf",
+                download_name=filename,
+                etag=chapter["sha256"],
+                last_modified=source_pdf(bookname).stat().st_mtime,
+            )
+        # Range, ETag and Last-Modified are handled by send_file; no-cache makes viewers revalidate
+        response = send_from_directory(chapter_dir.resolve(), filename)
+        response.cache_control.no_cache = True
+        return response
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@app.route("/api/chapter-export/<bookname>/<filename>", methods=["POST"])
+def export_virtual_chapter(bookname, filename):
+    # write a virtual chapter out as a real file (downloads, tools that need a path)
+    try:
+        catalog = get_catalog()
+        chapter = catalog.chapter_by_filename(bookname, filename)
+        if chapter is None:
+            return jsonify({"success": False, "error": "Not found"}), 404
+        book_dir = Path("bookstore") / "elaboratebook" / bookname
+        if chapter["virtual"]:
+            path = export_chapter(bookname, chapter, book_dir)
+            catalog.add_chapters(bookname, [{
+                "chapterNumber": chapter["number"],
+                "filename": filename,
+                "path": str(path),
+                "startPage": chapter["start_page"],
+                "endPage": chapter["end_page"],
+                "pageCount": chapter["page_count"],
+                # same pages as before: keep the token count and identity the row already has
+                "tokens": chapter["tokens"],
+                "sha256": chapter["sha256"],
+            }])
+            manifest = read_manifest(book_dir)
+            if manifest:
+                for entry in manifest["chapters"]:
+                    if entry["filename"] == filename:
+                        entry["virtual"] = False
+                        entry.pop("sha256", None)
+                write_manifest(book_dir, manifest)
+        return jsonify(
+            {"success": True, "bookname": bookname, "filename": filename, "path": str(book_dir / filename),
+             "exported": bool(chapter["virtual"])}
+        )
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route("/api/chapter-text/<bookname>/<filename>")
+def serve_chapter_text(bookname, filename):
+    # page range of a chapter (1-based, inclusive) straight from its text sidecar
+    try:
+        chapter_file = Path("bookstore") / "elaboratebook" / bookname / filename
+        start = int(request.args.get("start", 1))
+        end = request.args.get("end")
+        if not chapter_file.exists():
+            chapter = get_catalog().chapter_by_filename(bookname, filename)
+            if chapter is None or not chapter["virtual"]:
+                return jsonify({"success": False, "error": "Not found"}), 404
+            page_count = chapter["end_page"] - chapter["start_page"] + 1
+            last = page_count if end is None else min(int(end), page_count)
+            if start < 1 or last < start:
+                return jsonify({"success": False, "error": f"Invalid page range (1-{page_count})"}), 400
+            text = get_chapter_buffers().text(bookname, chapter, start - 1, last - 1)
+        else:
+            sidecar = open_sidecar(chapter_file)
+            if sidecar is None:
+                extract_text_from_pdf(str(chapter_file))  # builds the sidecar
+                sidecar = open_sidecar(chapter_file)
+            with sidecar:
+                page_count = sidecar.page_count
+                last = page_count if end is None else min(int(end), page_count)
+                if start < 1 or last < start:
+                    return jsonify({"success": False, "error": f"Invalid page range (1-{page_count})"}), 400
+                text = sidecar.text(start - 1, last - 1)
+        return jsonify(
+            {
+                "success": True,
+                "bookname": bookname,
+                "filename": filename,
+                "pageCount": page_count,
+                "startPage": start,
+                "endPage": last,
+                "text": text,
+            }
+        )
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
+@app.route("/api/search")
+def search_library():
+    # ranked pages of the whole library (or of ?book=) from the search index: no PDF is opened
+    query = request.args.get("q", "").strip()
+    if not query:
+        return jsonify({"success": False, "error": "Missing q"}), 400
+    try:
+        limit, offset = page_args(SEARCH_PAGE_SIZE)
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    try:
+        start = time.perf_counter()
+        hits, total = get_search_index().search(query, request.args.get("book"), limit, offset)
+        return jsonify(
+            {
+                "success": True,
+                "query": query,
+                "hits": hits,
+                "tookMs": round((time.perf_counter() - start) * 1000, 2),
+                **page_info(limit, offset, len(hits), total),
+            }
+        )
+    except ValueError as e:
+        return jsonify({"success": False, "error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"success": False, "error": str(e)}), 500
+
+
 @app.route("/api/save-chapters", methods=["POST"])
 def save_chapters():
     data = request.get_json()
@@ -293,12 +699,17 @@ def save_chapters():
         temp_file = temp_dir / f"{bookname}_chapters.json"
         with open(temp_file, "w", encoding="utf-8") as f:
             json.dump(chapters_data, f, ensure_ascii=False, indent=2)
-        result = subprocess.run(
-            [sys.executable, "logic/pdf_splitter.py", bookname, str(temp_file)],
-            capture_output=True,
-            text=True,
-            check=True,
-        )
+        # the splitter's stage lines (on its stderr) carry this request's id
+        env = {**os.environ, REQUEST_ID_ENV: g.request_id}
+        with SUBPROCESSES.track(command="pdf_splitter"), stage("split_subprocess", book=bookname):
+            result = subprocess.run(
+                [sys.executable, "logic/pdf_splitter.py", bookname, str(temp_file)],
+                capture_output=True,
+                text=True,
+                check=True,
+                env=env,
+            )
+        sys.stderr.write(result.stderr)
         temp_file.unlink()
         split_result = json.loads(result.stdout.strip())
         if split_result.get("status") == "error":
@@ -311,4 +722,5 @@ def save_chapters():
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    # development server (reloader and debugger on); production: gunicorn -c gunicorn.conf.py wsgi:app
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=os.environ.get("FLASK_DEBUG", "1") == "1")
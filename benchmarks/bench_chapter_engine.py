@@ -0,0 +1,86 @@
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.synthetic import make_book
+from logic.chapter_engine import ChapterEngine
+
+#Latency of /api/analyze-chapter: subprocess chapterlistcreator.py vs in-process ChapterEngine
+# usage: python benchmarks/bench_chapter_engine.py [--pages 100 500 2000] [--repeat 5] [--json]
+
+
+def time_call(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def run_subprocess(bookname, reference_page):
+    result = subprocess.run(
+        [sys.executable, str(ROOT / "logic" / "chapterlistcreator.py"), bookname, str(reference_page)],
+        capture_output=True,
+        text=True,
+        timeout=300,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr or result.stdout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[100, 500, 2000])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        book_dir = Path("bookstore") / "booktemp"
+        book_dir.mkdir(parents=True)
+        engine = ChapterEngine(workers=1)
+        for pages in args.pages:
+            bookname = f"synthetic_{pages}"
+            make_book(book_dir / f"{bookname}.pdf", pages)
+
+            subprocess_s = time_call(lambda: run_subprocess(bookname, 1), args.repeat)
+            start = time.perf_counter()
+            engine.run(bookname, 1)
+            cold_s = time.perf_counter() - start
+            warm_s = time_call(lambda: engine.run(bookname, 1), args.repeat)
+            rows.append(
+                {
+                    "pages": pages,
+                    "subprocess_s": round(subprocess_s, 4),
+                    "engine_cold_s": round(cold_s, 4),
+                    "engine_warm_s": round(warm_s, 4),
+                    "speedup": round(subprocess_s / warm_s, 2) if warm_s else None,
+                }
+            )
+        engine.shutdown()
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return
+    print(f"{'pages':>6} {'subprocess':>12} {'engine cold':>12} {'engine warm':>12} {'speedup':>8}")
+    for row in rows:
+        print(
+            f"{row['pages']:>6} {row['subprocess_s']:>11.3f}s {row['engine_cold_s']:>11.3f}s "
+            f"{row['engine_warm_s']:>11.3f}s {row['speedup']:>7}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.synthetic import make_book
+from logic.span_index import build_span_index
+
+#Scaling of the sharded span scan with the number of worker processes
+# usage: python benchmarks/bench_parallel_scan.py [--pages 1500] [--workers 1 2 4 8] [--json]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1500)
+    parser.add_argument("--workers", type=int, nargs="+")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    cpus = os.cpu_count() or 1
+    workers_list = args.workers or sorted({1, 2, 4, 8, cpus} & set(range(1, cpus + 1)) | {1})
+
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        pdf_path = Path(workdir) / "synthetic.pdf"
+        make_book(pdf_path, args.pages)
+        for workers in workers_list:
+            start = time.perf_counter()
+            index = build_span_index(pdf_path, workers=workers)
+            elapsed = time.perf_counter() - start
+            rows.append({"workers": workers, "pages": args.pages, "seconds": round(elapsed, 3), "rows": len(index.pages)})
+    baseline = rows[0]["seconds"]
+    for row in rows:
+        row["speedup"] = round(baseline / row["seconds"], 2)
+
+    if args.json:
+        print(json.dumps({"cpus": cpus, "results": rows}, indent=2))
+        return
+    print(f"{args.pages} pages, {cpus} cpus")
+    print(f"{'workers':>8} {'seconds':>9} {'speedup':>8}")
+    for row in rows:
+        print(f"{row['workers']:>8} {row['seconds']:>9.3f} {row['speedup']:>7}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fitz
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.synthetic import make_book
+from logic.pdf_splitter import write_chapter, write_chapters_parallel
+from logic.text_store import page_texts, write_text_sidecar
+
+#Chapter split: page-by-page insert_pdf with default saves (the previous splitter) against
+#range copies saved with garbage collection + deflate, serial and with a process pool
+#The book embeds a body font and a header image shared by every page, like a real one (--plain: no).
+# usage: python benchmarks/bench_split.py [--pages 1000] [--chapter-pages 20] [--workers 4] [--plain] [--json]
+
+
+def split_per_page(pdf_path, output_dir, chapters):
+    """The splitter before range copies: one insert_pdf per page, default save options."""
+    doc = fitz.open(pdf_path)
+    try:
+        for ch in chapters:
+            chapter_doc = fitz.open()
+            for p in range(ch["startPage"] - 1, ch["endPage"]):
+                if p < len(doc):
+                    chapter_doc.insert_pdf(doc, from_page=p, to_page=p)
+            chapter_path = Path(output_dir) / f"cap{ch['chapterNumber']}.pdf"
+            chapter_doc.save(chapter_path)
+            chapter_doc.close()
+            write_text_sidecar(chapter_path, page_texts(doc, ch["startPage"] - 1, min(ch["endPage"], len(doc)) - 1))
+    finally:
+        doc.close()
+
+
+def split_ranges(pdf_path, output_dir, chapters):
+    doc = fitz.open(pdf_path)
+    try:
+        for ch in chapters:
+            write_chapter(doc, output_dir, ch)
+    finally:
+        doc.close()
+
+
+def plan_chapters(pages, chapter_pages):
+    return [
+        {"chapterNumber": k + 1, "title": f"Chapter {k + 1}", "startPage": start + 1,
+         "endPage": min(start + chapter_pages, pages), "pageCount": min(chapter_pages, pages - start)}
+        for k, start in enumerate(range(0, pages, chapter_pages))
+    ]
+
+
+def output_bytes(output_dir):
+    return sum(f.stat().st_size for f in Path(output_dir).glob("*.pdf"))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, default=1000)
+    parser.add_argument("--chapter-pages", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--plain", action="store_true")
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    chapters = plan_chapters(args.pages, args.chapter_pages)
+    variants = [
+        ("per-page", lambda pdf, out: split_per_page(pdf, out, chapters)),
+        ("ranges", lambda pdf, out: split_ranges(pdf, out, chapters)),
+        (f"ranges x{args.workers}", lambda pdf, out: write_chapters_parallel(pdf, out, chapters, args.workers)),
+    ]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        pdf_path = Path(workdir) / "synthetic.pdf"
+        make_book(pdf_path, args.pages, chapter_every=args.chapter_pages, embed_fonts=not args.plain, images=not args.plain)
+        for name, split in variants:
+            output_dir = Path(workdir) / name.replace(" ", "_")
+            output_dir.mkdir()
+            start = time.perf_counter()
+            split(str(pdf_path), output_dir)
+            elapsed = time.perf_counter() - start
+            rows.append({"variant": name, "seconds": round(elapsed, 3), "bytes": output_bytes(output_dir)})
+    baseline = rows[0]
+    for row in rows:
+        row["speedup"] = round(baseline["seconds"] / row["seconds"], 2)
+        row["sizeRatio"] = round(row["bytes"] / baseline["bytes"], 3)
+
+    if args.json:
+        print(json.dumps({"pages": args.pages, "chapters": len(chapters), "results": rows}, indent=2))
+        return
+    print(f"{args.pages} pages, {len(chapters)} chapters")
+    print(f"{'variant':>12} {'seconds':>9} {'speedup':>8} {'bytes':>12} {'size':>7}")
+    for row in rows:
+        print(f"{row['variant']:>12} {row['seconds']:>9.3f} {row['speedup']:>7}x {row['bytes']:>12} {row['sizeRatio']:>7}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.synthetic import make_book
+
+#Startup and first-request latency of the server modes: the dev server (with and without the
+#reloader, which imports everything twice) and gunicorn with preloaded workers (when installed).
+#Each run starts the server in a scratch bookstore, polls /api/health until it answers, then times
+#the first book info, page preview and chapter detection requests.
+# usage: python benchmarks/bench_startup.py [--repeat 3] [--workers 2] [--modes dev dev-noreload gunicorn] [--json]
+
+BOOK = "startup_bench"
+READY_TIMEOUT = 60
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def command(mode, workers):
+    if mode == "gunicorn":
+        return [sys.executable, "-m", "gunicorn", "-c", str(ROOT / "gunicorn.conf.py"),
+                "--pythonpath", str(ROOT), "--workers", str(workers), "wsgi:app"]
+    return [sys.executable, str(ROOT / "app.py")]
+
+
+def call(port, path, payload=None):
+    data = json.dumps(payload).encode() if payload is not None else None
+    req = urllib.request.Request(f"http://127.0.0.1:{port}{path}", data=data,
+                                 headers={"Content-Type": "application/json"} if data else {})
+    start = time.perf_counter()
+    with urllib.request.urlopen(req, timeout=60) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def wait_ready(port, proc, start):
+    while time.perf_counter() - start < READY_TIMEOUT:
+        if proc.poll() is not None:
+            raise RuntimeError(f"server exited with {proc.returncode}")
+        try:
+            call(port, "/api/health")
+            return time.perf_counter() - start
+        except OSError:
+            time.sleep(0.01)
+    raise RuntimeError("server not ready")
+
+
+def run_once(mode, workers, workdir):
+    port = free_port()
+    env = {**os.environ, "PORT": str(port), "FLASK_DEBUG": "1" if mode == "dev" else "0",
+           "ARB_LOG_LEVEL": "WARNING", "PYTHONUNBUFFERED": "1"}
+    start = time.perf_counter()
+    proc = subprocess.Popen(command(mode, workers), cwd=workdir, env=env, start_new_session=True,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        ready = wait_ready(port, proc, start)
+        return {
+            "ready_s": ready,
+            "info_s": call(port, "/api/bookelaboration", {"bookname": BOOK}),
+            "preview_s": call(port, f"/api/book-image/{BOOK}/1"),
+            "chapters_s": call(port, "/api/analyze-chapter", {"bookname": BOOK, "pageNumber": 1, "strategy": "font-scan"}),
+        }
+    finally:
+        os.killpg(proc.pid, signal.SIGTERM)  # the whole group: the reloader's child too
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            os.killpg(proc.pid, signal.SIGKILL)
+            proc.wait()
+
+
+def import_seconds(module):
+    """Cold import of module in a fresh interpreter (what every dev server start and reload pays)."""
+    code = f"import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)"
+    out = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True, check=True).stdout
+    return round(float(out.strip().splitlines()[-1]), 4)  # last line: fitz may print a notice first
+
+
+def gunicorn_available():
+    return subprocess.run([sys.executable, "-c", "import gunicorn"], capture_output=True).returncode == 0
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--modes", nargs="+", default=["dev", "dev-noreload", "gunicorn"])
+    parser.add_argument("--json", action="store_true")
+    args = parser.parse_args()
+
+    modes = [m for m in args.modes if m != "gunicorn" or gunicorn_available()]
+    skipped = sorted(set(args.modes) - set(modes))
+    imports = {module: import_seconds(module) for module in ("app", "google.genai.types")}
+    rows = []
+    with tempfile.TemporaryDirectory() as workdir:
+        book_dir = Path(workdir) / "bookstore" / "booktemp"
+        book_dir.mkdir(parents=True)
+        make_book(book_dir / f"{BOOK}.pdf", args.pages)
+        for mode in modes:
+            runs = []
+            for _ in range(args.repeat):
+                # cold caches every time: previews, span index, sqlite stores
+                for artifact in list(book_dir.glob(f"{BOOK}.*")) + list(Path(workdir, "bookstore").glob("*.sqlite")):
+                    if artifact.suffix != ".pdf":
+                        artifact.unlink()
+                shutil.rmtree(book_dir / "cache", ignore_errors=True)
+                runs.append(run_once(mode, args.workers, workdir))
+            row = {"mode": mode}
+            for key in runs[0]:
+                row[key] = round(statistics.median(r[key] for r in runs), 4)
+            row["total_s"] = round(row["ready_s"] + row["info_s"] + row["preview_s"] + row["chapters_s"], 4)
+            rows.append(row)
+
+    if args.json:
+        print(json.dumps({"workers": args.workers, "imports": imports, "skipped": skipped, "results": rows}, indent=2))
+        return
+    print(f"import app: {imports['app']:.3f}s (google.genai, now loaded on the first generation: "
+          f"{imports['google.genai.types']:.3f}s)")
+    print(f"{'mode':>13} {'ready':>8} {'info':>8} {'preview':>8} {'chapters':>9} {'total':>8}")
+    for row in rows:
+        print(f"{row['mode']:>13} {row['ready_s']:>7.3f}s {row['info_s']:>7.3f}s {row['preview_s']:>7.3f}s "
+              f"{row['chapters_s']:>8.3f}s {row['total_s']:>7.3f}s")
+    if skipped:
+        print(f"skipped (not installed): {', '.join(skipped)}")
+
+
+if __name__ == "__main__":
+    main()
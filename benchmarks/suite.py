@@ -0,0 +1,295 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import fitz
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from benchmarks.synthetic import make_book, make_epub
+
+#End-to-end timings of the hot paths on synthetic books, with wall time and peak RSS.
+#Every case runs in its own process (in a scratch bookstore), so the peak RSS it reports is its own;
+#Gemini is the local fake (GEMINI_FAKE=1), so the generation case measures our side only.
+#Results go to JSON (--output); with --baseline the run is compared to a stored one and exits 1
+#when a case got slower (or bigger) than --threshold times the baseline.
+# usage: python benchmarks/suite.py [--pages 200 1000] [--repeat 3] [--cases split text_extract]
+#        [--embed-fonts] [--images] [--outline] [--heading-font hebo] [--heading-size 24]
+#        [--output results.json] [--baseline baseline.json] [--threshold 1.25]
+
+CHAPTER_EVERY = 20
+
+
+def peak_rss_mb(who=resource.RUSAGE_SELF):
+    peak = resource.getrusage(who).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)  # bytes on macOS, KiB elsewhere
+
+
+def case_book_info(book):
+    from logic.extractor import extract_book_info
+    return lambda: extract_book_info(book["name"]), None
+
+
+def case_book_info_epub(book):
+    from logic.extractor import extract_book_info
+    return lambda: extract_book_info(book["epub"]), None
+
+
+def case_page_image(book):
+    from logic.extractor import extract_page_image
+    pages = sorted({1, book["pages"] // 2, book["pages"]})
+    cache = Path("bookstore") / "booktemp" / "cache" / book["name"]
+
+    def run():
+        for page in pages:
+            extract_page_image(book["name"], page)
+    return run, lambda: shutil.rmtree(cache, ignore_errors=True)
+
+
+def case_max_font(book):
+    from logic.chapterlistcreator import find_max_font
+
+    def run():
+        doc = fitz.open(book["path"])
+        try:
+            return find_max_font(doc.load_page(0))
+        finally:
+            doc.close()
+    return run, None
+
+
+def case_chapter_pages(book):
+    from logic.chapterlistcreator import find_chapter_pages
+    font, size = case_max_font(book)[0]()
+    return lambda: find_chapter_pages(book["path"], font, size), None
+
+
+def plan_chapters(book):
+    from logic.chapterlistcreator import find_chapter_pages
+    font, size = case_max_font(book)[0]()
+    starts, titles = find_chapter_pages(book["path"], font, size)
+    ends = [s - 1 for s in starts[1:]] + [book["pages"]]
+    return {"chapters": [
+        {"chapterNumber": k + 1, "title": title, "startPage": start, "endPage": end, "pageCount": end - start + 1}
+        for k, (start, end, title) in enumerate(zip(starts, ends, titles))
+    ]}
+
+
+def _split(book, chapters, workers=None):
+    from logic.pdf_splitter import split_pdf_into_chapters
+    result = split_pdf_into_chapters(book["name"], chapters, workers=workers, virtual=False)
+    if result["status"] != "success":
+        raise RuntimeError(result["message"])
+    return result
+
+
+def case_split(book):
+    chapters = plan_chapters(book)
+    output_dir = Path("bookstore") / "elaboratebook" / book["name"]
+    return (
+        lambda: _split(book, chapters, book["workers"]),
+        lambda: shutil.rmtree(output_dir, ignore_errors=True),
+    )
+
+
+def case_text_extract(book):
+    from logic.gemini_generation import extract_text_from_pdf
+    from logic.text_store import sidecar_path
+
+    def run():
+        text = extract_text_from_pdf(book["path"])
+        if text.startswith("Error"):
+            raise RuntimeError(text)
+    # without the sidecar: the extraction itself, not the read of its result
+    return run, lambda: sidecar_path(book["path"]).unlink(missing_ok=True)
+
+
+def case_generation(book):
+    from logic.gemini_generation import extract_chapter_info
+    from logic.generation_cache import get_generation_cache
+    created = _split(book, plan_chapters(book))["createdFiles"]
+    selected = [f"{book['name']}_cap{c['chapterNumber']}" for c in created]
+
+    def run():
+        result = extract_chapter_info(book["name"], selected, "summarization", strategy="mapreduce")
+        if result.get("status") == "error":
+            raise RuntimeError(result.get("message"))
+    # every repetition pays for the requests, not for cache hits
+    return run, lambda: get_generation_cache().invalidate_book(book["name"])
+
+
+CASES = {
+    "book_info": case_book_info,
+    "book_info_epub": case_book_info_epub,
+    "page_image": case_page_image,
+    "max_font": case_max_font,
+    "chapter_pages": case_chapter_pages,
+    "split": case_split,
+    "text_extract": case_text_extract,
+    "generation": case_generation,
+}
+
+
+def run_case(args):
+    """Child side: set the case up, time it args.repeat times, write the result to args.result."""
+    os.chdir(args.workdir)
+    book = {
+        "name": args.book,
+        "path": str(Path("bookstore") / "booktemp" / f"{args.book}.pdf"),
+        "epub": f"{args.book}_epub",
+        "pages": args.book_pages,
+        "workers": args.workers,
+    }
+    run, reset = CASES[args.case](book)
+    rss_before = peak_rss_mb()
+    samples = []
+    for _ in range(args.repeat):
+        if reset:
+            reset()
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    Path(args.result).write_text(json.dumps({
+        "samples": [round(s, 6) for s in samples],
+        "setupRssMb": rss_before,
+        "peakRssMb": peak_rss_mb(),
+        "workersPeakRssMb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    }))
+
+
+def spawn_case(case, book, pages, workdir, args):
+    with tempfile.NamedTemporaryFile(suffix=".json", delete=False) as f:
+        result_path = f.name
+    env = {**os.environ, "GEMINI_FAKE": "1", "GEMINI_FAKE_DELAY": str(args.fake_delay), "ARB_LOG_LEVEL": "WARNING"}
+    env.pop("GEMINI_BASE_URL", None)
+    command = [
+        sys.executable, str(Path(__file__).resolve()), "--case", case, "--workdir", str(workdir),
+        "--book", book, "--book-pages", str(pages), "--repeat", str(args.repeat),
+        "--workers", str(args.workers), "--result", result_path,
+    ]
+    try:
+        proc = subprocess.run(command, capture_output=True, text=True, env=env, timeout=3600)
+        if proc.returncode != 0:
+            raise RuntimeError(f"{case} ({pages} pages) failed:\n{proc.stderr.strip()}")
+        measured = json.loads(Path(result_path).read_text())
+    finally:
+        os.unlink(result_path)
+    samples = measured.pop("samples")
+    return {
+        "case": case,
+        "pages": pages,
+        "seconds": round(statistics.median(samples), 4),
+        "min": round(min(samples), 4),
+        "max": round(max(samples), 4),
+        **measured,
+    }
+
+
+def compare(results, baseline, threshold):
+    """Ratios to the baseline per (case, pages); a regression is a ratio above threshold."""
+    previous = {(r["case"], r["pages"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for row in results:
+        old = previous.get((row["case"], row["pages"]))
+        if old is None:
+            continue
+        row["timeRatio"] = round(row["seconds"] / old["seconds"], 2) if old["seconds"] else None
+        row["rssRatio"] = round(row["peakRssMb"] / old["peakRssMb"], 2) if old["peakRssMb"] else None
+        if (row["timeRatio"] or 0) > threshold or (row["rssRatio"] or 0) > threshold:
+            regressions.append(f"{row['case']} ({row['pages']} pages)")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pages", type=int, nargs="+", default=[200, 1000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES))
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--embed-fonts", action="store_true")
+    parser.add_argument("--images", action="store_true")
+    parser.add_argument("--outline", action="store_true")
+    parser.add_argument("--heading-font", default="hebo")
+    parser.add_argument("--heading-size", type=float, default=24)
+    parser.add_argument("--fake-delay", type=float, default=0.0)
+    parser.add_argument("--output")
+    parser.add_argument("--baseline")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    parser.add_argument("--json", action="store_true")
+    # child process
+    parser.add_argument("--case", choices=list(CASES), help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    parser.add_argument("--book", help=argparse.SUPPRESS)
+    parser.add_argument("--book-pages", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case:
+        run_case(args)
+        return
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        book_dir = Path(workdir) / "bookstore" / "booktemp"
+        book_dir.mkdir(parents=True)
+        for pages in args.pages:
+            book = f"bench_{pages}"
+            make_book(book_dir / f"{book}.pdf", pages, chapter_every=CHAPTER_EVERY, embed_fonts=args.embed_fonts,
+                      images=args.images, outline=args.outline, heading_font=args.heading_font,
+                      heading_size=args.heading_size)
+            make_epub(book_dir / f"{book}_epub.epub", max(1, pages // CHAPTER_EVERY))
+            for case in args.cases:
+                results.append(spawn_case(case, book, pages, workdir, args))
+
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "pymupdf": fitz.VersionBind,
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "repeat": args.repeat,
+            "workers": args.workers,
+            "book": {"embedFonts": args.embed_fonts, "images": args.images, "outline": args.outline,
+                     "headingFont": args.heading_font, "headingSize": args.heading_size,
+                     "chapterEvery": CHAPTER_EVERY},
+        },
+        "results": results,
+    }
+    regressions = []
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        regressions = compare(results, baseline, args.threshold)
+        report["baseline"] = {"path": args.baseline, "threshold": args.threshold, "regressions": regressions}
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2), encoding="utf-8")
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        compared = bool(args.baseline)
+        print(f"{'case':>15} {'pages':>6} {'seconds':>9} {'peak RSS':>10} {'workers RSS':>12}"
+              + (f" {'time':>6} {'RSS':>6}" if compared else ""))
+        for row in results:
+            line = (f"{row['case']:>15} {row['pages']:>6} {row['seconds']:>9.4f} {row['peakRssMb']:>8.1f}MB "
+                    f"{row['workersPeakRssMb']:>10.1f}MB")
+            if compared:
+                line += f" {row.get('timeRatio', '-'):>5}x {row.get('rssRatio', '-'):>5}x"
+            print(line)
+        if regressions:
+            print(f"Regressions over {args.threshold}x the baseline: {', '.join(regressions)}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+import fitz
+
+#This file builds synthetic books used by the benchmarks
+
+LOREM = (
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod "
+    "tempor incididunt ut labore et dolore magna aliqua."
+)
+
+
+def header_image(width=400, height=60):
+    """A PNG gradient band, stored once in the book and shown on every page like a running header."""
+    samples = bytearray()
+    for y in range(height):
+        for x in range(width):
+            shade = 255 - x * 160 // width
+            samples += bytes((shade, (shade + y * 2) % 256, 200))
+    return fitz.Pixmap(fitz.csRGB, width, height, bytes(samples), False).tobytes("png")
+
+
+def make_book(path, pages, chapter_every=20, lines_per_page=40, embed_fonts=False, images=False, outline=False,
+              heading_font="hebo", heading_size=24):
+    """Synthetic book; embed_fonts and images add the resources shared by every page of a real book
+    (an embedded body font and a header image), which is what page-by-page copies duplicate.
+    outline adds a bookmark per chapter, like publisher PDFs. Chapter headings use heading_font
+    (a base-14 name) at heading_size, the largest text of the page as long as it is above 10."""
+    doc = fitz.open()
+    font_buffer = fitz.Font("tiro").buffer if embed_fonts else None
+    image = header_image() if images else None
+    body_font = "tiro-embedded" if embed_fonts else "helv"
+    chapter = 0
+    toc = []
+    for i in range(pages):
+        page = doc.new_page(width=595, height=842)
+        if font_buffer:
+            page.insert_font(fontname=body_font, fontbuffer=font_buffer)
+        if image:
+            page.insert_image(fitz.Rect(97, 20, 497, 60), stream=image)
+        y = 72
+        if i % chapter_every == 0:
+            chapter += 1
+            page.insert_text((72, y), f"Chapter {chapter}", fontname=heading_font, fontsize=heading_size)
+            toc.append([1, f"Chapter {chapter}", i + 1])
+            y += heading_size * 2
+        step = (842 - 72 - y) / max(1, lines_per_page)
+        for _ in range(lines_per_page):
+            page.insert_text((72, y), LOREM, fontname=body_font, fontsize=10)
+            y += step
+    if outline:
+        doc.set_toc(toc)
+    doc.save(str(path))
+    doc.close()
+    return path
+
+
+def _xhtml(title, body):
+    return (
+        '<?xml version="1.0" encoding="utf-8"?>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml"><head>'
+        f"<title>{title}</title><link rel=\"stylesheet\" href=\"../style.css\"/></head><body>{body}</body></html>"
+    )
+
+
+def make_epub(path, chapters, sections_per_chapter=2, paragraphs=30):
+    """Synthetic EPUB 3 (with an EPUB 2 toc.ncx too): every chapter spans sections_per_chapter
+    spine items and the navigation points at the first one."""
+    import zipfile
+
+    spine, nav_points = [], []
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr(zipfile.ZipInfo("mimetype"), "application/epub+zip")  # stored, first
+        zf.writestr(
+            "META-INF/container.xml",
+            '<?xml version="1.0"?><container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+            '<rootfiles><rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>'
+            "</rootfiles></container>",
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        zf.writestr("OEBPS/style.css", "body { font-family: serif; } h1 { font-size: 2em; }", compress_type=zipfile.ZIP_DEFLATED)
+        for c in range(1, chapters + 1):
+            for s in range(sections_per_chapter):
+                name = f"text/ch{c:03d}_{s}.xhtml"
+                heading = f"<h1>Chapter {c}</h1>" if s == 0 else ""
+                body = heading + "".join(f"<p>{LOREM} ({c}.{s}.{p})</p>" for p in range(paragraphs))
+                zf.writestr(f"OEBPS/{name}", _xhtml(f"Chapter {c}", body), compress_type=zipfile.ZIP_DEFLATED)
+                spine.append(name)
+            nav_points.append((f"Chapter {c}", f"text/ch{c:03d}_0.xhtml"))
+        items = "".join(
+            f'<item id="s{k}" href="{name}" media-type="application/xhtml+xml"/>' for k, name in enumerate(spine)
+        )
+        zf.writestr(
+            "OEBPS/content.opf",
+            '<?xml version="1.0"?><package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="id">'
+            '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Synthetic</dc:title>'
+            '<dc:identifier id="id">synthetic</dc:identifier><dc:language>en</dc:language></metadata>'
+            f'<manifest><item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>'
+            '<item id="ncx" href="toc.ncx" media-type="application/x-dtbncx+xml"/>'
+            f'<item id="css" href="style.css" media-type="text/css"/>{items}</manifest>'
+            '<spine toc="ncx">' + "".join(f'<itemref idref="s{k}"/>' for k in range(len(spine))) + "</spine></package>",
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        links = "".join(f'<li><a href="{href}">{title}</a></li>' for title, href in nav_points)
+        zf.writestr(
+            "OEBPS/nav.xhtml",
+            _xhtml("Contents", f'<nav xmlns:epub="http://www.idpf.org/2007/ops" epub:type="toc"><ol>{links}</ol></nav>'),
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+        points = "".join(
+            f'<navPoint id="n{k}" playOrder="{k + 1}"><navLabel><text>{title}</text></navLabel><content src="{href}"/></navPoint>'
+            for k, (title, href) in enumerate(nav_points)
+        )
+        zf.writestr(
+            "OEBPS/toc.ncx",
+            '<?xml version="1.0"?><ncx xmlns="http://www.daisy.org/z3986/2005/ncx/" version="2005-1">'
+            f"<head/><docTitle><text>Synthetic</text></docTitle><navMap>{points}</navMap></ncx>",
+            compress_type=zipfile.ZIP_DEFLATED,
+        )
+    return path
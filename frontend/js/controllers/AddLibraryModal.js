@@ -137,17 +137,18 @@ export class AddLibraryModal {
   submitBtn.innerHTML = '<span class="spinner mr-2"></span>Uploading...';
 
   try {
-    const formData = new FormData();
-    formData.append('title', title.trim());
-    formData.append('author', (author?.trim() || 'Unknown Author'));
-    formData.append('book-file', file);
-
-    const data = await APIClient.uploadBook(formData);
+    const data = await APIClient.uploadBook(file, title.trim(), (author?.trim() || 'Unknown Author'));
     if (!data.success || !data.bookname) {
       throw new Error(data.error || 'Book upload failed.');
     }
 
     this.closeModal();
+    if (data.reusedChapters) {
+      // same content already split under another title: its chapters were reused
+      notifications.success(`Book "${title}" was already known, chapters ready!`);
+      await window.navbar.loadLibraryBooks();
+      return;
+    }
     notifications.success(`Book "${title}" uploaded successfully!`);
     window.showChapterModal(data.bookname);
 
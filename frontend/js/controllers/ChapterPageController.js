@@ -135,17 +135,18 @@ export class ChapterPageController {
 
   confirmPage() {
     console.log('Extracting chapters using page:', this.currentPage);
-    this.extractChapters();
+    // a page picked by hand asks for the font scan even when the book has an outline
+    this.extractChapters('font-scan');
   }
 
-  async extractChapters() {
+  async extractChapters(strategy = 'auto') {
     if (!this.bookname) {
               notifications.warning('No book selected');
       return;
     }
     
     try {
-      const data = await APIClient.analyzeChapter(this.bookname, this.currentPage);
+      const data = await APIClient.analyzeChapter(this.bookname, this.currentPage, strategy);
       
       if (data.success) {
         this.displayChaptersList(data);
@@ -336,11 +337,11 @@ export class ChapterPageController {
   updateImage() {
     if (!this.pageImage || !this.bookname) return;
 
-    // Load real image from server
-    const imageUrl = APIClient.getPageImageURL(this.bookname, this.currentPage);
-    
-    const timestamp = new Date().getTime();
-    this.pageImage.src = `${imageUrl}?t=${timestamp}`;
+    // Load real image from server, sized for the preview box (the server sends ETags,
+    // so the browser cache takes care of pages already seen)
+    const imageUrl = APIClient.getPageImageURL(this.bookname, this.currentPage, this.getPreviewOptions());
+
+    this.pageImage.src = imageUrl;
     this.pageImage.style.opacity = '0.7';
     
     this.pageImage.onload = () => {
@@ -356,6 +357,17 @@ export class ChapterPageController {
     };
   }
 
+  getPreviewOptions() {
+    const boxWidth = this.pageImage.parentElement ? this.pageImage.parentElement.clientWidth : 0;
+    if (!boxWidth) {
+      return { size: 'medium', format: 'webp', quality: 80 };
+    }
+    // Round up to 100px steps so nearby layouts share the same cached variant
+    const pixels = boxWidth * (window.devicePixelRatio || 1);
+    const width = Math.min(2000, Math.max(200, Math.ceil(pixels / 100) * 100));
+    return { width, format: 'webp', quality: 80 };
+  }
+
   reconnectInputListeners() {
     // Reconnect event listeners to the new input
     this.pageInput = DOMHelpers.querySelector('#page-number input[type="number"]');
@@ -389,6 +401,10 @@ export class ChapterPageController {
         this.totalPages = data.pages;
         console.log(`Book elaborated successfully. Total pages: ${this.totalPages}`);
         this.updatePageNumberDisplay();
+        if (data.outline) {
+          // chapters from the book's outline / table of contents, no reference page to pick
+          this.displayChaptersList(data.outline);
+        }
       } else {
         throw new Error(data.error || 'Unknown error');
       }
@@ -99,44 +99,187 @@ export class GenerateController {
     try {
       // Prepare selected chapter IDs for the API
       const selectedChapterIds = chapters.map(ch => ch.id);
-      
+
+      // Several chapters are summarized one by one in parallel, then merged (map-reduce)
+      const strategy = selectedChapterIds.length > 1 ? 'mapreduce' : 'single';
+
+      // Submit the job; the server answers right away with its id
+      const job = await APIClient.submitGenerationJob(bookName, selectedChapterIds, mode, strategy);
+      if (!job.success) {
+        throw new Error(job.error || 'Unknown error in generation');
+      }
+      this.currentGeneration.jobId = job.jobId;
+      if (job.estimate) {
+        const { totalTokens, estimate } = job.estimate;
+        notifications.info(
+          `~${totalTokens} tokens, ${estimate.requests} request(s), ~${Math.ceil(estimate.latencySeconds)}s`
+        );
+      }
       this.currentGeneration.status = 'processing';
-      this.updateGenerationProgress('Processing chapters...', 30);
+      this.saveGenerationState();
+
+      await this.waitForJob(job.jobId);
+    } catch (error) {
+      console.error('Generation error:', error);
+      if (this.currentGeneration) {
+        this.currentGeneration.status = 'error';
+        this.currentGeneration.error = error.message;
+      }
+      notifications.error(`Error during generation: ${error.message}`);
+      this.clearGenerationState();
+    } finally {
+      // Reset state
+      this.isGenerating = false;
+      this.currentGeneration = null;
+      this.resetButtons();
+    }
+  }
 
-      // Call the Gemini generation API
-      const result = await APIClient.generateSummary(bookName, selectedChapterIds, mode);
+  waitForJob(jobId) {
+    if (!window.EventSource) {
+      return this.pollJob(jobId);
+    }
+    this.updateGenerationProgress('Waiting in queue...', 15);
+
+    return new Promise((resolve, reject) => {
+      const source = APIClient.openGenerationJobEvents(jobId);
+      let text = '';
+
+      const finish = (callback) => {
+        source.close();
+        clearInterval(cancelWatch);
+        callback();
+      };
+      // cancelGeneration() only flips the flag: close the stream when it does
+      const cancelWatch = setInterval(() => {
+        if (!this.isGenerating) {
+          finish(resolve);
+        }
+      }, 500);
+
+      // Every (re)connection starts again from the full output so far
+      source.addEventListener('open', () => {
+        text = '';
+      });
+
+      source.addEventListener('status', (e) => {
+        const { status } = JSON.parse(e.data);
+        if (status === 'queued') {
+          // requeued after its worker stopped: the output starts over
+          text = '';
+        } else if (status === 'running') {
+          this.updateGenerationProgress('Processing chapters...', 30);
+        }
+      });
+
+      source.addEventListener('chunk', (e) => {
+        text += JSON.parse(e.data).text;
+        this.displayPartialResult(text);
+        this.updateGenerationProgress('AI responding...', 70);
+      });
+
+      source.addEventListener('done', (e) => {
+        const { data } = JSON.parse(e.data);
+        finish(() => {
+          this.completeGeneration(data);
+          resolve();
+        });
+      });
+
+      source.addEventListener('error', (e) => {
+        // Named 'error' events come from the server, plain ones from the connection
+        if (e.data) {
+          finish(() => reject(new Error(JSON.parse(e.data).error || 'Unknown error in generation')));
+        } else if (source.readyState === EventSource.CLOSED) {
+          finish(() => reject(new Error('Connection to the server lost')));
+        }
+      });
+    });
+  }
 
-      this.updateGenerationProgress('AI responding...', 70);
+  completeGeneration(data) {
+    if (!this.currentGeneration) {
+      return;
+    }
+    this.currentGeneration.status = 'completed';
+    this.currentGeneration.result = data;
+    this.updateGenerationProgress('Complete!', 100);
 
-      if (result.success) {
-        this.currentGeneration.status = 'completed';
-        this.currentGeneration.result = result.data;
-        this.updateGenerationProgress('Complete!', 100);
-        
-        // Show results
-        this.displayGenerationResults(result.data);
-        notifications.success(`Generation completed for ${result.data.total_chapters} chapters!`);
-        
-        // Clear saved state since completed
-        this.clearGenerationState();
-      } else {
-        throw new Error(result.error || 'Unknown error in generation');
+    // Show results
+    this.displayGenerationResults(data);
+    notifications.success(`Generation completed for ${data.total_chapters} chapters!`);
+
+    // Clear saved state since completed
+    this.clearGenerationState();
+  }
+
+  async pollJob(jobId) {
+    this.updateGenerationProgress('Waiting in queue...', 15);
+
+    while (this.isGenerating) {
+      const job = await APIClient.getGenerationJob(jobId);
+      if (!this.isGenerating) {
+        return; // cancelled while waiting
       }
-      
+
+      if (job.status === 'error') {
+        throw new Error(job.error || 'Unknown error in generation');
+      }
+
+      if (job.status === 'done') {
+        const result = await APIClient.getGenerationJobResult(jobId);
+        if (!result.success) {
+          throw new Error(result.error || 'Unknown error in generation');
+        }
+        this.completeGeneration(result.data);
+        return;
+      }
+
+      if (job.status === 'running') {
+        if (job.partial) {
+          this.displayPartialResult(job.partial);
+          this.updateGenerationProgress('AI responding...', 70);
+        } else {
+          this.updateGenerationProgress('Processing chapters...', 30);
+        }
+      }
+
+      await new Promise(resolve => setTimeout(resolve, 1500));
+    }
+  }
+
+  async resumeGeneration(state) {
+    this.isGenerating = true;
+    this.currentGeneration = { ...state, status: 'processing' };
+    this.disableButtons();
+
+    try {
+      await this.waitForJob(state.jobId);
     } catch (error) {
       console.error('Generation error:', error);
-      this.currentGeneration.status = 'error';
-      this.currentGeneration.error = error.message;
       notifications.error(`Error during generation: ${error.message}`);
       this.clearGenerationState();
     } finally {
-      // Reset state
       this.isGenerating = false;
       this.currentGeneration = null;
       this.resetButtons();
     }
   }
 
+  displayPartialResult(text) {
+    const htmlContent = marked.parse(text);
+
+    if (this.resultContent) {
+      this.resultContent.innerHTML = htmlContent;
+    }
+    if (this.mobileResultContent) {
+      this.mobileResultContent.innerHTML = htmlContent;
+    }
+    if (window.mobileController && window.mobileController.syncResultContent) {
+      window.mobileController.syncResultContent(htmlContent);
+    }
+  }
+
   displayGenerationResults(data) {
     if (!data || !data.gemini_summary) {
       notifications.error('No summary data received');
@@ -247,8 +390,10 @@ export class GenerateController {
           return;
         }
 
-        // Show recovery dialog
-        if (state.status === 'processing' || state.status === 'starting') {
+        // A submitted job keeps running on the server: just follow it again
+        if (state.status === 'processing' && state.jobId) {
+          this.resumeGeneration(state);
+        } else if (state.status === 'processing' || state.status === 'starting') {
           this.showRecoveryDialog(state);
         } else if (state.status === 'completed' && state.result) {
           // Restore completed results
@@ -268,7 +413,7 @@ export class GenerateController {
     
     if (confirm(message)) {
       // Restart generation
-      this.startGeneration(state.bookName, state.chapters);
+      this.startGeneration(state.bookName, state.chapters, state.mode);
     } else {
       this.clearGenerationState();
     }
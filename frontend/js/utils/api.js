@@ -2,6 +2,9 @@
  * API utility functions for making HTTP requests
  */
 
+// the dedup probe hashes the whole file in memory: bigger books are just sent, the server hashes the stream
+const HASH_PROBE_MAX_BYTES = 64 * 1024 * 1024;
+
 class APIClient {
   constructor() {
     this.baseURL = '/api';
@@ -32,10 +35,10 @@ class APIClient {
   }
 
   /**
-   * Get library books
+   * Get library books (one page: options.limit, options.offset)
    */
-  async getLibraryBooks() {
-    return this.request('/library');
+  async getLibraryBooks(options = {}) {
+    return this.request(`/library${this.buildQuery(options)}`);
   }
 
   /**
@@ -48,10 +51,10 @@ class APIClient {
   }
 
   /**
-   * Get book chapters
+   * Get book chapters (one page: options.limit, options.offset)
    */
-  async getBookChapters(bookId) {
-    return this.request(`/book-chapters/${bookId}`);
+  async getBookChapters(bookId, options = {}) {
+    return this.request(`/book-chapters/${bookId}${this.buildQuery(options)}`);
   }
 
   /**
@@ -69,26 +72,105 @@ class APIClient {
   }
 
   /**
-   * Upload book
+   * Estimate tokens, requests, cost and latency of a generation (no model call)
    */
-  async uploadBook(formData) {
-    try {
-      const response = await fetch(`${this.baseURL}/upload-book`, {
-        method: 'POST',
-        body: formData // Don't set Content-Type for FormData
-      });
+  async estimateGeneration(bookId, chapters, mode, strategy = 'single') {
+    return this.request('/generation-estimate', {
+      method: 'POST',
+      body: JSON.stringify({
+        bookname: bookId,
+        selectedChapters: chapters,
+        mode: mode,
+        strategy: strategy
+      })
+    });
+  }
 
-      if (!response.ok) {
-        throw new Error(`Upload failed with status: ${response.status}`);
-      }
+  /**
+   * Submit a generation job (returns { jobId } right away)
+   */
+  async submitGenerationJob(bookId, chapters, mode, strategy = 'single') {
+    return this.request('/generation-jobs', {
+      method: 'POST',
+      body: JSON.stringify({
+        bookname: bookId,
+        selectedChapters: chapters,
+        mode: mode,
+        strategy: strategy
+      })
+    });
+  }
 
-      return await response.json();
+  /**
+   * Get status and partial output of a generation job
+   */
+  async getGenerationJob(jobId) {
+    return this.request(`/generation-jobs/${jobId}`);
+  }
+
+  /**
+   * Server-Sent Events stream of a generation job (status, chunk, done, error)
+   */
+  openGenerationJobEvents(jobId) {
+    return new EventSource(`${this.baseURL}/generation-jobs/${jobId}/events`);
+  }
+
+  /**
+   * Get the result of a finished generation job
+   */
+  async getGenerationJobResult(jobId) {
+    return this.request(`/generation-jobs/${jobId}/result`);
+  }
+
+  /**
+   * Upload book: probe by content hash first, send the file only if the server does not have it
+   */
+  async uploadBook(file, title, author) {
+    try {
+      const sha256 = await this.hashFile(file);
+      if (sha256) {
+        const probe = new FormData();
+        probe.append('title', title);
+        probe.append('author', author);
+        probe.append('sha256', sha256);
+        const known = await this.postUpload({ method: 'POST', body: probe });
+        if (!known.needsFile) {
+          return known;
+        }
+      }
+      // raw body: the server hashes and stores it while it streams in. The type comes from the
+      // extension: browsers report an empty or non-standard MIME type for some PDFs/EPUBs
+      const ext = file.name.toLowerCase().endsWith('.pdf') ? '.pdf' : '.epub';
+      return await this.postUpload({
+        method: 'PUT',
+        headers: { 'Content-Type': 'application/octet-stream' },
+        body: file
+      }, { title, author, ext });
     } catch (error) {
       console.error('Upload failed:', error);
       throw error;
     }
   }
 
+  async postUpload(options, params = {}) {
+    const response = await fetch(`${this.baseURL}/upload-book${this.buildQuery(params)}`, options);
+    if (!response.ok) {
+      throw new Error(`Upload failed with status: ${response.status}`);
+    }
+    return await response.json();
+  }
+
+  /**
+   * sha256 of a file as hex, or null where SubtleCrypto is unavailable (plain http) or the file is too big to hash in memory
+   */
+  async hashFile(file) {
+    if (!window.crypto?.subtle || file.size > HASH_PROBE_MAX_BYTES) {
+      return null;
+    }
+    const digest = await window.crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return Array.from(new Uint8Array(digest), b => b.toString(16).padStart(2, '0')).join('');
+  }
+
   /**
    * Book elaboration
    */
@@ -100,12 +182,12 @@ class APIClient {
   }
 
   /**
-   * Analyze chapter
+   * Analyze chapter (strategy: 'auto' uses the PDF outline when there is one, 'font-scan' the reference page)
    */
-  async analyzeChapter(bookname, pageNumber) {
+  async analyzeChapter(bookname, pageNumber, strategy = 'auto') {
     return this.request('/analyze-chapter', {
       method: 'POST',
-      body: JSON.stringify({ bookname, pageNumber })
+      body: JSON.stringify({ bookname, pageNumber, strategy })
     });
   }
 
@@ -121,9 +203,24 @@ class APIClient {
 
   /**
    * Get page image
+   * options: { size: 'thumb'|'medium'|'full', width, format: 'png'|'jpeg'|'webp', quality }
    */
-  getPageImageURL(bookname, pageNumber) {
-    return `/api/book-image/${bookname}/${pageNumber}`;
+  getPageImageURL(bookname, pageNumber, options = {}) {
+    const query = this.buildQuery(options);
+    return `/api/book-image/${bookname}/${pageNumber}${query}`;
+  }
+
+  /**
+   * Get a thumbnail sprite covering pages start..end (layout in X-Sprite-* headers)
+   */
+  getThumbnailSpriteURL(bookname, start, end, options = {}) {
+    const query = this.buildQuery({ start, end, ...options });
+    return `/api/book-thumbnails/${bookname}${query}`;
+  }
+
+  buildQuery(params) {
+    const entries = Object.entries(params).filter(([, value]) => value !== undefined && value !== null);
+    return entries.length ? `?${new URLSearchParams(entries).toString()}` : '';
   }
 }
 
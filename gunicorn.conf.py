@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+
+#This file provide the production server settings (the dev server is python app.py):
+#
+# python -m gunicorn -c gunicorn.conf.py wsgi:app
+#
+# Workers are preloaded and forked, and each has a few threads: requests mostly wait on MuPDF
+# (which releases the GIL) or on Gemini. After max_requests (+ jitter, so they don't all restart
+# together) a worker finishes its requests and is replaced; jobs it was running are requeued by
+# the job queue of the other workers, which every worker starts right after the fork.
+
+bind = os.environ.get("BIND", f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get("WEB_CONCURRENCY", min(4, os.cpu_count() or 1)))
+worker_class = "gthread"
+threads = int(os.environ.get("WEB_THREADS", 8))
+preload_app = True
+max_requests = int(os.environ.get("WEB_MAX_REQUESTS", 1000))
+max_requests_jitter = max_requests // 10
+timeout = 120  # gthread: a worker silent that long is killed; long SSE streams don't count
+graceful_timeout = 60
+keepalive = 5
+accesslog = None  # every request is already logged as a JSON line (logic/metrics.py)
+
+# /metrics merges the values every worker writes here (logic/metrics.py); set before the app is loaded
+os.environ.setdefault("ARB_METRICS_DIR", os.path.join(tempfile.gettempdir(), f"arb-metrics-{os.getpid()}"))
+
+
+def on_starting(server):
+    # totals start from zero with the server, like the counters of a single process
+    shutil.rmtree(os.environ["ARB_METRICS_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["ARB_METRICS_DIR"])
+
+
+def post_fork(server, worker):
+    from wsgi import reset_after_fork
+    from logic.generation_jobs import get_job_queue
+    from logic.metrics import start_multiprocess
+    reset_after_fork()
+    start_multiprocess()
+    get_job_queue()  # recovers orphaned jobs now and periodically, not on the first job request
+
+
+def child_exit(server, worker):
+    from logic.metrics import archive_process
+    archive_process(worker.pid)
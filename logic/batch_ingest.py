@@ -0,0 +1,227 @@
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import fitz
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic import span_index
+from logic.blob_store import store_stream, alias_book, alias_of
+from logic.catalog import get_catalog
+from logic.chapterlistcreator import extract_chapters, outline_chapters, guess_reference_page
+from logic.epub_book import book_source_path, is_epub
+from logic.pdf_splitter import split_pdf_into_chapters
+from logic.search_index import get_search_index
+
+#This file provide the headless ingestion of a whole directory of books (a course reading list):
+# 1. every PDF/EPUB is stored and aliased like an upload (in this process, which picks the free
+#    names), then detected and split in a process pool, one book per worker
+# 2. chapters come from the outline/EPUB navigation, else from a font scan whose reference page is
+#    guessed from the span index (the biggest recurring heading)
+# 3. a manifest records every finished book, so an interrupted run resumes where it stopped
+#
+# python logic/batch_ingest.py <directory> [--workers 4] [--manifest path] [--retry-failed]
+
+INGEST_WORKERS = int(os.environ.get("INGEST_WORKERS", os.cpu_count() or 1))
+MANIFEST_NAME = "ingest_manifest.json"
+BOOK_TYPES = {".pdf", ".epub"}
+DONE, ERROR = "done", "error"
+
+
+def book_name(title):
+    # same rule as /api/upload-book
+    return re.sub(r"[^a-z0-9_]", "", title.lower().replace(" ", "_"))
+
+
+def find_books(directory, recursive=False):
+    pattern = "**/*" if recursive else "*"
+    return sorted(p for p in Path(directory).glob(pattern) if p.is_file() and p.suffix.lower() in BOOK_TYPES)
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"books": {}}
+
+
+def save_manifest(path, manifest):
+    manifest["updated"] = time.time()
+    tmp = Path(path).with_name(Path(path).name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def pending(books, manifest, directory, retry_failed=False):
+    """Books not finished in an earlier run (or changed on disk since)."""
+    todo = []
+    for path in books:
+        entry = manifest["books"].get(str(path.relative_to(directory)))
+        if entry and entry["source"] == _stamp(path) and (entry["status"] == DONE or not retry_failed):
+            continue
+        todo.append(path)
+    return todo
+
+
+def store_book(path, taken):
+    """Store and alias path like an upload; returns (bookname, sha256, book whose chapters were reused)."""
+    title = path.stem.replace("_", " ").strip()
+    ext = path.suffix.lower()
+    with open(path, "rb") as f:
+        sha256, _, _ = store_stream(f, ext)
+    base = book_name(title) or "book"
+    bookname, n = base, 1
+    # a different book already under this name keeps it
+    while bookname in taken or (alias_of(bookname) or {}).get("sha256", sha256) != sha256:
+        n += 1
+        bookname = f"{base}_{n}"
+    taken.add(bookname)
+    reused_from = alias_book(bookname, sha256, ext, title)
+    if reused_from:
+        get_catalog().copy_book(reused_from, bookname, title)
+        get_search_index().index_book(bookname)
+    return bookname, sha256, reused_from
+
+
+def _init_worker():
+    # parallelism is across books: no nested pool for the span scan inside a worker
+    span_index.SCAN_WORKERS = 1
+
+
+def detect_chapters(bookname):
+    """extract_chapters() with the reference page picked automatically; also returns the page count."""
+    source = book_source_path(bookname)
+    if is_epub(source):
+        result = extract_chapters(bookname, None)
+        return result, max((c["endPage"] for c in result.get("chapters", [])), default=0)
+    doc = fitz.open(str(source))
+    try:
+        reference_page = None
+        if outline_chapters(doc) is None:
+            reference_page = guess_reference_page(span_index.get_span_index(source, doc))
+            if reference_page is None:
+                return {"status": "error", "message": "No outline and no recurring heading: pick the reference page by hand"}, len(doc)
+        return extract_chapters(bookname, reference_page, doc=doc), len(doc)
+    finally:
+        doc.close()
+
+
+def ingest_book(bookname):
+    """Worker side: detect the chapters of an aliased book and split it."""
+    start = time.perf_counter()
+    try:
+        detected, pages = detect_chapters(bookname)
+        if detected["status"] != "success":
+            return {"status": ERROR, "bookname": bookname, "pages": pages, "message": detected["message"]}
+        split = split_pdf_into_chapters(bookname, detected, workers=1)
+        if split["status"] != "success":
+            return {"status": ERROR, "bookname": bookname, "pages": pages, "message": split["message"]}
+        return {
+            "status": DONE,
+            "bookname": bookname,
+            "pages": pages,
+            "strategy": detected["strategy"],
+            "referencePage": detected.get("referencePage"),
+            "chapters": split["totalChapters"],
+            "virtual": split["virtual"],
+            "seconds": round(time.perf_counter() - start, 3),
+        }
+    except Exception as e:
+        return {"status": ERROR, "bookname": bookname, "message": str(e)}
+
+
+def ingest_directory(directory, workers=INGEST_WORKERS, manifest_path=None, retry_failed=False, recursive=False,
+                     progress=None):
+    directory = Path(directory)
+    manifest_path = Path(manifest_path) if manifest_path else directory / MANIFEST_NAME
+    manifest = load_manifest(manifest_path)
+    books = find_books(directory, recursive)
+    todo = pending(books, manifest, directory, retry_failed)
+    taken = {e["bookname"] for k, e in manifest["books"].items() if e.get("bookname")}
+    counts = {DONE: 0, ERROR: 0}
+    pages = 0
+    start = time.perf_counter()
+
+    def record(path, entry):
+        nonlocal pages
+        key = str(path.relative_to(directory))
+        manifest["books"][key] = {**entry, "source": _stamp(path), "finished": time.time()}
+        save_manifest(manifest_path, manifest)  # after every book: a crash loses at most the ones in flight
+        counts[entry["status"]] += 1
+        pages += entry.get("pages") or 0
+        if progress:
+            progress(key, entry, counts[DONE] + counts[ERROR], len(todo))
+
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context, initializer=_init_worker) as pool:
+        futures = {}
+        for path in todo:
+            # the previous entry's name, so a resumed book doesn't get a _2 suffix
+            previous = manifest["books"].get(str(path.relative_to(directory)), {}).get("bookname")
+            taken.discard(previous)
+            try:
+                bookname, sha256, reused_from = store_book(path, taken)
+            except Exception as e:
+                record(path, {"status": ERROR, "message": str(e)})
+                continue
+            if reused_from:
+                record(path, {"status": DONE, "bookname": bookname, "sha256": sha256, "reusedFrom": reused_from,
+                              "chapters": get_catalog().chapters(bookname)[1]})
+                continue
+            futures[pool.submit(ingest_book, bookname)] = (path, sha256)
+        for future in as_completed(futures):
+            path, sha256 = futures[future]
+            record(path, {**future.result(), "sha256": sha256})
+
+    elapsed = time.perf_counter() - start
+    return {
+        "status": "success",
+        "directory": str(directory),
+        "manifest": str(manifest_path),
+        "books": len(books),
+        "skipped": len(books) - len(todo),
+        "ingested": counts[DONE],
+        "failed": counts[ERROR],
+        "pages": pages,
+        "seconds": round(elapsed, 2),
+        "booksPerMinute": round((counts[DONE] + counts[ERROR]) / elapsed * 60, 2) if elapsed and todo else None,
+        "pagesPerSecond": round(pages / elapsed, 1) if elapsed and todo else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest every PDF/EPUB of a directory: chapters detected and split")
+    parser.add_argument("directory")
+    parser.add_argument("--workers", type=int, default=INGEST_WORKERS)
+    parser.add_argument("--manifest", help=f"default: <directory>/{MANIFEST_NAME}")
+    parser.add_argument("--retry-failed", action="store_true", help="try again the books that failed last time")
+    parser.add_argument("--recursive", action="store_true")
+    args = parser.parse_args()
+    if not Path(args.directory).is_dir():
+        print(json.dumps({"status": "error", "message": f"Not a directory: {args.directory}"}))
+        sys.exit(1)
+
+    def progress(key, entry, n, total):
+        detail = f"{entry.get('chapters')} chapters" if entry["status"] == DONE else entry.get("message")
+        print(f"[{n}/{total}] {key}: {entry['status']} ({detail})", file=sys.stderr, flush=True)
+
+    result = ingest_directory(args.directory, args.workers, args.manifest, args.retry_failed, args.recursive, progress)
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    sys.exit(0 if result["failed"] == 0 else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+
+try:
+    import fcntl  # POSIX only: elsewhere the registry is locked within a process
+except ImportError:
+    fcntl = None
+
+#This file provide the content-addressed store of uploaded books:
+# 1. uploads are streamed to disk in chunks while hashing (sha256), stored once in bookstore/blobs
+# 2. every title is an alias: bookstore/booktemp/<bookname>.pdf is a hard link to the blob
+# 3. artifacts derived from the content (span index, previews) are keyed by the blob, so
+#    the same book uploaded under another title reuses them
+# 4. aliases.json is shared by the server workers and batch ingestion: every change is a
+#    read-modify-write under a file lock (aliases.lock)
+
+BLOB_ROOT = Path("bookstore") / "blobs"
+ALIASES_FILE = BLOB_ROOT / "aliases.json"
+ALIASES_LOCK = BLOB_ROOT / "aliases.lock"
+CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_aliases_cache = {"stamp": None, "aliases": {}}
+
+
+def blob_path(sha256, ext):
+    return BLOB_ROOT / sha256[:2] / f"{sha256}{ext}"
+
+
+def _load_aliases():
+    # read again only when the registry changed: content_key() runs on every preview lookup
+    try:
+        st = os.stat(ALIASES_FILE)
+    except FileNotFoundError:
+        return {}
+    stamp = (st.st_ino, st.st_size, st.st_mtime_ns)
+    if _aliases_cache["stamp"] != stamp:
+        with open(ALIASES_FILE, encoding="utf-8") as f:
+            _aliases_cache["aliases"] = json.load(f)
+        _aliases_cache["stamp"] = stamp
+    return dict(_aliases_cache["aliases"])
+
+
+def _save_aliases(aliases):
+    ALIASES_FILE.parent.mkdir(parents=True, exist_ok=True)
+    tmp = ALIASES_FILE.with_name(ALIASES_FILE.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(aliases, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, ALIASES_FILE)
+
+
+@contextmanager
+def _registry_lock():
+    """Exclusive access to the alias registry for this thread and against other processes."""
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+        ALIASES_LOCK.parent.mkdir(parents=True, exist_ok=True)
+        with open(ALIASES_LOCK, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def store_stream(stream, ext):
+    """Copy stream into the blob store; returns (sha256, path, already_known)."""
+    BLOB_ROOT.mkdir(parents=True, exist_ok=True)
+    digest = hashlib.sha256()
+    fd, tmp_name = tempfile.mkstemp(dir=BLOB_ROOT, suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+                digest.update(chunk)
+                out.write(chunk)
+        sha256 = digest.hexdigest()
+        target = blob_path(sha256, ext)
+        with _lock:
+            if target.exists():
+                os.unlink(tmp_name)
+                return sha256, target, True
+            target.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_name, target)
+        return sha256, target, False
+    except BaseException:
+        if os.path.exists(tmp_name):
+            os.unlink(tmp_name)
+        raise
+
+
+def find_blob(sha256):
+    """(path, ext) of a stored blob, or (None, None)."""
+    for ext in (".pdf", ".epub"):
+        path = blob_path(sha256, ext)
+        if path.exists():
+            return path, ext
+    return None, None
+
+
+def alias_book(bookname, sha256, ext, title=None, author=None):
+    """Alias bookname to the blob and hard-link the chapters already split for the same content.
+
+    Returns the name of the book whose chapters were reused, or None."""
+    siblings = link_alias(bookname, sha256, ext, title, author)
+    target = Path("bookstore") / "elaboratebook" / bookname
+    for sibling in siblings:
+        source = Path("bookstore") / "elaboratebook" / sibling
+        if not source.is_dir() or not any(source.iterdir()):
+            continue
+        if target.exists():
+            shutil.rmtree(target)
+        target.mkdir(parents=True)
+        for f in source.iterdir():
+            if f.is_file():
+                _link(f, target / f.name)
+        return sibling
+    return None
+
+
+def _link(source, target):
+    target.parent.mkdir(parents=True, exist_ok=True)
+    if target.exists() or target.is_symlink():
+        target.unlink()
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)  # filesystems without hard links (keeps mtime for the sidecars)
+
+
+def link_alias(bookname, sha256, ext, title=None, author=None):
+    """Point bookname at the blob; returns the other aliases that already share its content."""
+    _link(blob_path(sha256, ext), Path("bookstore") / "booktemp" / f"{bookname}{ext}")
+    with _registry_lock():
+        aliases = _load_aliases()
+        siblings = [name for name, a in aliases.items() if a["sha256"] == sha256 and name != bookname]
+        aliases[bookname] = {
+            "sha256": sha256,
+            "ext": ext,
+            "title": title,
+            "author": author,
+            "created": time.time(),
+        }
+        _save_aliases(aliases)
+    return siblings
+
+
+def alias_of(bookname):
+    with _lock:
+        return _load_aliases().get(bookname)
+
+
+def content_key(bookname):
+    """Key for artifacts derived from the book content: the blob hash, or the name for legacy books."""
+    alias = alias_of(bookname)
+    return alias["sha256"] if alias else bookname
+
+
+def artifact_path(source_path, suffix):
+    """Where an artifact of source_path lives: next to its blob when it is an alias, else next to it."""
+    source_path = Path(source_path)
+    alias = alias_of(source_path.stem) if source_path.parent == Path("bookstore") / "booktemp" else None
+    if alias and alias["ext"] == source_path.suffix:
+        return blob_path(alias["sha256"], suffix)
+    return source_path.with_suffix(suffix)
+
+
+def release_alias(bookname):
+    """Forget bookname; the blob and its artifacts go when no alias uses them anymore."""
+    with _registry_lock():
+        aliases = _load_aliases()
+        alias = aliases.pop(bookname, None)
+        if alias is None:
+            return False
+        _save_aliases(aliases)
+        if any(a["sha256"] == alias["sha256"] for a in aliases.values()):
+            return False
+    blob = blob_path(alias["sha256"], alias["ext"])
+    for artifact in blob.parent.glob(f"{alias['sha256']}.*"):
+        artifact.unlink(missing_ok=True)
+    return True
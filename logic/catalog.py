@@ -0,0 +1,317 @@
+import os
+import re
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+from pathlib import Path
+
+import fitz
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic.text_store import open_sidecar
+
+#This file provide the library catalog (bookstore/catalog.sqlite): books and their chapters
+#with page ranges, sizes and hashes. The splitter and delete_book keep it up to date, the
+#listing endpoints answer from it instead of scanning bookstore/elaboratebook.
+#Virtual chapters are only a page range of the source book: they have no file, the splitter
+#lists them in the book's chapters.json so a rebuild can find them again.
+#
+# rebuild from disk: python logic/catalog.py --rebuild
+
+CATALOG_DB = Path("bookstore") / "catalog.sqlite"
+BOOKS_DIR = Path("bookstore") / "elaboratebook"
+CHAPTER_FILE = re.compile(r"cap(\d+)\[(.+)\]\.pdf$")
+MANIFEST_FILE = "chapters.json"
+
+
+def chapter_title(filename):
+    """Display title of a chapter file: cap3[La_fine].pdf -> 'La fine'."""
+    match = CHAPTER_FILE.match(filename)
+    return match.group(2).replace("_", " ") if match else None
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def read_manifest(book_dir):
+    path = Path(book_dir) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_manifest(book_dir, manifest):
+    path = Path(book_dir) / MANIFEST_FILE
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def _page_count(path):
+    sidecar = open_sidecar(path)
+    if sidecar is not None:
+        with sidecar:
+            return sidecar.page_count
+    with fitz.open(path) as doc:
+        return len(doc)
+
+
+class Catalog:
+    def __init__(self, db_path=CATALOG_DB, books_dir=BOOKS_DIR):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.books_dir = Path(books_dir)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS books (
+                    name TEXT PRIMARY KEY,
+                    title TEXT,
+                    author TEXT,
+                    sha256 TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS chapters (
+                    book TEXT NOT NULL REFERENCES books(name) ON DELETE CASCADE,
+                    number INTEGER NOT NULL,
+                    title TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    start_page INTEGER,
+                    end_page INTEGER,
+                    page_count INTEGER,
+                    size INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    virtual INTEGER NOT NULL DEFAULT 0,
+                    tokens INTEGER,
+                    PRIMARY KEY (book, number)
+                );
+                """
+            )
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(chapters)")}
+            if "virtual" not in columns:  # catalogs created before virtual chapters
+                conn.execute("ALTER TABLE chapters ADD COLUMN virtual INTEGER NOT NULL DEFAULT 0")
+            if "tokens" not in columns:  # catalogs created before token budgeting
+                conn.execute("ALTER TABLE chapters ADD COLUMN tokens INTEGER")
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    @staticmethod
+    def _rows(conn, query, params=()):
+        conn.row_factory = sqlite3.Row
+        return [dict(row) for row in conn.execute(query, params)]
+
+    # -- writes ---------------------------------------------------------------
+
+    def add_book(self, name, title=None, author=None, sha256=None, conn=None):
+        now = time.time()
+        query = (
+            "INSERT INTO books (name, title, author, sha256, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(name) DO UPDATE SET title = COALESCE(excluded.title, title), "
+            "author = COALESCE(excluded.author, author), sha256 = COALESCE(excluded.sha256, sha256), "
+            "updated_at = excluded.updated_at"
+        )
+        params = (name, title, author, sha256, now, now)
+        if conn is not None:
+            conn.execute(query, params)
+            return
+        with self._lock, self._connect() as conn:
+            conn.execute(query, params)
+
+    def add_chapters(self, book, chapters, **book_fields):
+        """Record chapters of book (dicts with chapterNumber, filename, path and optionally
+        startPage/endPage/pageCount/tokens), in one transaction; the book row is created if needed.
+        Virtual chapters (virtual: True) have no file and must come with their sha256."""
+        rows = []
+        for ch in chapters:
+            virtual = bool(ch.get("virtual"))
+            size = 0 if virtual else os.stat(ch["path"]).st_size
+            rows.append((
+                book,
+                ch["chapterNumber"],
+                chapter_title(ch["filename"]) or ch.get("title", ""),
+                ch["filename"],
+                ch.get("startPage"),
+                ch.get("endPage"),
+                ch.get("pageCount"),
+                size,
+                ch.get("sha256") or file_sha256(ch["path"]),
+                int(virtual),
+                ch.get("tokens"),
+            ))
+        with self._lock, self._connect() as conn:
+            self.add_book(book, conn=conn, **book_fields)
+            conn.executemany(
+                "INSERT OR REPLACE INTO chapters "
+                "(book, number, title, filename, start_page, end_page, page_count, size, sha256, virtual, tokens) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+        return len(rows)
+
+    def copy_book(self, source, name, title=None, author=None):
+        """Catalog name with the chapters of source (same content, files hard-linked)."""
+        with self._lock, self._connect() as conn:
+            self.add_book(name, title, author, conn=conn)
+            conn.execute("DELETE FROM chapters WHERE book = ?", (name,))
+            conn.execute(
+                "INSERT INTO chapters "
+                "(book, number, title, filename, start_page, end_page, page_count, size, sha256, virtual, tokens) "
+                "SELECT ?, number, title, filename, start_page, end_page, page_count, size, sha256, virtual, tokens "
+                "FROM chapters WHERE book = ?",
+                (name, source),
+            )
+
+    def remove_book(self, name):
+        with self._lock, self._connect() as conn:
+            return conn.execute("DELETE FROM books WHERE name = ?", (name,)).rowcount > 0
+
+    # -- reads ----------------------------------------------------------------
+
+    def books(self, limit=None, offset=0):
+        """(books, total), ordered by name."""
+        with self._connect() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM books").fetchone()[0]
+            rows = self._rows(
+                conn,
+                "SELECT b.*, (SELECT COUNT(*) FROM chapters c WHERE c.book = b.name) AS chapter_count "
+                "FROM books b ORDER BY b.name LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset),
+            )
+        return rows, total
+
+    def chapters(self, book, limit=None, offset=0):
+        with self._connect() as conn:
+            total = conn.execute("SELECT COUNT(*) FROM chapters WHERE book = ?", (book,)).fetchone()[0]
+            rows = self._rows(
+                conn,
+                "SELECT * FROM chapters WHERE book = ? ORDER BY number LIMIT ? OFFSET ?",
+                (book, -1 if limit is None else limit, offset),
+            )
+        return rows, total
+
+    def chapter(self, book, number):
+        with self._connect() as conn:
+            rows = self._rows(conn, "SELECT * FROM chapters WHERE book = ? AND number = ?", (book, number))
+        return rows[0] if rows else None
+
+    def prune_chapters(self, book, numbers):
+        """Forget the chapters of book whose number is not in numbers (after a re-split)."""
+        numbers = list(numbers)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"DELETE FROM chapters WHERE book = ? AND number NOT IN ({', '.join('?' * len(numbers))})",
+                (book, *numbers),
+            )
+
+    def set_tokens(self, book, number, tokens):
+        with self._lock, self._connect() as conn:
+            conn.execute("UPDATE chapters SET tokens = ? WHERE book = ? AND number = ?", (tokens, book, number))
+
+    def chapter_by_filename(self, book, filename):
+        match = CHAPTER_FILE.match(filename)
+        row = self.chapter(book, int(match.group(1))) if match else None
+        return row if row and row["filename"] == filename else None
+
+    def has_book(self, name):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM books WHERE name = ?", (name,)).fetchone() is not None
+
+    def is_empty(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT 1 FROM books LIMIT 1").fetchone() is None
+
+    # -- recovery -------------------------------------------------------------
+
+    def scan_book(self, name):
+        """Catalog the chapters found on disk for one book: the virtual ones and the page ranges
+        come from its chapters.json, files without a manifest entry get no page range."""
+        book_dir = self.books_dir / name
+        manifest = read_manifest(book_dir) or {}
+        listed = {ch["filename"]: ch for ch in manifest.get("chapters", [])}
+        chapters = [ch for ch in listed.values() if ch.get("virtual") and not (book_dir / ch["filename"]).exists()]
+        for ch in chapters:
+            ch["path"] = str(book_dir / ch["filename"])
+        for pdf_file in sorted(book_dir.glob("cap*.pdf")):
+            match = CHAPTER_FILE.match(pdf_file.name)
+            if match:
+                entry = listed.get(pdf_file.name, {})
+                chapters.append({
+                    "chapterNumber": int(match.group(1)),
+                    "filename": pdf_file.name,
+                    "path": str(pdf_file),
+                    "startPage": entry.get("startPage"),
+                    "endPage": entry.get("endPage"),
+                    "pageCount": _page_count(pdf_file),
+                    "tokens": entry.get("tokens"),
+                })
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM chapters WHERE book = ?", (name,))
+        return self.add_chapters(name, chapters)
+
+    def ensure_book(self, name):
+        """True if name is catalogued, scanning its directory first when only the disk knows it."""
+        if self.has_book(name):
+            return True
+        if (self.books_dir / name).is_dir():
+            self.scan_book(name)
+            return True
+        return False
+
+    def rebuild(self):
+        """Drop the catalog and recover it from bookstore/elaboratebook."""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM chapters")
+            conn.execute("DELETE FROM books")
+        counts = {"books": 0, "chapters": 0}
+        if self.books_dir.exists():
+            for item in sorted(self.books_dir.iterdir()):
+                if item.is_dir():
+                    counts["chapters"] += self.scan_book(item.name)
+                    counts["books"] += 1
+        return counts
+
+
+_catalog = None
+_catalog_lock = threading.Lock()
+
+
+def get_catalog():
+    global _catalog
+    with _catalog_lock:
+        if _catalog is None:
+            _catalog = Catalog()
+            if _catalog.is_empty() and _catalog.books_dir.exists() and any(_catalog.books_dir.iterdir()):
+                _catalog.rebuild()  # first start with books split before the catalog existed
+        return _catalog
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Library catalog maintenance")
+    parser.add_argument("--rebuild", action="store_true", help="recover the catalog from bookstore/elaboratebook")
+    args = parser.parse_args()
+    catalog = Catalog()
+    if args.rebuild:
+        print(json.dumps({"status": "success", **catalog.rebuild()}))
+    else:
+        books, total = catalog.books()
+        print(json.dumps({"status": "success", "books": total, "names": [b["name"] for b in books]}))
+
+
+if __name__ == "__main__":
+    main()
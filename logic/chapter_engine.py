@@ -0,0 +1,186 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import fitz
+
+from logic.chapterlistcreator import book_pdf_path, extract_chapters, extract_epub_chapters
+from logic.epub_book import book_source_path, is_epub
+from logic.span_index import get_span_index
+from logic.metrics import stage, run_in_context
+
+#This file keeps chapter detection inside the Flask process:
+# 1. DocumentPool keeps the last opened fitz.Document of every book
+# 2. ChapterEngine runs extract_chapters (and span index builds) on a small worker pool
+
+DEFAULT_WORKERS = int(os.environ.get("CHAPTER_ENGINE_WORKERS", min(4, os.cpu_count() or 1)))
+DEFAULT_MAX_OPEN = int(os.environ.get("CHAPTER_ENGINE_MAX_OPEN", 8))
+
+
+class _PooledDocument:
+    def __init__(self, doc, stamp):
+        self.doc = doc
+        self.stamp = stamp
+        self.lock = threading.Lock()  # fitz documents are not thread safe
+        self.users = 0
+        self.evicted = False
+
+
+class DocumentPool:
+    """LRU of open documents keyed by path, reopened when the file changes on disk."""
+
+    def __init__(self, max_open=DEFAULT_MAX_OPEN):
+        self.max_open = max(1, max_open)
+        self._entries = OrderedDict()
+        self._opening = {}  # path -> Event set when the thread opening it is done
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return st.st_size, st.st_mtime_ns
+
+    @contextmanager
+    def borrow(self, path):
+        key = str(path)
+        stamp = self._stamp(key)
+        entry = None
+        while entry is None:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None and entry.stamp != stamp:
+                    self._evict(key)
+                    entry = None
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    entry.users += 1
+                    break
+                opening = self._opening.get(key)
+                owner = opening is None
+                if owner:
+                    opening = self._opening[key] = threading.Event()
+            if not owner:
+                opening.wait()  # the same book opened by another thread: use its handle
+                continue
+            # opened outside the lock: borrowers of the other books don't wait for a big one
+            try:
+                with stage("fitz_open", file=os.path.basename(key)):
+                    doc = fitz.open(key)
+                with self._lock:
+                    entry = self._entries[key] = _PooledDocument(doc, stamp)
+                    entry.users += 1
+                    while len(self._entries) > self.max_open:
+                        self._evict(next(iter(self._entries)))
+            finally:
+                with self._lock:
+                    self._opening.pop(key, None)
+                opening.set()
+        try:
+            with entry.lock:
+                yield entry.doc
+        finally:
+            with self._lock:
+                entry.users -= 1
+                if entry.evicted and entry.users == 0:
+                    entry.doc.close()
+
+    def _evict(self, key):
+        entry = self._entries.pop(key)
+        entry.evicted = True
+        if entry.users == 0:
+            entry.doc.close()
+
+    def discard(self, path):
+        with self._lock:
+            if str(path) in self._entries:
+                self._evict(str(path))
+
+    def size(self):
+        with self._lock:
+            return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self._entries):
+                self._evict(key)
+
+
+class ChapterEngine:
+    def __init__(self, workers=DEFAULT_WORKERS, max_open=DEFAULT_MAX_OPEN):
+        self.documents = DocumentPool(max_open)
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="chapters")
+        self._waiting = 0  # submitted, not started yet
+        self._waiting_lock = threading.Lock()
+
+    def _submit(self, fn, *args):
+        def started(*args):
+            with self._waiting_lock:
+                self._waiting -= 1
+            return fn(*args)
+
+        with self._waiting_lock:
+            self._waiting += 1
+        future = self.executor.submit(run_in_context(started), *args)
+        future.add_done_callback(self._forget_cancelled)
+        return future
+
+    def _forget_cancelled(self, future):
+        if future.cancelled():  # never started, so started() did not count it down
+            with self._waiting_lock:
+                self._waiting -= 1
+
+    def extract(self, bookname, reference_page, strategy="auto"):
+        with stage("chapter_detect", book=bookname) as fields:
+            result = self._extract(bookname, reference_page, strategy)
+            fields.update(strategy=result.get("strategy"), chapters=result.get("totalChapters"))
+            return result
+
+    def _extract(self, bookname, reference_page, strategy):
+        source = book_source_path(bookname)
+        if is_epub(source):
+            return extract_epub_chapters(bookname, source, reference_page)
+        pdf_path = book_pdf_path(bookname)
+        if not pdf_path.exists():
+            return {
+                "status": "error",
+                "message": f"PDF not found: {pdf_path}",
+                "bookname": bookname,
+                "referencePage": reference_page,
+            }
+        with self.documents.borrow(pdf_path) as doc:
+            return extract_chapters(bookname, reference_page, doc=doc, strategy=strategy)
+
+    def submit(self, bookname, reference_page, strategy="auto"):
+        return self._submit(self.extract, bookname, reference_page, strategy)
+
+    def build_index(self, bookname):
+        # its own fitz handle, not the pooled one: previews of the book don't wait for the scan
+        get_span_index(book_pdf_path(bookname))
+
+    def submit_index(self, bookname):
+        return self._submit(self.build_index, bookname)
+
+    def queue_depth(self):
+        with self._waiting_lock:
+            return self._waiting
+
+    def run(self, bookname, reference_page, timeout=None, strategy="auto"):
+        return self.submit(bookname, reference_page, strategy).result(timeout=timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+        self.documents.clear()
+
+
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = ChapterEngine()
+        return _engine
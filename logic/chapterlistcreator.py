@@ -4,7 +4,16 @@ import fitz
 from pathlib import Path
 from collections import Counter
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic.span_index import get_span_index
+from logic.epub_book import book_source_path, is_epub, open_epub
+
 #This file provide most sensible pasrt of the logic, here there is the identification of the chapters
+#Strategies, in order: the PDF outline (bookmarks) when it is usable, else the font scan from a
+#reference page; EPUB books always use their table of contents.
+
+STRATEGIES = ("auto", "outline", "font-scan")
+MIN_OUTLINE_CHAPTERS = 2
 
 def find_max_font(page):
     content = page.get_text("dict")
@@ -23,8 +32,10 @@ def find_max_font(page):
     return common_font, max_size
 
 
-def find_chapter_pages(pdf_path, target_font, target_size):
-    doc = fitz.open(pdf_path)
+def find_chapter_pages(source, target_font, target_size):
+    # source can be a path or an already open fitz.Document (the engine pools them)
+    own_doc = not isinstance(source, fitz.Document)
+    doc = fitz.open(source) if own_doc else source
     found_pages, found_titles = [], []
     for i in range(len(doc)):
         page = doc.load_page(i)
@@ -42,25 +53,119 @@ def find_chapter_pages(pdf_path, target_font, target_size):
             else:
                 continue
             break
-    doc.close()
+    if own_doc:
+        doc.close()
     return found_pages, found_titles
 
 
-def extract_chapters(bookname, reference_page):
+def outline_chapters(doc):
+    """Chapters from the PDF bookmarks: the shallowest outline level with at least two entries
+    pointing inside the document, or None when there is no usable outline."""
+    toc = doc.get_toc(simple=True)
+    for level in sorted({entry[0] for entry in toc}):
+        starts = {}
+        for lvl, title, page in toc:
+            if lvl == level and 1 <= page <= len(doc) and title.strip():
+                starts.setdefault(page, " ".join(title.split()))
+        if len(starts) < MIN_OUTLINE_CHAPTERS:
+            continue  # e.g. a single bookmark with the book title: look one level down
+        pages = sorted(starts)
+        chapters = []
+        for i, page in enumerate(pages):
+            end_page = pages[i + 1] - 1 if i + 1 < len(pages) else len(doc)
+            chapters.append(
+                {
+                    "chapterNumber": i + 1,
+                    "title": starts[page],
+                    "startPage": page,
+                    "endPage": end_page,
+                    "pageCount": end_page - page + 1,
+                }
+            )
+        return chapters
+    return None
+
+
+def guess_reference_page(index):
+    """Reference page for the font scan without asking: the first page headed by the largest
+    (font, size) that is bigger than the body text and heads at least MIN_OUTLINE_CHAPTERS pages.
+    None when no such heading exists."""
+    totals = {}
+    for size, count in zip(index.sizes, index.counts):
+        totals[size] = totals.get(size, 0) + count
+    if not totals:
+        return None
+    body_size = max(totals, key=totals.get)
+    headed = {}
+    for page in range(1, index.page_count + 1):
+        font, size = index.max_font(page)
+        if font and size > body_size:
+            headed.setdefault((font, size), []).append(page)
+    candidates = [(size, len(pages), pages[0]) for (_, size), pages in headed.items() if len(pages) >= MIN_OUTLINE_CHAPTERS]
+    # a one-off title page is bigger still, hence the minimum count; then the biggest heading wins
+    return max(candidates, key=lambda c: (c[0], c[1], -c[2]))[2] if candidates else None
+
+
+def book_pdf_path(bookname):
+    return Path("bookstore") / "booktemp" / f"{bookname}.pdf"
+
+
+def extract_epub_chapters(bookname, epub_path, reference_page=None):
+    """Chapters of an EPUB from its navigation: no reference page and no font scan needed."""
     try:
-        pdf_path = Path("bookstore") / "booktemp" / f"{bookname}.pdf"
-        if not pdf_path.exists():
-            raise FileNotFoundError(f"PDF not found: {pdf_path}")
+        chapters = open_epub(epub_path).chapters()
+        return {
+            "status": "success",
+            "bookname": bookname,
+            "referencePage": reference_page,
+            "strategy": "epub-toc",
+            "totalChapters": len(chapters),
+            "chapters": chapters,
+        }
+    except Exception as e:
+        return {"status": "error", "message": str(e), "bookname": bookname, "referencePage": reference_page}
+
+
+def extract_chapters(bookname, reference_page, doc=None, strategy="auto"):
+    source = book_source_path(bookname)
+    if doc is None and is_epub(source):
+        return extract_epub_chapters(bookname, source, reference_page)
+    own_doc = doc is None
+    try:
+        pdf_path = book_pdf_path(bookname)
+        if own_doc:
+            if not pdf_path.exists():
+                raise FileNotFoundError(f"PDF not found: {pdf_path}")
+            doc = fitz.open(str(pdf_path))
+
+        if strategy not in STRATEGIES:
+            raise ValueError(f"Unknown strategy '{strategy}' (use {', '.join(STRATEGIES)})")
+        if strategy != "font-scan":
+            chapters = outline_chapters(doc)
+            if chapters:
+                return {
+                    "status": "success",
+                    "bookname": bookname,
+                    "referencePage": reference_page,
+                    "strategy": "outline",
+                    "totalChapters": len(chapters),
+                    "chapters": chapters,
+                }
+            if strategy == "outline":
+                raise ValueError("This PDF has no usable outline")
 
-        doc = fitz.open(str(pdf_path))
+        if reference_page is None:
+            raise ValueError("Reference page required: this PDF has no usable outline")
         if reference_page < 1 or reference_page > len(doc):
             raise ValueError(f"Reference page {reference_page} out of range (1-{len(doc)})")
 
-        font_hugger, size_hugger = find_max_font(doc.load_page(reference_page - 1))
+        # the span index is built once per book (usually at upload) and answers both lookups
+        index = get_span_index(pdf_path, doc)
+        font_hugger, size_hugger = index.max_font(reference_page)
         if not font_hugger:
             raise ValueError("No valid font found on reference page")
 
-        chapter_pages, chapter_titles = find_chapter_pages(str(pdf_path), font_hugger, size_hugger)
+        chapter_pages, chapter_titles = index.chapter_pages(font_hugger, size_hugger)
 
         chapters = []
         for i, (page, title) in enumerate(zip(chapter_pages, chapter_titles)):
@@ -74,13 +179,13 @@ def extract_chapters(bookname, reference_page):
                     "pageCount": end_page - page + 1,
                 }
             )
-        doc.close()
         return {
             "status": "success",
             "bookname": bookname,
             "referencePage": reference_page,
             "detectedFont": font_hugger,
             "detectedSize": size_hugger,
+            "strategy": "font-scan",
             "totalChapters": len(chapters),
             "chapters": chapters,
         }
@@ -92,15 +197,18 @@ def extract_chapters(bookname, reference_page):
             "bookname": bookname,
             "referencePage": reference_page,
         }
+    finally:
+        if own_doc and doc is not None:
+            doc.close()
 
 
 def main():
-    if len(sys.argv) != 3:
+    if len(sys.argv) not in (2, 3):
         print(
             json.dumps(
                 {
                     "status": "error",
-                    "message": "Usage: python chapterlistcreator.py <bookname> <reference_page>",
+                    "message": "Usage: python chapterlistcreator.py <bookname> [reference_page]",
                 }
             )
         )
@@ -108,7 +216,7 @@ def main():
 
     bookname = sys.argv[1]
     try:
-        reference_page = int(sys.argv[2])
+        reference_page = int(sys.argv[2]) if len(sys.argv) == 3 else None
     except ValueError:
         print(json.dumps({"status": "error", "message": "Reference page must be an integer"}))
         sys.exit(1)
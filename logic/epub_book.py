@@ -0,0 +1,266 @@
+import io
+import re
+import zipfile
+import posixpath
+import threading
+from collections import OrderedDict
+from html.parser import HTMLParser
+from pathlib import Path
+from xml.etree import ElementTree
+
+import fitz
+
+#This file provide EPUB books without converting them to PDF first:
+# 1. chapters come from the navigation document (EPUB 3 nav or EPUB 2 toc.ncx) mapped on the spine
+# 2. a "page" of an EPUB is one spine item (section): what the preview, detection and splitting count
+# 3. text is read by streaming the zip members through an HTML parser, the archive is never unpacked
+# 4. sections are laid out (fitz.Story) only when a preview or a chapter PDF needs them
+
+PAGE_RECT = fitz.paper_rect("a5")
+PAGE_MARGIN = 36
+READ_CHUNK = 64 * 1024
+MAX_OPEN = 8
+
+NS = {
+    "container": "urn:oasis:names:tc:opendocument:xmlns:container",
+    "opf": "http://www.idpf.org/2007/opf",
+    "ncx": "http://www.daisy.org/z3986/2005/ncx/",
+    "xhtml": "http://www.w3.org/1999/xhtml",
+    "epub": "http://www.idpf.org/2007/ops",
+}
+BLOCK_TAGS = {"p", "div", "br", "li", "h1", "h2", "h3", "h4", "h5", "h6", "tr", "section", "blockquote", "pre"}
+LINK_ATTR = re.compile(r'(<(?:img|image|link)\b[^>]*?\b(?:src|href|xlink:href)=")([^"#:]+)(")', re.IGNORECASE)
+
+
+def book_source_path(bookname):
+    """The uploaded file of bookname: its PDF, else its EPUB, else None."""
+    for ext in (".pdf", ".epub"):
+        path = Path("bookstore") / "booktemp" / f"{bookname}{ext}"
+        if path.exists():
+            return path
+    return None
+
+
+def is_epub(path):
+    return path is not None and Path(path).suffix.lower() == ".epub"
+
+
+class _TextExtractor(HTMLParser):
+    """Visible text of an XHTML document, one line per block element."""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.parts = []
+        self._skip = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style", "head"):
+            self._skip += 1
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style", "head"):
+            self._skip = max(0, self._skip - 1)
+        elif tag in BLOCK_TAGS:
+            self.parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip:
+            self.parts.append(data)
+
+    def text(self):
+        lines = (" ".join(line.split()) for line in "".join(self.parts).splitlines())
+        return "\n".join(line for line in lines if line) + "\n"
+
+
+class EpubBook:
+    def __init__(self, path):
+        self.path = Path(path)
+        self._zip = zipfile.ZipFile(self.path)
+        self._lock = threading.Lock()  # one reader at a time on the zip handle
+        self._render_lock = threading.Lock()
+        self._archive = None
+        opf_path = self._rootfile()
+        self._base = posixpath.dirname(opf_path)
+        opf = ElementTree.fromstring(self._zip.read(opf_path))
+        manifest = {
+            item.get("id"): item
+            for item in opf.iterfind("opf:manifest/opf:item", NS)
+        }
+        self.spine = [
+            self._href(manifest[ref.get("idref")].get("href"))
+            for ref in opf.iterfind("opf:spine/opf:itemref", NS)
+            if ref.get("idref") in manifest and ref.get("linear", "yes") != "no"
+        ]
+        self.title = opf.findtext("opf:metadata/{http://purl.org/dc/elements/1.1/}title", default=None, namespaces=NS)
+        self._nav = next((self._href(i.get("href")) for i in manifest.values() if "nav" in (i.get("properties") or "").split()), None)
+        toc_id = opf.find("opf:spine", NS).get("toc") if opf.find("opf:spine", NS) is not None else None
+        self._ncx = self._href(manifest[toc_id].get("href")) if toc_id in manifest else None
+
+    def _rootfile(self):
+        container = ElementTree.fromstring(self._zip.read("META-INF/container.xml"))
+        rootfile = container.find(".//container:rootfile", NS)
+        if rootfile is None:
+            raise ValueError("EPUB without a rootfile in META-INF/container.xml")
+        return rootfile.get("full-path")
+
+    def _href(self, href):
+        return posixpath.normpath(posixpath.join(self._base, href.split("#")[0]))
+
+    def __len__(self):
+        return len(self.spine)
+
+    def close(self):
+        self._zip.close()
+
+    # -- navigation -----------------------------------------------------------
+
+    def toc(self):
+        """[(title, spine index)] of the top level navigation entries, in reading order."""
+        entries = self._nav_entries() if self._nav else []
+        if not entries and self._ncx:
+            entries = self._ncx_entries()
+        position = {href: k for k, href in enumerate(self.spine)}
+        seen, toc = set(), []
+        for title, href in entries:
+            k = position.get(href)
+            if k is not None and k not in seen:
+                seen.add(k)
+                toc.append((title, k))
+        return sorted(toc, key=lambda entry: entry[1])
+
+    def _nav_entries(self):
+        doc = ElementTree.fromstring(self._zip.read(self._nav))
+        base = posixpath.dirname(self._nav)
+        for nav in doc.iter(f"{{{NS['xhtml']}}}nav"):
+            if nav.get(f"{{{NS['epub']}}}type") == "toc":
+                ol = nav.find("xhtml:ol", NS)
+                if ol is None:
+                    return []
+                return [
+                    (" ".join("".join(a.itertext()).split()), posixpath.normpath(posixpath.join(base, a.get("href").split("#")[0])))
+                    for li in ol.findall("xhtml:li", NS)
+                    for a in li.findall("xhtml:a", NS)
+                    if a.get("href")
+                ]
+        return []
+
+    def _ncx_entries(self):
+        doc = ElementTree.fromstring(self._zip.read(self._ncx))
+        base = posixpath.dirname(self._ncx)
+        return [
+            (
+                " ".join((point.findtext("ncx:navLabel/ncx:text", default="", namespaces=NS)).split()),
+                posixpath.normpath(posixpath.join(base, point.find("ncx:content", NS).get("src").split("#")[0])),
+            )
+            for point in doc.findall("ncx:navMap/ncx:navPoint", NS)
+            if point.find("ncx:content", NS) is not None
+        ]
+
+    def chapters(self):
+        """Chapters as 1-based section ranges, in the format of the PDF chapter detection."""
+        toc = self.toc()
+        if not toc:
+            # no navigation: every section is a chapter, titled by its <title>
+            toc = [(self.section_title(k) or f"Section {k + 1}", k) for k in range(len(self.spine))]
+        chapters = []
+        for i, (title, start) in enumerate(toc):
+            end = toc[i + 1][1] - 1 if i + 1 < len(toc) else len(self.spine) - 1
+            chapters.append({
+                "chapterNumber": i + 1,
+                "title": title,
+                "startPage": start + 1,
+                "endPage": end + 1,
+                "pageCount": end - start + 1,
+            })
+        return chapters
+
+    # -- content --------------------------------------------------------------
+
+    def section_text(self, index):
+        """Text of spine item index (0-based), parsed while the member is decompressed."""
+        parser = _TextExtractor()
+        with self._lock, self._zip.open(self.spine[index]) as member:
+            decoder = io.TextIOWrapper(member, encoding="utf-8", errors="replace")
+            for chunk in iter(lambda: decoder.read(READ_CHUNK), ""):
+                parser.feed(chunk)
+        parser.close()
+        return parser.text()
+
+    def section_title(self, index):
+        with self._lock:
+            head = self._zip.read(self.spine[index])[:4096].decode("utf-8", "replace")
+        match = re.search(r"<title>([^<]*)</title>", head, re.IGNORECASE)
+        return " ".join(match.group(1).split()) if match and match.group(1).strip() else None
+
+    def section_html(self, index):
+        """Body of spine item index with image/style links made relative to the archive root."""
+        href = self.spine[index]
+        with self._lock:
+            html = self._zip.read(href).decode("utf-8", "replace")
+        base = posixpath.dirname(href)
+        return LINK_ATTR.sub(
+            lambda m: m.group(1) + posixpath.normpath(posixpath.join(base, m.group(2))) + m.group(3), html
+        )
+
+    def _layout(self, html, first_page_only=False):
+        if self._archive is None:
+            self._archive = fitz.Archive(self._zip)  # MuPDF reads the members from the file itself
+        buffer = io.BytesIO()
+        writer = fitz.DocumentWriter(buffer)
+        story = fitz.Story(html=html, archive=self._archive)
+        where = PAGE_RECT + (PAGE_MARGIN, PAGE_MARGIN, -PAGE_MARGIN, -PAGE_MARGIN)
+        more = True
+        while more:
+            device = writer.begin_page(PAGE_RECT)
+            more, _ = story.place(where)
+            story.draw(device)
+            writer.end_page()
+            if first_page_only:
+                break
+        writer.close()
+        return fitz.open("pdf", buffer.getvalue())
+
+    def preview_doc(self, first, last):
+        """PDF numbered like the book up to section last: pages first..last show the first laid
+        out page of their section, the ones before are blank placeholders never rendered."""
+        if not 1 <= first <= last <= len(self.spine):
+            raise ValueError(f"Page number out of range (1-{len(self.spine)} requested {last})")
+        doc = fitz.open()
+        for _ in range(first - 1):
+            doc.new_page(width=PAGE_RECT.width, height=PAGE_RECT.height)
+        with self._render_lock:
+            for index in range(first - 1, last):
+                with self._layout(self.section_html(index), first_page_only=True) as section:
+                    doc.insert_pdf(section)
+        return doc
+
+    def chapter_pdf(self, start, end):
+        """PDF of sections start..end (1-based, inclusive), each section starting on a new page."""
+        doc = fitz.open()
+        with self._render_lock:
+            for index in range(start - 1, end):
+                with self._layout(self.section_html(index)) as section:
+                    doc.insert_pdf(section)
+        return doc
+
+
+_open = OrderedDict()
+_open_lock = threading.Lock()
+
+
+def open_epub(path):
+    """Shared EpubBook for path (parsed once while the file is unchanged)."""
+    path = Path(path)
+    st = path.stat()
+    key = (str(path), st.st_size, st.st_mtime_ns)
+    with _open_lock:
+        book = _open.get(key)
+        if book is None:
+            book = _open[key] = EpubBook(path)
+            while len(_open) > MAX_OPEN:
+                _, evicted = _open.popitem(last=False)
+                evicted.close()
+        _open.move_to_end(key)
+        return book
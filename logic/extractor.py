@@ -2,24 +2,46 @@ import os
 import sys
 import json
 import fitz
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic.epub_book import book_source_path, is_epub, open_epub
+from logic.chapterlistcreator import outline_chapters
 
 #This file provide
-# 1. Lenght of the book (in pages)
-# 2. Picture for the preview
+# 1. Lenght of the book (in pages, for an EPUB: its sections)
+# 2. Its outline as a chapter list, when it has one (the UI then skips the reference page)
+# 3. Picture for the preview
+
+def _outline(strategy, chapters):
+    if not chapters:
+        return None
+    return {"strategy": strategy, "totalChapters": len(chapters), "chapters": chapters}
 
 def _pdf_path(bookname: str) -> str:
     return os.path.join("bookstore", "booktemp", f"{bookname}.pdf")
 
 def extract_book_info(bookname: str) -> dict:
+    source = book_source_path(bookname)
+    if is_epub(source):
+        book = open_epub(source)
+        return {
+            "status": "ok",
+            "bookname": bookname,
+            "pages": len(book),
+            "format": "epub",
+            "outline": _outline("epub-toc", book.chapters()),
+        }
     pdf_path = _pdf_path(bookname)
     if not os.path.exists(pdf_path):
         return {"status": "error", "message": f"File not found: {pdf_path}"}
     doc = fitz.open(pdf_path)
     try:
         pages = len(doc)
+        outline = _outline("outline", outline_chapters(doc))
     finally:
         doc.close()
-    return {"status": "ok", "bookname": bookname, "pages": pages}
+    return {"status": "ok", "bookname": bookname, "pages": pages, "format": "pdf", "outline": outline}
 
 def extract_page_image(bookname: str, page_number: int):
     pdf_path = _pdf_path(bookname)
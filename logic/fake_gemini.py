@@ -0,0 +1,195 @@
+import os
+import re
+import json
+import time
+import argparse
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+#This file provide a local stand-in for genai.Client, enabled with GEMINI_FAKE=1.
+#It answers generate_content_stream with a few chunks describing the request, so the
+#generation paths (jobs, SSE, caching) can be exercised without network or API key.
+#FakeGeminiServer speaks the same over HTTP, for the real client (GEMINI_BASE_URL), with
+#injectable 429/5xx answers to exercise rate limiting and retries:
+#
+# python logic/fake_gemini.py --port 8765 --rpm 30
+
+
+class FakeChunk:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeModels:
+    def __init__(self, chunks=None, delay=None):
+        self.chunks = chunks
+        self.delay = float(os.environ.get("GEMINI_FAKE_DELAY", 0.05)) if delay is None else delay
+        self.calls = []
+
+    def _input_text(self, contents):
+        return "".join(part.text or "" for content in contents for part in content.parts)
+
+    @staticmethod
+    def default_chunks(model, text):
+        return [
+            "## Riassunto (fake)\n\n",
+            f"Modello: {model}. ",
+            f"Testo ricevuto: {len(text)} caratteri, {len(text.split())} parole.\n\n",
+            text.strip()[:200] + "...\n",
+        ]
+
+    def generate_content_stream(self, model, contents, config=None):
+        text = self._input_text(contents)
+        self.calls.append({"model": model, "chars": len(text)})
+        chunks = self.chunks or self.default_chunks(model, text)
+        for chunk in chunks:
+            if self.delay:
+                time.sleep(self.delay)
+            yield FakeChunk(chunk)
+
+    def generate_content(self, model, contents, config=None):
+        return FakeChunk("".join(c.text for c in self.generate_content_stream(model, contents, config)))
+
+
+class FakeGeminiClient:
+    def __init__(self, chunks=None, delay=None, **kwargs):
+        self.models = FakeModels(chunks, delay)
+
+
+class _FakeGeminiHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so connection reuse shows in the stats
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_json(self, status, payload, headers=None):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server.fake
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        match = re.match(r"^/[^/]+/models/([^/:]+):(streamGenerateContent|generateContent)", self.path)
+        if match is None:
+            self._send_json(404, {"error": {"code": 404, "message": "Not found", "status": "NOT_FOUND"}})
+            return
+        failure = server.admit(self.client_address)
+        if failure:
+            status, message = failure
+            self._send_json(
+                status,
+                {"error": {"code": status, "message": message, "status": HTTPStatus(status).phrase.upper()}},
+                {"Retry-After": str(server.retry_after)},
+            )
+            return
+        model, method = match.groups()
+        text = "".join(
+            part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", [])
+        )
+        chunks = server.models.chunks or FakeModels.default_chunks(model, text)
+        if method == "generateContent":
+            self._send_json(200, _fake_response("".join(chunks)))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for chunk in chunks:
+            if server.models.delay:
+                time.sleep(server.models.delay)
+            event = f"data: {json.dumps(_fake_response(chunk))}\r\n\r\n".encode()
+            self.wfile.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+            self.wfile.flush()
+        self.wfile.write(b"0\r\n\r\n")
+
+
+def _fake_response(text):
+    return {
+        "candidates": [{"content": {"role": "model", "parts": [{"text": text}]}, "index": 0}],
+        "modelVersion": "fake",
+    }
+
+
+class FakeGeminiServer:
+    """HTTP stand-in for the Gemini API: point the real client at it with GEMINI_BASE_URL.
+    Answers generateContent and streamGenerateContent (SSE) like FakeModels, and can inject
+    failures: the first fail_first requests get fail_status, and past rpm requests in a minute
+    get 429, as the provider's rate limit would."""
+
+    def __init__(self, host="127.0.0.1", port=0, chunks=None, delay=None, fail_first=0, fail_status=429,
+                 rpm=None, retry_after=0):
+        self.models = FakeModels(chunks, delay)
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.rpm = rpm
+        self.retry_after = retry_after
+        self.stats = {"requests": 0, "failed": 0, "rateLimited": 0, "connections": 0}
+        self._recent = []
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), _FakeGeminiHandler)
+        self._httpd.daemon_threads = True
+        self._httpd.fake = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def admit(self, client_address):
+        """None to serve the request, else (status, message) of the injected failure."""
+        now = time.monotonic()
+        with self._lock:
+            self.stats["requests"] += 1
+            if client_address not in self._clients:
+                self._clients.add(client_address)
+                self.stats["connections"] += 1
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                self.stats["failed"] += 1
+                return self.fail_status, "Injected failure"
+            self._recent = [t for t in self._recent if now - t < 60]
+            if self.rpm is not None and len(self._recent) >= self.rpm:
+                self.stats["rateLimited"] += 1
+                return 429, "Resource has been exhausted (fake rate limit)"
+            self._recent.append(now)
+        return None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-gemini", daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local fake Gemini HTTP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--delay", type=float, default=None, help="seconds between streamed chunks")
+    parser.add_argument("--fail-first", type=int, default=0, help="answer the first N requests with --fail-status")
+    parser.add_argument("--fail-status", type=int, default=429)
+    parser.add_argument("--rpm", type=int, default=None, help="429 past N requests per minute")
+    args = parser.parse_args()
+    server = FakeGeminiServer(args.host, args.port, delay=args.delay, fail_first=args.fail_first,
+                              fail_status=args.fail_status, rpm=args.rpm)
+    print(f"Fake Gemini on {server.base_url} (GEMINI_BASE_URL={server.base_url} GEMINI_API_KEY=fake)")
+    try:
+        server._httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
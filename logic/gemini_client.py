@@ -0,0 +1,222 @@
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from contextlib import contextmanager
+
+from logic.metrics import stage
+
+#This file provide the one Gemini client of the process, shared by every generation:
+# 1. a single genai.Client over a pooled httpx client, so connections are reused across requests
+# 2. token buckets on requests and tokens per minute, below the provider's quota
+# 3. retries with jittered exponential backoff on 429, 5xx and connection errors
+#    (Retry-After is honoured, and a 429 drains the buckets so every caller slows down)
+# 4. a scheduler bounding the requests in flight; waiting ones go by priority, then FIFO
+#
+# GEMINI_BASE_URL points the client at another endpoint, e.g. logic/fake_gemini.py's server.
+
+MAX_CONCURRENCY = int(os.environ.get("GEMINI_MAX_CONCURRENCY", 4))
+REQUESTS_PER_MINUTE = int(os.environ.get("GEMINI_RPM", 60))
+TOKENS_PER_MINUTE = int(os.environ.get("GEMINI_TPM", 1_000_000))
+MAX_RETRIES = int(os.environ.get("GEMINI_MAX_RETRIES", 5))
+BACKOFF_BASE = float(os.environ.get("GEMINI_BACKOFF_BASE", 1.0))
+BACKOFF_MAX = float(os.environ.get("GEMINI_BACKOFF_MAX", 30.0))
+HTTP_TIMEOUT = float(os.environ.get("GEMINI_HTTP_TIMEOUT", 300))
+
+PRIORITY_INTERACTIVE = 0  # a user waiting on the request (/api/gemini-generation)
+PRIORITY_JOB = 10  # queued generation jobs
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class TokenBucket:
+    """per_minute units, refilled continuously. An amount larger than the bucket waits for a
+    full bucket and then goes, so one oversized request is slowed down but never stuck."""
+
+    def __init__(self, per_minute):
+        self.capacity = max(1, per_minute)
+        self.rate = self.capacity / 60.0
+        self._level = float(self.capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def acquire(self, amount):
+        """Take amount units, sleeping until they are there; returns the seconds waited."""
+        amount = min(amount, self.capacity)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                if self._level >= amount:
+                    self._level -= amount
+                    return waited
+                delay = (amount - self._level) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+    def drain(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self._level = min(self._level, 0.0)
+
+
+class PriorityScheduler:
+    """At most limit holders of a slot; waiters are admitted lowest priority first, FIFO within one."""
+
+    def __init__(self, limit):
+        self.limit = max(1, limit)
+        self.active = 0
+        self._waiting = []
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+
+    @contextmanager
+    def slot(self, priority=PRIORITY_JOB):
+        with self._cond:
+            entry = (priority, next(self._seq))
+            heapq.heappush(self._waiting, entry)
+            while self.active >= self.limit or self._waiting[0] != entry:
+                self._cond.wait()
+            heapq.heappop(self._waiting)
+            self.active += 1
+            self._cond.notify_all()
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.active -= 1
+                self._cond.notify_all()
+
+    def queued(self):
+        with self._cond:
+            return len(self._waiting)
+
+
+def _status(error):
+    """HTTP status of a failed call (None for transport errors, which are retried too)."""
+    code = getattr(error, "code", None)
+    if isinstance(code, int):
+        return code
+    try:
+        import httpx
+    except ImportError:
+        return -1
+    return None if isinstance(error, httpx.TransportError) else -1
+
+
+def _retry_after(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def make_client():
+    """genai.Client over a pooled httpx client (or the in-process fake with GEMINI_FAKE=1)."""
+    if os.environ.get("GEMINI_FAKE") and not os.environ.get("GEMINI_BASE_URL"):
+        from logic.fake_gemini import FakeGeminiClient
+        return FakeGeminiClient()
+    import httpx
+    from google import genai
+    from google.genai import types
+
+    http_client = httpx.Client(
+        timeout=HTTP_TIMEOUT,
+        limits=httpx.Limits(max_connections=MAX_CONCURRENCY * 2, max_keepalive_connections=MAX_CONCURRENCY),
+    )
+    return genai.Client(
+        api_key=os.environ.get("GEMINI_API_KEY") or "fake",
+        http_options=types.HttpOptions(base_url=os.environ.get("GEMINI_BASE_URL"), httpx_client=http_client),
+    )
+
+
+class GeminiService:
+    def __init__(self, client=None, max_concurrency=MAX_CONCURRENCY, rpm=REQUESTS_PER_MINUTE,
+                 tpm=TOKENS_PER_MINUTE, max_retries=MAX_RETRIES, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX):
+        self._client = client
+        self._client_lock = threading.Lock()
+        self.scheduler = PriorityScheduler(max_concurrency)
+        self.request_bucket = TokenBucket(rpm)
+        self.token_bucket = TokenBucket(tpm)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._lock = threading.Lock()
+        self.counters = {"requests": 0, "retries": 0, "failures": 0, "throttledSeconds": 0.0}
+
+    @property
+    def client(self):
+        with self._client_lock:
+            if self._client is None:
+                self._client = make_client()
+            return self._client
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def backoff(self, attempt, error=None):
+        """Full jitter: uniform in [0, min(max, base * 2^attempt)], at least the server's Retry-After."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        retry_after = _retry_after(error) if error is not None else None
+        return max(delay, min(retry_after, self.backoff_max)) if retry_after is not None else delay
+
+    def stream(self, model, contents, config=None, priority=PRIORITY_JOB, tokens=0):
+        """generate_content_stream through the limiter; failures before the first chunk are retried."""
+        with stage("gemini", model=model, priority=priority, tokens=tokens) as fields:
+            queued = time.monotonic()
+            with self.scheduler.slot(priority):
+                fields["queuedMs"] = round((time.monotonic() - queued) * 1000, 2)
+                attempt = 0
+                chunks = 0
+                while True:
+                    waited = self.request_bucket.acquire(1) + self.token_bucket.acquire(tokens)
+                    if waited:
+                        self._count("throttledSeconds", waited)
+                    self._count("requests")
+                    fields["attempts"] = attempt + 1
+                    try:
+                        for chunk in self.client.models.generate_content_stream(model=model, contents=contents, config=config):
+                            chunks += 1
+                            fields["chunks"] = chunks
+                            yield chunk
+                        return
+                    except Exception as e:
+                        status = _status(e)
+                        if chunks or attempt >= self.max_retries or (status is not None and status not in RETRY_STATUS):
+                            self._count("failures")
+                            raise
+                        if status == 429:
+                            # the provider says we are over quota: everyone waits for the buckets to refill
+                            self.request_bucket.drain()
+                            self.token_bucket.drain()
+                        self._count("retries")
+                        time.sleep(self.backoff(attempt, e))
+                        attempt += 1
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self.counters)
+        counters["throttledSeconds"] = round(counters["throttledSeconds"], 3)
+        return {**counters, "inflight": self.scheduler.active, "queued": self.scheduler.queued()}
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_gemini_service():
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = GeminiService()
+        return _service
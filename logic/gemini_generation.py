@@ -4,77 +4,278 @@ import json
 from pathlib import Path
 import fitz
 import base64
-from google import genai
-from google.genai import types
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic.generation_cache import get_generation_cache
+from logic.catalog import get_catalog
+from logic.virtual_chapters import ensure_book_text, source_pdf
+from logic.text_store import open_sidecar, page_texts, write_text_sidecar
+from logic.tokens import REQUEST_TOKEN_BUDGET, estimate_tokens, chunk_pages, estimate_cost
+from logic.gemini_client import get_gemini_service, PRIORITY_JOB
+from logic.metrics import stage, run_in_context
 
 #This file provide Gemini response
 
-def extract_text_from_pdf(pdf_path):
+def extract_text_from_pdf(pdf_path, start=0, end=None):
     try:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for page in doc:
-            text += page.get_text()
-        doc.close()
-        return text
+        sidecar = open_sidecar(pdf_path)
+        if sidecar is not None:
+            with sidecar:
+                return sidecar.text(start, end)
+        # no sidecar yet (chapters split before it existed): extract once and keep it
+        with stage("text_extract", file=os.path.basename(str(pdf_path))) as fields:
+            doc = fitz.open(pdf_path)
+            try:
+                texts = page_texts(doc)
+            finally:
+                doc.close()
+            write_text_sidecar(pdf_path, texts)
+            fields["pages"] = len(texts)
+        end = len(texts) - 1 if end is None else end
+        return "".join(texts[start:end + 1])
     except Exception as e:
         return f"Error extracting text from {pdf_path}: {str(e)}"
 
-def generate_with_gemini(input_text, mode):
-    print("Request ready")
+MODEL = "gemini-2.5-flash"
+GENERATION_ERROR = "Error generating with Gemini"
+MAX_INFLIGHT = int(os.environ.get("GEMINI_MAX_INFLIGHT", 4))  # concurrent requests of one map-reduce
+OVERSIZE_POLICIES = ("chunk", "refuse")
+
+
+def chapter_pages(bookname, chapter_file, row):
+    """Page texts of a catalogued chapter (virtual ones from the source book's sidecar)."""
+    with stage("chapter_text", book=bookname, file=os.path.basename(str(chapter_file))) as fields:
+        pages = _chapter_pages(bookname, chapter_file, row)
+        fields["pages"] = len(pages)
+        return pages
+
+
+def _chapter_pages(bookname, chapter_file, row):
+    if row['virtual']:
+        source = source_pdf(bookname)
+        if source is None:
+            raise FileNotFoundError(f"Source of {bookname} not found")
+        with ensure_book_text(source) as sidecar:
+            last = min(row['end_page'], sidecar.page_count)
+            return [sidecar.page(i) for i in range(row['start_page'] - 1, last)]
+    sidecar = open_sidecar(chapter_file)
+    if sidecar is None:
+        extract_text_from_pdf(str(chapter_file))  # writes the sidecar
+        sidecar = open_sidecar(chapter_file)
+    if sidecar is None:
+        raise FileNotFoundError(f"No text for {chapter_file}")
+    with sidecar:
+        return [sidecar.page(i) for i in range(sidecar.page_count)]
+
+
+def resolve_chapters(bookname, selected_chapters):
+    """[(chapter_id, chapter file, catalog row)] of the selected ids that exist."""
+    book_dir = Path('bookstore') / 'elaboratebook' / bookname
+    catalog = get_catalog()
+    catalog.ensure_book(bookname)
+    found = []
+    for chapter_id in selected_chapters:
+        if '_cap' in chapter_id:
+            chapter_number = chapter_id.split('_cap')[1]
+            row = catalog.chapter(bookname, int(chapter_number)) if chapter_number.isdigit() else None
+
+            if row:
+                found.append((chapter_id, book_dir / row['filename'], row))
+            else:
+                print(f"Error: Chapter {chapter_number} of {bookname} not in the catalog", file=sys.stderr)
+        else:
+            print(f"Error: Chapter ID {chapter_id} doesn't contain '_cap'", file=sys.stderr)
+    return found
+
+
+def chapter_tokens(bookname, chapter_file, row):
+    """Token estimate of a chapter: stored at split time, computed (and stored) for older ones."""
+    if row.get('tokens') is None:
+        row['tokens'] = sum(estimate_tokens(page) for page in chapter_pages(bookname, chapter_file, row))
+        get_catalog().set_tokens(bookname, row['number'], row['tokens'])
+    return row['tokens']
+
+
+def plan_generation(bookname, chapters_found, mode, strategy="single", budget=REQUEST_TOKEN_BUDGET,
+                    max_inflight=MAX_INFLIGHT):
+    """Requests needed for a selection, from the token counts alone (no text is read, no call made).
+    A single request over budget becomes a map-reduce whose oversized chapters are chunked."""
+    prompt_tokens = estimate_tokens(build_prompt(mode))
+    text_budget = max(1, budget - prompt_tokens)
+    chapters = [
+        {'number': row['number'], 'title': row['title'], 'tokens': chapter_tokens(bookname, chapter_file, row)}
+        for _, chapter_file, row in chapters_found
+    ]
+    total = sum(ch['tokens'] for ch in chapters)
+    oversize = total > text_budget
+    chunks = sum(max(1, -(-ch['tokens'] // text_budget)) for ch in chapters)
+    map_reduce = (strategy == "mapreduce" and len(chapters) > 1) or oversize
+    if map_reduce:
+        map_cost = estimate_cost(total + chunks * prompt_tokens, chunks, parallel=max_inflight)
+        reduce_cost = estimate_cost(map_cost['outputTokens'], 1)
+        estimate = {
+            'inputTokens': map_cost['inputTokens'] + reduce_cost['inputTokens'],
+            'outputTokens': map_cost['outputTokens'] + reduce_cost['outputTokens'],
+            'requests': chunks + 1,
+            'costUsd': round(map_cost['costUsd'] + reduce_cost['costUsd'], 6),
+            'latencySeconds': round(map_cost['latencySeconds'] + reduce_cost['latencySeconds'], 1),
+        }
+    else:
+        estimate = estimate_cost(total + prompt_tokens, 1)
+    return {
+        'chapters': chapters,
+        'totalTokens': total,
+        'budget': budget,
+        'oversize': oversize,
+        'strategy': 'mapreduce' if map_reduce else 'single',
+        'chunks': chunks,
+        'estimate': estimate,
+    }
+
+
+def build_prompt(mode):
     if mode.lower() == "summarization":
-        prompt = (
+        return (
             "Ti verranno forniti uno o più capitoli di un libro; "
             "crea un riassunto molto dettagliato del contenuto condiviso."
         )
-    else:
-        prompt = (
-            "Ti verranno forniti uno o più capitoli di un libro; "
-            "organizza chiaramente i personaggi in ordine di rilevanza, "
-            "evidenziando chi sono, le loro caratteristiche e cosa hanno fatto in breve."
-            "Il risutalto deve essere esempio Marco: [Descrizione] [Breve descrizione di cose fatte]"
-            "Solo personaggi dentro il libro, non parlare dell'autore o altre cose in prefazione su personaggi non nel libro"
-        )
+    return (
+        "Ti verranno forniti uno o più capitoli di un libro; "
+        "organizza chiaramente i personaggi in ordine di rilevanza, "
+        "evidenziando chi sono, le loro caratteristiche e cosa hanno fatto in breve."
+        "Il risutalto deve essere esempio Marco: [Descrizione] [Breve descrizione di cose fatte]"
+        "Solo personaggi dentro il libro, non parlare dell'autore o altre cose in prefazione su personaggi non nel libro"
+    )
 
-    try:
-        client = genai.Client(
-            api_key=os.environ.get("GEMINI_API_KEY"),
+
+def build_reduce_prompt(mode):
+    if mode.lower() == "summarization":
+        return (
+            "Ti verranno forniti i riassunti di più capitoli dello stesso libro, in ordine; "
+            "uniscili in un unico riassunto molto dettagliato e coerente, seguendo l'ordine dei capitoli."
         )
+    return (
+        "Ti verranno fornite le liste dei personaggi estratte da più capitoli dello stesso libro; "
+        "uniscile in un'unica lista ordinata per rilevanza, fondendo i personaggi ripetuti. "
+        "Il risutalto deve essere esempio Marco: [Descrizione] [Breve descrizione di cose fatte]"
+    )
 
-        model = "gemini-2.5-flash"
-        contents = [
-            types.Content(
-                role="user",
-                parts=[
-                    types.Part.from_text(text=input_text),
-                ],
-            ),
-        ]
-        generate_content_config = types.GenerateContentConfig(
-            thinking_config = types.ThinkingConfig(
-                thinking_budget=-1,
-            ),
-            system_instruction=[
-                types.Part.from_text(text=prompt),
+
+def gemini_available():
+    return bool(os.environ.get("GEMINI_API_KEY") or os.environ.get("GEMINI_FAKE"))
+
+
+def stream_with_gemini(input_text, mode, client=None, prompt=None, priority=PRIORITY_JOB):
+    """Yield the response text chunk by chunk, as the model produces it.
+    Without an explicit client the request goes through the shared, rate limited service."""
+    from google.genai import types  # ~0.5 s to import: paid by the first generation, not by every start
+
+    contents = [
+        types.Content(
+            role="user",
+            parts=[
+                types.Part.from_text(text=input_text),
             ],
+        ),
+    ]
+    generate_content_config = types.GenerateContentConfig(
+        thinking_config = types.ThinkingConfig(
+            thinking_budget=-1,
+        ),
+        system_instruction=[
+            types.Part.from_text(text=prompt or build_prompt(mode)),
+        ],
+    )
+    if client is not None:
+        chunks = client.models.generate_content_stream(
+            model=MODEL,
+            contents=contents,
+            config=generate_content_config,
+        )
+    else:
+        chunks = get_gemini_service().stream(
+            MODEL, contents, generate_content_config, priority=priority,
+            tokens=estimate_tokens(input_text) + estimate_tokens(prompt or build_prompt(mode)),
         )
+    for chunk in chunks:
+        if chunk.text:
+            yield chunk.text
 
+
+def generate_with_gemini(input_text, mode, on_chunk=None, client=None, prompt=None, priority=PRIORITY_JOB):
+    try:
         response_text = ""
-        for chunk in client.models.generate_content_stream(
-            model=model,
-            contents=contents,
-            config=generate_content_config,
-        ):
-            response_text += chunk.text
+        for text in stream_with_gemini(input_text, mode, client, prompt, priority):
+            response_text += text
+            if on_chunk:
+                on_chunk(text)
 
         return response_text
         
     except Exception as e:
-        return f"Error generating with Gemini: {str(e)}"
+        return f"{GENERATION_ERROR}: {str(e)}"
 
-def extract_chapter_info(bookname, selected_chapters, mode):
+def summarize_map_reduce(bookname, chapters_info, mode, on_chunk=None, max_inflight=MAX_INFLIGHT,
+                         budget=REQUEST_TOKEN_BUDGET, priority=PRIORITY_JOB):
+    """Summarize every chapter concurrently (cached per chapter), then merge the partial results.
+    Chapters over the token budget are mapped in chunks of consecutive pages, and partials that
+    don't fit one merge request are merged in rounds."""
+    cache = get_generation_cache()
+    prompt = build_prompt(mode)
+    text_budget = max(1, budget - estimate_tokens(prompt))
+
+    work = []
+    for info in chapters_info:
+        chunks = chunk_pages(info['pages'], text_budget) or [info['text']]
+        for k, chunk in enumerate(chunks):
+            label = f"{info['chapter_title']} (parte {k + 1}/{len(chunks)})" if len(chunks) > 1 else info['chapter_title']
+            # a chapter in one piece keeps the cache key it had before chunking existed
+            content_hash = info['content_hash'] if len(chunks) == 1 else f"{info['content_hash']}:{k}/{len(chunks)}"
+            work.append((info, label, content_hash, chunk))
+
+    def map_chunk(item):
+        info, _, content_hash, text = item
+        key = cache.key([info['file_path']], mode, prompt, MODEL, hashes=[content_hash])
+        cached = cache.get(key)
+        if cached is not None:
+            return cached['gemini_summary']
+        text = generate_with_gemini(text, mode, priority=priority)
+        if not text.startswith(GENERATION_ERROR):
+            cache.put(key, bookname, {'gemini_summary': text}, [info['file_path']])
+        return text
+
+    with ThreadPoolExecutor(max_workers=max(1, max_inflight)) as pool:
+        partials = list(pool.map(run_in_context(map_chunk), work))
+
+    for partial in partials:
+        if partial.startswith(GENERATION_ERROR):
+            return partial, partials
+    if len(partials) == 1:
+        if on_chunk:
+            on_chunk(partials[0])
+        return partials[0], partials
+
+    reduce_prompt = build_reduce_prompt(mode)
+    reduce_budget = max(1, budget - estimate_tokens(reduce_prompt))
+    sections = [
+        f"\n\n=== CAPITOLO {info['chapter_number']}: {label} ===\n\n{partial}"
+        for (info, label, _, _), partial in zip(work, partials)
+    ]
+    batches = chunk_pages(sections, reduce_budget)
+    while len(batches) > 1:
+        merged = [generate_with_gemini(batch, mode, prompt=reduce_prompt, priority=priority) for batch in batches]
+        for text in merged:
+            if text.startswith(GENERATION_ERROR):
+                return text, partials
+        batches = chunk_pages([f"\n\n=== PARTE {k + 1} ===\n\n{text}" for k, text in enumerate(merged)], reduce_budget)
+    return generate_with_gemini(batches[0], mode, on_chunk, prompt=reduce_prompt, priority=priority), partials
+
+
+def extract_chapter_info(bookname, selected_chapters, mode, on_chunk=None, strategy="single", oversize="chunk",
+                         priority=PRIORITY_JOB):
     try:
-        if not os.environ.get("GEMINI_API_KEY"):
+        if not gemini_available():
             raise ValueError("GEMINI_API_KEY environment variable not set")
 
         book_dir = Path('bookstore') / 'elaboratebook' / bookname
@@ -84,52 +285,72 @@ def extract_chapter_info(bookname, selected_chapters, mode):
 
         chapters_info = []
         all_chapters_text = ""
-        
-        for chapter_id in selected_chapters:
-            if '_cap' in chapter_id:
-                chapter_number = chapter_id.split('_cap')[1]
-
-                pattern = f'cap{chapter_number}*.pdf'
-                chapter_files = list(book_dir.glob(pattern))
-                
-                if chapter_files:
-                    chapter_file = chapter_files[0]
-                    filename = chapter_file.name
-
-                    import re
-                    match = re.match(r'cap(\d+)\[(.+)\]\.pdf', filename)
-                    if match:
-                        cap_num = int(match.group(1))
-                        cap_title = match.group(2).replace('_', ' ')
-                        chapter_text = extract_text_from_pdf(str(chapter_file))
-                        
-                        chapter_info = {
-                            'chapter_number': cap_num,
-                            'chapter_title': cap_title,
-                            'filename': filename,
-                            'file_path': str(chapter_file),
-                            'url': f'/api/chapter-file/{bookname}/{filename}',
-                            'chapter_id': chapter_id,
-                            'text': chapter_text
-                        }
-                        
-                        chapters_info.append(chapter_info)
-
-                        all_chapters_text += f"\n\n=== CAPITOLO {cap_num}: {cap_title} ===\n\n{chapter_text}"
-                    else:
-                        print(f"Error: Filename {filename} doesn't match expected pattern", file=sys.stderr)
-                else:
-                    print(f"Error: No files found for pattern {pattern}", file=sys.stderr)
-            else:
-                print(f"Error: Chapter ID {chapter_id} doesn't contain '_cap'", file=sys.stderr)
+        catalog = get_catalog()
+        chapter_files_found = resolve_chapters(bookname, selected_chapters)
+
+        # token budget checked before any request: too big for one call is chunked or refused
+        token_plan = plan_generation(bookname, chapter_files_found, mode, strategy)
+        if token_plan['oversize'] and oversize == "refuse":
+            raise ValueError(
+                f"Selection of ~{token_plan['totalTokens']} tokens exceeds the budget of {token_plan['budget']} per request"
+            )
+
+        # Same chapter files (by content), mode, prompt and model: answer from the cache
+        cache = get_generation_cache()
+        chapter_paths = [chapter_file for _, chapter_file, _ in chapter_files_found]
+        chapter_hashes = [
+            row['sha256'] if row['virtual'] else cache.file_hash(chapter_file)
+            for _, chapter_file, row in chapter_files_found
+        ]
+        map_reduce = token_plan['strategy'] == "mapreduce"
+        prompt = build_prompt(mode) + (build_reduce_prompt(mode) if map_reduce else "")
+        cache_key = cache.key(chapter_paths, mode, prompt, MODEL, hashes=chapter_hashes) if chapter_paths else None
+        if cache_key:
+            cached = cache.get(cache_key)
+            if cached is not None:
+                if on_chunk:
+                    on_chunk(cached['gemini_summary'])
+                return {**cached, 'cached': True}
+
+        for (chapter_id, chapter_file, row), content_hash in zip(chapter_files_found, chapter_hashes):
+            filename = chapter_file.name
+            cap_num = row['number']
+            cap_title = row['title']
+            pages = chapter_pages(bookname, chapter_file, row)
+            chapter_text = "".join(pages)
+            
+            chapter_info = {
+                'chapter_number': cap_num,
+                'chapter_title': cap_title,
+                'filename': filename,
+                'file_path': str(chapter_file),
+                'url': f'/api/chapter-file/{bookname}/{filename}',
+                'chapter_id': chapter_id,
+                'content_hash': content_hash,
+                'tokens': row['tokens'],
+                'pages': pages,
+                'text': chapter_text
+            }
+            
+            chapters_info.append(chapter_info)
+
+            all_chapters_text += f"\n\n=== CAPITOLO {cap_num}: {cap_title} ===\n\n{chapter_text}"
 
         chapters_info.sort(key=lambda x: x['chapter_number'])
 
 
-        if all_chapters_text.strip():
-            summary = generate_with_gemini(all_chapters_text, mode)
+        generated = False
+        partial_summaries = None
+        if all_chapters_text.strip() and map_reduce:
+            summary, partial_summaries = summarize_map_reduce(bookname, chapters_info, mode, on_chunk, priority=priority)
+            generated = not summary.startswith(GENERATION_ERROR)
+        elif all_chapters_text.strip():
+            summary = generate_with_gemini(all_chapters_text, mode, on_chunk, priority=priority)
+            generated = not summary.startswith(GENERATION_ERROR)
         else:
             summary = "No chapter content found for generation."
+        for info in chapters_info:
+            info.pop('pages')  # the text is already there once
         
         result = {
             'status': 'success',
@@ -138,14 +359,19 @@ def extract_chapter_info(bookname, selected_chapters, mode):
             'chapters': chapters_info,
             'combined_text': all_chapters_text,
             'gemini_summary': summary,
+            'strategy': 'mapreduce' if map_reduce else 'single',
+            'chapter_summaries': partial_summaries,
+            'token_plan': token_plan,
             'book_directory': str(book_dir),
             'generation_ready': True,
             'debug_info': {
                 'selected_chapters': selected_chapters,
                 'book_dir_exists': book_dir.exists(),
-                'files_in_dir': [str(f) for f in book_dir.glob('*')] if book_dir.exists() else []
+                'files_in_dir': [str(book_dir / row['filename']) for row in catalog.chapters(bookname)[0]]
             }
         }
+        if generated:
+            cache.put(cache_key, bookname, result, chapter_paths)
         
         return result
         
@@ -164,7 +390,7 @@ def main():
     if len(sys.argv) < 4:
         print(json.dumps({
             'status': 'error',
-            'message': 'Usage: python gemini_generation.py <bookname> <chapter_ids_json> <mode>'
+            'message': 'Usage: python gemini_generation.py <bookname> <chapter_ids_json> <mode> [single|mapreduce] [chunk|refuse]'
         }))
         sys.exit(1)
     
@@ -172,10 +398,12 @@ def main():
         bookname = sys.argv[1]
         chapter_ids_json = sys.argv[2]
         mode = sys.argv[3]
+        strategy = sys.argv[4] if len(sys.argv) > 4 else "single"
+        oversize = sys.argv[5] if len(sys.argv) > 5 else "chunk"
 
         selected_chapters = json.loads(chapter_ids_json)
 
-        result = extract_chapter_info(bookname, selected_chapters, mode)
+        result = extract_chapter_info(bookname, selected_chapters, mode, strategy=strategy, oversize=oversize)
         print(json.dumps(result))
         
         
@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+#This file provide the cache of Gemini results (summaries and character lists).
+#The key is a hash of the chapter PDFs' content + mode + prompt + model, so the same
+#request is answered without a new Gemini call. Entries are evicted LRU above a size cap
+#and dropped when their chapter files are re-split or the book is deleted.
+
+CACHE_DB = Path("bookstore") / "generation_cache.sqlite"
+CACHE_MAX_BYTES = int(os.environ.get("GENERATION_CACHE_BYTES", 64 * 1024 * 1024))
+
+
+class GenerationCache:
+    def __init__(self, db_path=CACHE_DB, max_bytes=CACHE_MAX_BYTES):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    bookname TEXT NOT NULL,
+                    result TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entries_lru ON entries(last_access);
+                CREATE INDEX IF NOT EXISTS entries_book ON entries(bookname);
+                CREATE TABLE IF NOT EXISTS entry_files (
+                    key TEXT NOT NULL,
+                    path TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS entry_files_path ON entry_files(path);
+                CREATE TABLE IF NOT EXISTS file_hashes (
+                    path TEXT PRIMARY KEY,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    sha256 TEXT NOT NULL
+                );
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def file_hash(self, path):
+        """sha256 of a file, remembered per (size, mtime) so unchanged chapters are read once."""
+        path = str(path)
+        st = os.stat(path)
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT sha256 FROM file_hashes WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        if row:
+            return row[0]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO file_hashes (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                (path, st.st_size, st.st_mtime_ns, digest.hexdigest()),
+            )
+        return digest.hexdigest()
+
+    def key(self, chapter_paths, mode, prompt, model, hashes=None):
+        """hashes: content hashes already known (virtual chapters have no file), in path order."""
+        hashes = hashes or [self.file_hash(p) for p in chapter_paths]
+        parts = list(hashes) + [mode.lower(), prompt, model]
+        return hashlib.sha256("\0".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock, self._connect() as conn:
+            row = conn.execute("SELECT result FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+            conn.execute("UPDATE entries SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.counters["hits"] += 1
+        return json.loads(row[0])
+
+    def put(self, key, bookname, result, chapter_paths):
+        payload = json.dumps(result, ensure_ascii=False)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, bookname, result, size, created_at, last_access) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, bookname, payload, len(payload), now, now),
+            )
+            conn.execute("DELETE FROM entry_files WHERE key = ?", (key,))
+            conn.executemany(
+                "INSERT INTO entry_files (key, path) VALUES (?, ?)", [(key, str(p)) for p in chapter_paths]
+            )
+            self._evict(conn)
+
+    def _evict(self, conn):
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        while total > self.max_bytes:
+            row = conn.execute("SELECT key, size FROM entries ORDER BY last_access LIMIT 1").fetchone()
+            if row is None:
+                break
+            self._delete(conn, [row[0]])
+            total -= row[1]
+            self.counters["evictions"] += 1
+
+    @staticmethod
+    def _delete(conn, keys):
+        conn.executemany("DELETE FROM entries WHERE key = ?", [(k,) for k in keys])
+        conn.executemany("DELETE FROM entry_files WHERE key = ?", [(k,) for k in keys])
+
+    def invalidate_paths(self, paths):
+        """Drop entries built from any of these chapter files (re-split or removed)."""
+        paths = [str(p) for p in paths]
+        with self._lock, self._connect() as conn:
+            keys = {
+                row[0]
+                for p in paths
+                for row in conn.execute("SELECT key FROM entry_files WHERE path = ?", (p,))
+            }
+            self._delete(conn, list(keys))
+            conn.executemany("DELETE FROM file_hashes WHERE path = ?", [(p,) for p in paths])
+        return len(keys)
+
+    def invalidate_book(self, bookname):
+        with self._lock, self._connect() as conn:
+            keys = [row[0] for row in conn.execute("SELECT key FROM entries WHERE bookname = ?", (bookname,))]
+            self._delete(conn, keys)
+            prefix = str(Path("bookstore") / "elaboratebook" / bookname) + os.sep
+            conn.execute("DELETE FROM file_hashes WHERE substr(path, 1, ?) = ?", (len(prefix), prefix))
+        return len(keys)
+
+    def stats(self):
+        with self._connect() as conn:
+            entries, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.counters["hits"] + self.counters["misses"]
+        return {
+            **self.counters,
+            "hitRatio": round(self.counters["hits"] / lookups, 4) if lookups else None,
+            "entries": entries,
+            "bytes": size,
+            "maxBytes": self.max_bytes,
+        }
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_generation_cache():
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = GenerationCache()
+        return _cache
@@ -0,0 +1,303 @@
+import os
+import json
+import time
+import uuid
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from logic.metrics import run_in_context
+
+#This file provide the job queue for Gemini generation:
+# 1. submit() stores the job and returns its id right away
+# 2. a bounded worker pool runs extract_chapter_info, streaming partial output into the job
+# 3. jobs live in bookstore/jobs.sqlite; a job is claimed by one process (several server workers),
+#    and every queue checks periodically for queued jobs nobody runs and running jobs whose
+#    process is gone (a restart, a recycled worker), which it requeues and runs
+# 4. events() follows a job live, which /api/generation-jobs/<id>/events sends as SSE; a job
+#    running in another worker is followed through the partial output flushed to the store
+
+JOBS_DB = Path("bookstore") / "jobs.sqlite"
+JOB_WORKERS = int(os.environ.get("GEMINI_JOB_WORKERS", 2))
+PARTIAL_FLUSH_SECONDS = 1.0
+RECOVER_SECONDS = float(os.environ.get("GEMINI_JOB_RECOVER_SECONDS", 30))
+
+QUEUED, RUNNING, DONE, ERROR = "queued", "running", "done", "error"
+
+
+def _alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class JobStore:
+    def __init__(self, db_path=JOBS_DB):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    bookname TEXT NOT NULL,
+                    chapters TEXT NOT NULL,
+                    mode TEXT NOT NULL,
+                    strategy TEXT NOT NULL DEFAULT 'single',
+                    status TEXT NOT NULL,
+                    partial TEXT NOT NULL DEFAULT '',
+                    result TEXT,
+                    error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )"""
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs(status)")
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(jobs)")}
+            if "strategy" not in columns:  # stores created before map-reduce
+                conn.execute("ALTER TABLE jobs ADD COLUMN strategy TEXT NOT NULL DEFAULT 'single'")
+            if "worker" not in columns:  # pid of the process running the job (several server workers)
+                conn.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    def create(self, bookname, chapters, mode, strategy="single"):
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, bookname, chapters, mode, strategy, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, bookname, json.dumps(chapters), mode, strategy, QUEUED, now, now),
+            )
+        return job_id
+
+    def update(self, job_id, **fields):
+        if "result" in fields and fields["result"] is not None:
+            fields["result"] = json.dumps(fields["result"])
+        fields["updated_at"] = time.time()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self._lock, self._connect() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def get(self, job_id):
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["chapters"] = json.loads(job["chapters"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def claim(self, job_id):
+        """Mark a queued job as running in this process; False if another process got it first."""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, worker = ?, updated_at = ? WHERE id = ? AND status = ?",
+                (RUNNING, os.getpid(), time.time(), job_id, QUEUED),
+            )
+        return cursor.rowcount == 1
+
+    def requeue(self, job_id, worker):
+        """Put a running job back in the queue if worker still owns it; False if it moved on."""
+        with self._lock, self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, worker = NULL, partial = '', updated_at = ? "
+                "WHERE id = ? AND status = ? AND worker IS ?",
+                (QUEUED, time.time(), job_id, RUNNING, worker),
+            )
+        return cursor.rowcount == 1
+
+    def unfinished(self):
+        """[(id, status, worker)] of the queued and running jobs, oldest first."""
+        with self._connect() as conn:
+            return conn.execute(
+                "SELECT id, status, worker FROM jobs WHERE status IN (?, ?) ORDER BY created_at", (QUEUED, RUNNING)
+            ).fetchall()
+
+    def count(self, status):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM jobs WHERE status = ?", (status,)).fetchone()[0]
+
+
+class JobQueue:
+    def __init__(self, store=None, workers=JOB_WORKERS, recover_every=RECOVER_SECONDS):
+        self.store = store or JobStore()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="gemini-job")
+        self._partials = {}
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._scheduled = set()  # ids waiting in or running on this executor
+        self._stop = threading.Event()
+        self.recover()
+        if recover_every:
+            threading.Thread(target=self._recover_loop, args=(recover_every,), name="gemini-job-recover",
+                             daemon=True).start()
+
+    def _schedule(self, job_id, fn):
+        with self._lock:
+            if job_id in self._scheduled:
+                return
+            self._scheduled.add(job_id)
+        self.executor.submit(fn, job_id)
+
+    def recover(self):
+        """Schedule queued jobs not already waiting here and requeue running jobs whose process is
+        gone; the claim in _run lets only one process run each of them."""
+        pid = os.getpid()
+        for job_id, status, worker in self.store.unfinished():
+            with self._lock:
+                mine = job_id in self._scheduled
+            if status == RUNNING:
+                # our own pid on a job we don't run is a previous run of this process (pid 1 in a container)
+                orphan = not _alive(worker) or (worker == pid and not mine)
+                if not orphan or not self.store.requeue(job_id, worker):
+                    continue
+            self._schedule(job_id, self._run)
+
+    def _recover_loop(self, every):
+        while not self._stop.wait(every):
+            try:
+                self.recover()
+            except sqlite3.Error:
+                pass  # busy store: next round
+
+    def submit(self, bookname, chapters, mode, strategy="single"):
+        job_id = self.store.create(bookname, chapters, mode, strategy)
+        self._schedule(job_id, run_in_context(self._run))  # log lines keep the submitting request's id
+        return job_id
+
+    def status(self, job_id):
+        job = self.store.get(job_id)
+        if job is None:
+            return None
+        with self._lock:
+            partial = self._partials.get(job_id)
+        if partial is not None:
+            job["partial"] = "".join(partial)  # fresher than the last flush
+        return job
+
+    def _run(self, job_id):
+        from logic.gemini_generation import extract_chapter_info  # google.genai is only needed here
+
+        job = self.store.get(job_id)
+        if job is None or not self.store.claim(job_id):
+            with self._lock:
+                self._scheduled.discard(job_id)
+            return  # gone, or already claimed by another server worker
+        with self._changed:
+            self._partials[job_id] = []
+            self._changed.notify_all()
+        last_flush = [time.monotonic()]
+
+        def on_chunk(text):
+            with self._changed:
+                self._partials[job_id].append(text)
+                partial = "".join(self._partials[job_id])
+                self._changed.notify_all()
+            if time.monotonic() - last_flush[0] >= PARTIAL_FLUSH_SECONDS:
+                self.store.update(job_id, partial=partial)
+                last_flush[0] = time.monotonic()
+
+        try:
+            result = extract_chapter_info(
+                job["bookname"], job["chapters"], job["mode"], on_chunk=on_chunk, strategy=job["strategy"]
+            )
+            with self._lock:
+                partial = "".join(self._partials.get(job_id, []))
+            if result.get("status") == "error":
+                self.store.update(job_id, status=ERROR, error=result.get("message"), partial=partial)
+            else:
+                self.store.update(job_id, status=DONE, result=result, partial=partial)
+        except Exception as e:
+            self.store.update(job_id, status=ERROR, error=str(e))
+        finally:
+            with self._changed:
+                self._partials.pop(job_id, None)
+                self._scheduled.discard(job_id)
+                self._changed.notify_all()
+
+    def events(self, job_id, heartbeat=15.0):
+        """Yield (event, data) for a job: its output so far, new chunks as they arrive, then done/error."""
+        sent = 0
+        status = None
+        last_event = time.monotonic()
+        while True:
+            idle = False
+            with self._changed:
+                parts = self._partials.get(job_id)
+                if parts is not None and len("".join(parts)) == sent:
+                    idle = not self._changed.wait(heartbeat)
+                    parts = self._partials.get(job_id)
+                live = "".join(parts) if parts is not None else None
+            if idle:
+                yield "ping", {}
+                continue
+
+            if live is not None:
+                if len(live) < sent:  # requeued and started over: the client drops its text
+                    sent, status = 0, QUEUED
+                    yield "status", {"status": QUEUED}
+                if status != RUNNING:
+                    status = RUNNING
+                    yield "status", {"status": RUNNING}
+                if len(live) > sent:
+                    yield "chunk", {"text": live[sent:]}
+                    sent = len(live)
+                continue
+
+            job = self.store.get(job_id)
+            if job is None:
+                yield "error", {"error": "Job not found"}
+                return
+            if job["status"] in (DONE, ERROR):
+                if len(job["partial"]) > sent:
+                    yield "chunk", {"text": job["partial"][sent:]}
+                if job["status"] == DONE:
+                    yield "done", {"data": job["result"]}
+                else:
+                    yield "error", {"error": job["error"]}
+                return
+            if sent and (job["status"] == QUEUED or len(job["partial"]) < sent):
+                sent, status = 0, None  # requeued and started over: the queued status below resets the client
+                if job["status"] != QUEUED:
+                    yield "status", {"status": QUEUED}
+            if status != job["status"]:
+                status = job["status"]
+                last_event = time.monotonic()
+                yield "status", {"status": status}
+            # not running here: another server worker may run it, its output arrives with the flushes
+            if len(job["partial"]) > sent:
+                last_event = time.monotonic()
+                yield "chunk", {"text": job["partial"][sent:]}
+                sent = len(job["partial"])
+            elif time.monotonic() - last_event >= heartbeat:
+                last_event = time.monotonic()
+                yield "ping", {}
+            with self._changed:
+                if job_id not in self._partials:
+                    self._changed.wait(PARTIAL_FLUSH_SECONDS)
+
+    def depth(self):
+        return {QUEUED: self.store.count(QUEUED), RUNNING: self.store.count(RUNNING)}
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+
+def get_job_queue():
+    global _queue
+    with _queue_lock:
+        if _queue is None:
+            _queue = JobQueue()
+        return _queue
@@ -0,0 +1,406 @@
+import os
+import sys
+import json
+import time
+import uuid
+import atexit
+import bisect
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+from pathlib import Path
+
+#This file provide the operational surface of the app:
+# 1. counters, gauges and histograms rendered in the Prometheus text format (/metrics)
+# 2. stage(): times one step (fitz.open, span scan, render, split, text, Gemini call...), records
+#    it in arb_stage_seconds and writes a structured (JSON) log line
+# 3. the request id of the request being served, kept in a context variable so the stage lines
+#    of every module carry it; run_in_context() hands it over to worker threads and
+#    ARB_REQUEST_ID to subprocesses
+# 4. with several server processes (gunicorn, ARB_METRICS_DIR set) every process writes its
+#    values to <dir>/<pid>.json every few seconds and /metrics merges the files, in the spirit of
+#    the Prometheus multiprocess mode: counters and histograms add up over all processes, the
+#    exited ones included (the master folds them into archive.json, so totals survive a worker
+#    being recycled), gauges add up over live processes ("live"), over all of them ("all", for
+#    running totals kept by a subsystem) or take the largest value ("max", state every process
+#    reads from the same store)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+REQUEST_ID_HEADER = "X-Request-Id"
+REQUEST_ID_ENV = "ARB_REQUEST_ID"
+METRICS_DIR_ENV = "ARB_METRICS_DIR"
+FLUSH_SECONDS = float(os.environ.get("ARB_METRICS_FLUSH_SECONDS", 5))
+ARCHIVE_FILE = "archive.json"
+
+_request_id = contextvars.ContextVar("request_id", default=os.environ.get(REQUEST_ID_ENV))
+
+logger = logging.getLogger("arb")
+if not logger.handlers:
+    _handler = logging.StreamHandler(sys.stderr)
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(os.environ.get("ARB_LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def current_request_id():
+    return _request_id.get()
+
+
+def set_request_id(request_id):
+    """Make request_id current; returns the token to restore the previous one."""
+    return _request_id.set(request_id)
+
+
+def reset_request_id(token):
+    _request_id.reset(token)
+
+
+def run_in_context(fn):
+    """fn bound to the caller's context (request id included), for executor.submit()/map();
+    every call runs in its own copy, so the result can be called from several threads."""
+    ctx = contextvars.copy_context()
+    return lambda *args, **kwargs: ctx.copy().run(fn, *args, **kwargs)
+
+
+def log_event(event, **fields):
+    if logger.isEnabledFor(logging.INFO):
+        record = {"ts": round(time.time(), 3), "event": event, "requestId": current_request_id(), **fields}
+        logger.info(json.dumps(record, default=str, ensure_ascii=False))
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escape = lambda v: str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    pairs = (f'{n}="{escape(v)}"' for n, v in zip(names, values))
+    return "{" + ",".join(pairs) + "}"
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _merge(kind, mode, values):
+    """One value out of the values of several processes."""
+    if kind == "histogram":
+        counts = [sum(c) for c in zip(*(v[0] for v in values))]
+        return [counts, sum(v[1] for v in values), sum(v[2] for v in values)]
+    if mode == "max":
+        return max(values)
+    return sum(values)
+
+
+class _Metric:
+    kind = None
+    mode = "all"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """{label values tuple: value} of this process."""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, samples=None):
+        items = sorted((self.samples() if samples is None else samples).items())
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {v}" for k, v in items]
+
+    def _key(self, labels):
+        return tuple(str(labels.get(n, "")) for n in self.labelnames)
+
+    def header(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """Set/inc/dec by hand, or computed at scrape time by a callback returning {labels tuple: value};
+    mode says how the values of several processes merge (see the top of the file)."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), callback=None, mode="live"):
+        super().__init__(name, help, labelnames)
+        self.callback = callback
+        self.mode = mode
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    @contextmanager
+    def track(self, **labels):
+        """+1 while the block runs (in-flight work, running subprocesses)."""
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    def samples(self):
+        if self.callback is None:
+            return super().samples()
+        try:
+            values = self.callback()
+        except Exception:
+            values = {}  # a failing source must not break the whole scrape
+        return {tuple(str(x) for x in k): v for k, v in values.items() if v is not None}
+
+
+class Ratio(_Metric):
+    """Share of one label value in another metric's series (hits among hits + misses), computed
+    from that metric's values after the processes are merged."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help, source, numerator="hits"):
+        super().__init__(name, help)
+        self.source = source
+        self.numerator = numerator
+
+    def ratio(self, source_samples):
+        total = sum(source_samples.values())
+        return {(): round(source_samples.get((self.numerator,), 0) / total, 4)} if total else {}
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            return {k: [list(v[0]), v[1], v[2]] for k, v in self._values.items()}
+
+    def render(self, samples=None):
+        items = sorted((self.samples() if samples is None else samples).items())
+        lines = self.header()
+        names = self.labelnames + ("le",)
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                lines.append(f"{self.name}_bucket{_labels(names, key + (repr(float(bound)),))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(names, key + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, key)} {round(total, 6)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=(), callback=None, mode="live"):
+        return self.register(Gauge(name, help, labelnames, callback, mode))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def ratio(self, name, help, source, numerator="hits"):
+        return self.register(Ratio(name, help, source, numerator))
+
+    def _list(self):
+        with self._lock:
+            return list(self._metrics.values())
+
+    def snapshot(self):
+        """This process' values in the form written to the metrics directory."""
+        return {
+            m.name: {"kind": m.kind, "mode": m.mode, "values": [[list(k), v] for k, v in m.samples().items()]}
+            for m in self._list() if not isinstance(m, Ratio)
+        }
+
+    def write(self, directory):
+        target = Path(directory) / f"{os.getpid()}.json"
+        tmp = target.with_name(target.name + ".tmp")
+        tmp.write_text(json.dumps({"pid": os.getpid(), "metrics": self.snapshot()}))
+        os.replace(tmp, target)
+
+    def render(self):
+        directory = metrics_dir()
+        merged = None
+        if directory:
+            self.write(directory)  # this process' values as of now
+            merged = collect(directory)
+        lines = []
+        for metric in self._list():
+            if isinstance(metric, Ratio):
+                source = merged.get(metric.source, {}) if merged is not None else self._metrics[metric.source].samples()
+                lines.extend(metric.render(metric.ratio(source)))
+            else:
+                lines.extend(metric.render(None if merged is None else merged.get(metric.name, {})))
+        return "\n".join(lines) + "\n"
+
+
+def metrics_dir():
+    return os.environ.get(METRICS_DIR_ENV)
+
+
+def _read(path):
+    try:
+        return json.loads(path.read_text())
+    except (OSError, ValueError):
+        return None  # gone meanwhile (archived) or never completely written
+
+
+def collect(directory):
+    """{metric: {labels tuple: value}} merged over the process files and the archive."""
+    directory = Path(directory)
+    archive = _read(directory / ARCHIVE_FILE) or {"pids": [], "metrics": {}}
+    archived = set(archive["pids"])
+    sources = [(archive["metrics"], False)]
+    for path in directory.glob("*.json"):
+        if path.name == ARCHIVE_FILE:
+            continue
+        data = _read(path)
+        if data is not None and data["pid"] not in archived:
+            sources.append((data["metrics"], _alive(data["pid"])))
+    grouped = {}
+    for metrics, live in sources:
+        for name, metric in metrics.items():
+            if metric["mode"] != "all" and not live:
+                continue  # a live gauge of a process that is gone
+            series = grouped.setdefault(name, (metric["kind"], metric["mode"], {}))[2]
+            for key, value in metric["values"]:
+                series.setdefault(tuple(key), []).append(value)
+    return {
+        name: {key: _merge(kind, mode, values) for key, values in series.items()}
+        for name, (kind, mode, series) in grouped.items()
+    }
+
+
+def archive_process(pid, directory=None):
+    """Fold the totals of an exited process into archive.json (gunicorn child_exit, in the master)."""
+    directory = Path(directory or metrics_dir())
+    path = directory / f"{pid}.json"
+    data = _read(path)
+    if data is None:
+        return
+    archive = _read(directory / ARCHIVE_FILE) or {"pids": [], "metrics": {}}
+    for name, metric in data["metrics"].items():
+        if metric["mode"] != "all":
+            continue
+        target = archive["metrics"].setdefault(name, {"kind": metric["kind"], "mode": "all", "values": []})
+        values = {tuple(k): v for k, v in target["values"]}
+        for key, value in metric["values"]:
+            key = tuple(key)
+            values[key] = _merge(metric["kind"], "all", [values[key], value]) if key in values else value
+        target["values"] = [[list(k), v] for k, v in values.items()]
+    # the pid keeps its file out of the sums until the file is gone (a scrape in between)
+    archive["pids"] = [p for p in archive["pids"] if (directory / f"{p}.json").exists()] + [pid]
+    tmp = directory / (ARCHIVE_FILE + ".tmp")
+    tmp.write_text(json.dumps(archive))
+    os.replace(tmp, directory / ARCHIVE_FILE)
+    path.unlink(missing_ok=True)
+
+
+def start_multiprocess():
+    """Write this process' values to the metrics directory now, every FLUSH_SECONDS and at exit
+    (call it in every server worker, after the fork)."""
+    directory = metrics_dir()
+    if not directory:
+        return
+    Path(directory).mkdir(parents=True, exist_ok=True)
+
+    def flush():
+        try:
+            REGISTRY.write(directory)
+        except OSError:
+            pass  # next round
+
+    def loop():
+        while True:
+            time.sleep(FLUSH_SECONDS)
+            flush()
+
+    flush()
+    atexit.register(flush)
+    threading.Thread(target=loop, name="metrics-flush", daemon=True).start()
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("arb_stage_seconds", "Duration of processing stages", ("stage",))
+STAGE_ERRORS = REGISTRY.counter("arb_stage_errors_total", "Stages that raised", ("stage",))
+HTTP_SECONDS = REGISTRY.histogram(
+    "arb_http_request_duration_seconds", "Duration of HTTP requests by route", ("route", "method", "status")
+)
+HTTP_BYTES = REGISTRY.counter("arb_http_response_bytes_total", "Bytes of response bodies by route", ("route",))
+RENDERED_BYTES = REGISTRY.counter("arb_rendered_bytes_total", "Bytes of preview images rendered")
+SUBPROCESSES = REGISTRY.gauge("arb_subprocesses_running", "Subprocesses running, by command", ("command",))
+WORKERS_BUSY = REGISTRY.gauge("arb_worker_processes_running", "Pool worker processes running, by pool", ("pool",))
+
+
+@contextmanager
+def stage(name, **fields):
+    """Time the block as stage name: histogram + one structured log line (with the request id)."""
+    start = time.perf_counter()
+    error = None
+    try:
+        yield fields  # the block can add fields (sizes, counts) to its log line
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        if error is not None:
+            STAGE_ERRORS.inc(stage=name)
+            fields["error"] = type(error).__name__
+        log_event("stage", stage=name, ms=round(elapsed * 1000, 2), **fields)
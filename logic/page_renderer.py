@@ -0,0 +1,331 @@
+import os
+import io
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import fitz
+
+from logic.chapter_engine import get_engine
+from logic.blob_store import content_key
+from logic.epub_book import book_source_path, is_epub, open_epub
+from logic.metrics import stage, run_in_context, log_event, RENDERED_BYTES
+
+try:
+    from PIL import Image  # optional, only needed for WebP
+except ImportError:
+    Image = None
+
+#This file provide the page preview renderer used by /api/book-image:
+# 1. pages are rendered from the document pool of the chapter engine (one handle per book)
+# 2. the pages around the one being viewed are pre-rendered in background
+# 3. bookstore/booktemp/cache is kept under a byte budget with LRU eviction across books; the
+#    directory is the shared state of all server workers: file mtimes are the LRU order (a hit
+#    touches the file) and a worker past the budget sweeps the whole directory, so the cache
+#    overshoots the budget by at most what each worker writes between two sweeps
+# 4. previews come in variants (width, png/jpeg/webp, quality) and as thumbnail sprites
+# 5. an EPUB "page" is a section: only the sections asked for are laid out, on a miss
+
+CACHE_ROOT = Path("bookstore") / "booktemp" / "cache"
+CACHE_BUDGET = int(os.environ.get("PAGE_CACHE_BYTES", 256 * 1024 * 1024))
+SWEEP_TARGET = 0.9  # a sweep leaves the cache at 90% of the budget, so the next one is a while away
+PRERENDER_AHEAD = int(os.environ.get("PAGE_PRERENDER_AHEAD", 3))
+PRERENDER_BEHIND = int(os.environ.get("PAGE_PRERENDER_BEHIND", 1))
+RENDER_DPI = 150
+SIZE_PRESETS = {"thumb": 160, "medium": 600, "full": None}
+MAX_WIDTH = 2000
+MAX_SPRITE_PAGES = 100
+MIME_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "webp": "image/webp"}
+
+DEFAULT_VARIANT = {"width": None, "format": "png", "quality": None}
+
+
+def parse_variant(args):
+    """Variant from query args: size=thumb|medium|full or width=N, format=png|jpeg|webp, quality=1-100."""
+    size = args.get("size")
+    if size is not None and size not in SIZE_PRESETS:
+        raise ValueError(f"Unknown size '{size}' (use {', '.join(SIZE_PRESETS)})")
+    width = SIZE_PRESETS.get(size) if size else None
+    if args.get("width"):
+        width = int(args.get("width"))
+    if width is not None and not 16 <= width <= MAX_WIDTH:
+        raise ValueError(f"Width must be between 16 and {MAX_WIDTH}")
+
+    fmt = (args.get("format") or "png").lower().replace("jpg", "jpeg")
+    if fmt not in MIME_TYPES:
+        raise ValueError(f"Unknown format '{fmt}' (use png, jpeg or webp)")
+    if fmt == "webp" and Image is None:
+        fmt = "jpeg"  # Pillow not installed: closest lossy format fitz can write itself
+    quality = None
+    if fmt != "png":
+        quality = int(args.get("quality") or 80)
+        if not 1 <= quality <= 100:
+            raise ValueError("Quality must be between 1 and 100")
+    return {"width": width, "format": fmt, "quality": quality}
+
+
+def _variant_suffix(variant):
+    parts = ""
+    if variant["width"]:
+        parts += f"_w{variant['width']}"
+    if variant["quality"]:
+        parts += f"_q{variant['quality']}"
+    return f"{parts}.{'jpg' if variant['format'] == 'jpeg' else variant['format']}"
+
+
+def page_filename(page_number, variant=DEFAULT_VARIANT):
+    return f"page_{page_number:03d}{_variant_suffix(variant)}"
+
+
+def sprite_filename(start, end, columns, variant):
+    return f"sprite_{start:03d}-{end:03d}_c{columns}{_variant_suffix(variant)}"
+
+
+def mime_type(filename):
+    ext = filename.rsplit(".", 1)[-1]
+    return MIME_TYPES["jpeg" if ext == "jpg" else ext]
+
+
+def encode_pixmap(pix, variant):
+    if variant["format"] == "png":
+        return pix.tobytes("png")
+    if variant["format"] == "jpeg":
+        return pix.tobytes("jpeg", jpg_quality=variant["quality"])
+    image = Image.frombytes("RGB", (pix.width, pix.height), pix.samples)
+    buffer = io.BytesIO()
+    image.save(buffer, "WEBP", quality=variant["quality"])
+    return buffer.getvalue()
+
+
+def render_page(doc, page_number, variant):
+    page = doc.load_page(page_number - 1)
+    if variant["width"]:
+        scale = variant["width"] / page.rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+    else:
+        pix = page.get_pixmap(dpi=RENDER_DPI, alpha=False)
+    return encode_pixmap(pix, variant)
+
+
+def sprite_layout(start, end, columns, variant):
+    count = end - start + 1
+    columns = min(columns, count)
+    return {"columns": columns, "rows": -(-count // columns), "tileWidth": variant["width"] or SIZE_PRESETS["thumb"]}
+
+
+def render_sprite(doc, start, end, columns, variant):
+    """All pages start..end as tiles of one image, rendered in a single pass."""
+    layout = sprite_layout(start, end, columns, variant)
+    tile_w = layout["tileWidth"]
+    first = doc.load_page(start - 1).rect
+    tile_h = round(tile_w * first.height / first.width)
+    sheet = fitz.open()
+    try:
+        canvas = sheet.new_page(width=layout["columns"] * tile_w, height=layout["rows"] * tile_h)
+        canvas.draw_rect(canvas.rect, color=None, fill=(1, 1, 1))
+        for k in range(end - start + 1):
+            x, y = (k % layout["columns"]) * tile_w, (k // layout["columns"]) * tile_h
+            canvas.show_pdf_page(fitz.Rect(x, y, x + tile_w, y + tile_h), doc, start - 1 + k)
+        pix = canvas.get_pixmap(alpha=False)  # 72 dpi: one point per pixel
+    finally:
+        sheet.close()
+    return encode_pixmap(pix, variant)
+
+
+def _source_path(bookname):
+    path = book_source_path(bookname)
+    if path is None:
+        raise FileNotFoundError(f"File not found: {bookname}")
+    return path
+
+
+class PageRenderer:
+    def __init__(self, cache_root=CACHE_ROOT, budget=CACHE_BUDGET, workers=2):
+        self.cache_root = Path(cache_root)
+        self.budget = budget
+        # size of the cache directory at the last sweep + what this process wrote since
+        self._bytes = 0
+        self._files = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self._sweep_lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prerender")
+        self.counters = {"hits": 0, "misses": 0, "prerendered": 0, "prerenderFailed": 0, "evictions": 0, "bytesRendered": 0}
+        self._sweep()
+
+    def cache_path(self, bookname, filename):
+        # aliases of the same uploaded content share one preview directory
+        return self.cache_root / content_key(bookname) / filename
+
+    def get(self, bookname, page_number, variant=DEFAULT_VARIANT, prerender=True):
+        """Path of the cached image of page_number, rendering it first on a miss."""
+        filename = page_filename(page_number, variant)
+        path = self._lookup(bookname, filename, lambda doc: render_page(doc, page_number, variant), page_number, page_number)
+        if prerender:
+            self.prerender_around(bookname, page_number, variant)
+        return path
+
+    def get_sprite(self, bookname, start, end, columns=10, variant=None):
+        variant = variant or {"width": SIZE_PRESETS["thumb"], "format": "jpeg", "quality": 70}
+        if start < 1 or end < start or end - start + 1 > MAX_SPRITE_PAGES:
+            raise ValueError(f"Sprite range must cover 1-{MAX_SPRITE_PAGES} pages")
+        columns = max(1, columns)
+        filename = sprite_filename(start, end, columns, variant)
+        path = self._lookup(bookname, filename, lambda doc: render_sprite(doc, start, end, columns, variant), start, end)
+        return path, sprite_layout(start, end, columns, variant)
+
+    def _lookup(self, bookname, filename, render, first_page, last_page):
+        path = self.cache_path(bookname, filename)
+        try:
+            os.utime(path)  # most recently used, for the sweeps of every worker
+            hit = True
+        except FileNotFoundError:
+            hit = False
+        with self._lock:
+            self.counters["hits" if hit else "misses"] += 1
+        if not hit:
+            self._render_once(bookname, filename, render, first_page, last_page)
+        return path
+
+    def etag(self, bookname, filename):
+        """Strong validator: rendering is deterministic for a given source file and variant."""
+        st = os.stat(_source_path(bookname))
+        return hashlib.sha1(f"{st.st_size}:{st.st_mtime_ns}:{filename}".encode()).hexdigest()
+
+    def _render_once(self, bookname, filename, render, first_page, last_page):
+        key = (content_key(bookname), filename)
+        with self._lock:
+            event = self._inflight.get(key)
+            owner = event is None
+            if owner:
+                event = self._inflight[key] = threading.Event()
+        if not owner:
+            event.wait()
+            if self.cache_path(bookname, filename).exists():
+                return
+        try:
+            self._render(bookname, filename, render, first_page, last_page)
+        finally:
+            if owner:
+                with self._lock:
+                    self._inflight.pop(key, None)
+                event.set()
+
+    def _render(self, bookname, filename, render, first_page, last_page):
+        source = _source_path(bookname)
+        with stage("render", book=bookname, file=filename) as fields:
+            if is_epub(source):
+                with open_epub(source).preview_doc(first_page, last_page) as doc:
+                    data = render(doc)
+            else:
+                with get_engine().documents.borrow(source) as doc:
+                    if not 1 <= last_page <= len(doc):
+                        raise ValueError(f"Page number out of range (1-{len(doc)} requested {last_page})")
+                    data = render(doc)
+            fields["bytes"] = len(data)
+        RENDERED_BYTES.inc(len(data))
+        path = self.cache_path(bookname, filename)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_bytes(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self._bytes += len(data)
+            self._files += 1
+            self.counters["bytesRendered"] += len(data)
+            over = self._bytes > self.budget
+        if over:
+            self._sweep()
+
+    def _sweep(self):
+        """Measure the cache directory (written by every worker) and evict the least recently used
+        files down to SWEEP_TARGET of the budget; the newest file always stays."""
+        if not self._sweep_lock.acquire(blocking=False):
+            return  # another thread of this process is sweeping
+        try:
+            files = []
+            for f in self.cache_root.glob("*/*"):
+                if f.suffix == ".tmp":
+                    continue  # being written
+                try:
+                    st = f.stat()
+                except FileNotFoundError:
+                    continue  # evicted by another worker meanwhile
+                files.append((st.st_mtime_ns, st.st_size, f))
+            files.sort()
+            total, evicted = sum(size for _, size, _ in files), 0
+            if total > self.budget:
+                for _, size, f in files[:-1]:
+                    if total <= self.budget * SWEEP_TARGET:
+                        break
+                    f.unlink(missing_ok=True)
+                    total -= size
+                    evicted += 1
+            with self._lock:
+                self._bytes = total
+                self._files = len(files) - evicted
+                self.counters["evictions"] += evicted
+        finally:
+            self._sweep_lock.release()
+
+    def prerender_around(self, bookname, page_number, variant=DEFAULT_VARIANT):
+        if book_source_path(bookname) is None:
+            return
+        wanted = [page_number + d for d in range(1, PRERENDER_AHEAD + 1)]
+        wanted += [page_number - d for d in range(1, PRERENDER_BEHIND + 1)]
+        for p in wanted:
+            if p < 1:
+                continue
+            filename = page_filename(p, variant)
+            key = (content_key(bookname), filename)
+            with self._lock:
+                if key in self._inflight:
+                    continue
+            if self.cache_path(bookname, filename).exists():
+                continue
+            self._executor.submit(run_in_context(self._prerender), bookname, p, variant)
+
+    def _prerender(self, bookname, page_number, variant):
+        try:
+            filename = page_filename(page_number, variant)
+            self._render_once(
+                bookname, filename, lambda doc: render_page(doc, page_number, variant), page_number, page_number
+            )
+        except Exception as e:
+            # background work: counted and logged, the foreground request reports real errors
+            # (a ValueError is usually a page past the last one)
+            with self._lock:
+                self.counters["prerenderFailed"] += 1
+            log_event("prerender_failed", book=bookname, page=page_number, error=type(e).__name__, message=str(e))
+            return
+        with self._lock:
+            self.counters["prerendered"] += 1
+
+    def reset(self):
+        with self._lock:
+            self._bytes = 0
+            self._files = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters["hits"] + self.counters["misses"]
+            return {
+                **self.counters,
+                "hitRatio": round(self.counters["hits"] / lookups, 4) if lookups else None,
+                "entries": self._files,
+                "bytes": self._bytes,
+                "budget": self.budget,
+            }
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = PageRenderer()
+        return _renderer
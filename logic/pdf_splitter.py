@@ -1,49 +1,304 @@
 import sys, os, json, fitz
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic.generation_cache import get_generation_cache
+from logic.catalog import get_catalog, read_manifest, write_manifest, file_sha256, CHAPTER_FILE
+from logic.blob_store import alias_of
+from logic.text_store import page_texts, write_text_sidecar, sidecar_path
+from logic.virtual_chapters import SAVE_OPTIONS, source_pdf, chapter_hash, ensure_book_text
+from logic.epub_book import book_source_path, open_epub
+from logic.tokens import estimate_tokens
+from logic.metrics import stage, WORKERS_BUSY
+from logic.search_index import get_search_index
 
-def split_pdf_into_chapters(bookname, chapters_data):
+#This file provide the split of a book into chapter PDFs (+ their text sidecars).
+#Each chapter copies its page range in one insert_pdf call and is saved with garbage
+#collection and deflate, so chapters don't carry unused objects. Big books are split by a
+#process pool where every worker opens the source once and writes whole chapters.
+#With CHAPTER_STORAGE=virtual (or "virtual": true in the chapters JSON) no file is written:
+#chapters are page ranges of the source, built on demand by logic/virtual_chapters.py.
+#EPUB books are split by section ranges (logic/epub_book.py): each chapter is laid out to a PDF
+#once, here, and always written as a file.
+
+SPLIT_WORKERS = int(os.environ.get("CHAPTER_SPLIT_WORKERS", os.cpu_count() or 1))
+SPLIT_MIN_PAGES = int(os.environ.get("CHAPTER_SPLIT_MIN_PAGES", 300))
+VIRTUAL_CHAPTERS = os.environ.get("CHAPTER_STORAGE", "files") == "virtual"
+
+_source = None  # the book opened once per worker process
+
+
+def chapter_filename(n, title):
+    clean = "".join(c for c in title if c.isalnum() or c in " -_").strip().replace(" ", "_")
+    return f"cap{n}[{clean}].pdf"
+
+
+def save_chapter(chapter_doc, chapter_path):
+    # a reader never sees a half-written chapter: written aside, then renamed over the old one
+    tmp = chapter_path.with_name(chapter_path.name + ".tmp")
+    chapter_doc.save(tmp, **SAVE_OPTIONS)
+    os.replace(tmp, chapter_path)
+
+
+def write_chapter(doc, output_dir, ch):
+    n, title = ch["chapterNumber"], ch["title"]
+    start, end = ch["startPage"] - 1, min(ch["endPage"] - 1, len(doc) - 1)   # 0-based
+    filename = chapter_filename(n, title)
+    chapter_path = Path(output_dir) / filename
+    chapter_doc = fitz.open()
+    try:
+        chapter_doc.insert_pdf(doc, from_page=start, to_page=end)
+        save_chapter(chapter_doc, chapter_path)
+    finally:
+        chapter_doc.close()
+    # text extracted once here, generation reads it from the sidecar
+    texts = page_texts(doc, start, end)
+    write_text_sidecar(chapter_path, texts)
+    return {
+        "chapterNumber": n,
+        "title": title,
+        "filename": filename,
+        "path": str(chapter_path),
+        "startPage": ch["startPage"],
+        "endPage":   ch["endPage"],
+        "pageCount": ch["pageCount"],
+        "tokens": sum(estimate_tokens(t) for t in texts),
+    }
+
+
+def write_epub_chapter(book, output_dir, ch):
+    """Chapter of an EPUB: its sections laid out into one PDF, the sidecar holds one text per
+    section (the EPUB "pages" startPage..endPage count), read straight from the zip members."""
+    n, title = ch["chapterNumber"], ch["title"]
+    start, end = ch["startPage"], min(ch["endPage"], len(book))
+    filename = chapter_filename(n, title)
+    chapter_path = Path(output_dir) / filename
+    chapter_doc = book.chapter_pdf(start, end)
+    try:
+        save_chapter(chapter_doc, chapter_path)
+    finally:
+        chapter_doc.close()
+    texts = [book.section_text(i) for i in range(start - 1, end)]
+    write_text_sidecar(chapter_path, texts)
+    return {
+        "chapterNumber": n,
+        "title": title,
+        "filename": filename,
+        "path": str(chapter_path),
+        "startPage": ch["startPage"],
+        "endPage":   ch["endPage"],
+        "pageCount": ch["pageCount"],
+        "tokens": sum(estimate_tokens(t) for t in texts),
+    }
+
+
+def _open_source(pdf_path):
+    global _source
+    _source = fitz.open(pdf_path)
+
+
+def _write_chapter_in_worker(output_dir, ch):
+    return write_chapter(_source, output_dir, ch)
+
+
+def write_chapters_parallel(pdf_path, output_dir, chapters, workers):
+    # spawn: same reason as the span scan, the caller may have threads running
+    context = multiprocessing.get_context("spawn")
+    WORKERS_BUSY.inc(workers, pool="split")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                 initializer=_open_source, initargs=(str(pdf_path),)) as pool:
+            # longest chapters first so the last one to finish is a short one
+            order = sorted(chapters, key=lambda ch: ch["endPage"] - ch["startPage"], reverse=True)
+            futures = {id(ch): pool.submit(_write_chapter_in_worker, str(output_dir), ch) for ch in order}
+            return [futures[id(ch)].result() for ch in chapters]
+    finally:
+        WORKERS_BUSY.dec(workers, pool="split")
+
+
+def virtual_chapter(source_sha256, ch, tokens=None):
+    n, title = ch["chapterNumber"], ch["title"]
+    return {
+        "chapterNumber": n,
+        "title": title,
+        "filename": chapter_filename(n, title),
+        "startPage": ch["startPage"],
+        "endPage":   ch["endPage"],
+        "pageCount": ch["pageCount"],
+        "virtual": True,
+        "sha256": chapter_hash(source_sha256, ch["startPage"], ch["endPage"]),
+        "tokens": tokens,
+    }
+
+
+def plan_split(previous, source_hash, chapters, virtual, output_dir):
+    """(kept, build): chapters an earlier split of the same source already produced, paired with
+    their manifest entry (same page range and storage, possibly another number or title), and the
+    chapters to build."""
+    old = {}
+    if previous and source_hash and previous.get("source") == source_hash:
+        for entry in previous.get("chapters", []):
+            old.setdefault((entry["startPage"], entry["endPage"], bool(entry.get("virtual"))), entry)
+    kept, build = [], []
+    for ch in chapters:
+        entry = old.pop((ch["startPage"], ch["endPage"], bool(virtual)), None)
+        if entry is not None and (virtual or (Path(output_dir) / entry["filename"]).exists()):
+            kept.append((ch, entry))
+        else:
+            build.append(ch)
+    return kept, build
+
+
+def _staged(output_dir, filename):
+    return Path(output_dir) / f"{filename}.keep", Path(output_dir) / f"{filename}.keep.text"
+
+
+def stage_renames(output_dir, renames):
+    """Move kept chapters out of the way first: their new name may belong to a chapter being rebuilt."""
+    for old_name, new_name in renames.items():
+        pdf, text = _staged(output_dir, new_name)
+        os.replace(Path(output_dir) / old_name, pdf)
+        if sidecar_path(Path(output_dir) / old_name).exists():
+            os.replace(sidecar_path(Path(output_dir) / old_name), text)
+
+
+def finish_renames(output_dir, renames):
+    # os.replace keeps size and mtime, so the sidecars still match their PDF
+    for new_name in renames.values():
+        pdf, text = _staged(output_dir, new_name)
+        os.replace(pdf, Path(output_dir) / new_name)
+        if text.exists():
+            os.replace(text, sidecar_path(Path(output_dir) / new_name))
+
+
+def remove_stale(output_dir, keep):
+    """Delete chapter files (and sidecars, leftovers of interrupted writes) not in keep."""
+    removed = []
+    for f in sorted(Path(output_dir).iterdir()):
+        if CHAPTER_FILE.match(f.name) and f.name not in keep:
+            f.unlink()
+            sidecar_path(f).unlink(missing_ok=True)
+            removed.append(f.name)
+        elif f.name.endswith((".tmp", ".keep", ".keep.text")):  # a staged sidecar's suffix is .text
+            f.unlink()
+    return removed
+
+
+def split_pdf_into_chapters(bookname, chapters_data, workers=None, virtual=None):
+    """Split bookname into chapters_data["chapters"], reusing what an earlier split of the same
+    source left in its directory: chapters with an unchanged page range are kept (renamed if their
+    number or title changed), only new or changed ones are written, stale files are removed."""
     try:
         pdf_path   = Path("bookstore") / "booktemp"     / f"{bookname}.pdf"
         output_dir = Path("bookstore") / "elaboratebook" /  bookname
+        epub = None if pdf_path.exists() else book_source_path(bookname)
 
-        if not pdf_path.exists():
+        virtual = chapters_data.get("virtual", VIRTUAL_CHAPTERS) if virtual is None else virtual
+        source = source_pdf(bookname) if virtual else None
+        if virtual and source is None:
+            # not in the blob store (uploaded before it existed) or an EPUB: write files
+            virtual = False
+        if not virtual and not pdf_path.exists() and epub is None:
             raise FileNotFoundError(f"PDF not found: {pdf_path}")
 
         output_dir.mkdir(parents=True, exist_ok=True)
-        doc = fitz.open(pdf_path)
-
-        created = []
-        for ch in chapters_data.get("chapters", []):
-            n, title = ch["chapterNumber"], ch["title"]
-            start, end = ch["startPage"] - 1, ch["endPage"] - 1   # 0-based
-            clean = "".join(c for c in title if c.isalnum() or c in " -_").strip().replace(" ", "_")
-            chapter_doc = fitz.open()
-            for p in range(start, end + 1):
-                if p < len(doc):
-                    chapter_doc.insert_pdf(doc, from_page=p, to_page=p)
-            filename = f"cap{n}[{clean}].pdf"
-            chapter_path = output_dir / filename
-            chapter_doc.save(chapter_path)
-            chapter_doc.close()
-            created.append({
-                "chapterNumber": n,
-                "title": title,
+        workers = SPLIT_WORKERS if workers is None else workers
+        chapters = chapters_data.get("chapters", [])
+        alias = alias_of(bookname) or {}
+        # books uploaded before the blob store have no alias: hash the file itself
+        source_hash = alias.get("sha256") or file_sha256(pdf_path if epub is None else epub)
+        catalog = get_catalog()
+        kept, build = plan_split(read_manifest(output_dir), source_hash, chapters, virtual, output_dir)
+
+        renames, reused = {}, []
+        for ch, entry in kept:
+            filename = chapter_filename(ch["chapterNumber"], ch["title"])
+            if not virtual and filename != entry["filename"]:
+                renames[entry["filename"]] = filename
+            row = None if virtual else catalog.chapter_by_filename(bookname, entry["filename"])
+            reused.append({
+                **entry,
+                "chapterNumber": ch["chapterNumber"],
+                "title": ch["title"],
                 "filename": filename,
-                "path": str(chapter_path),
-                "startPage": ch["startPage"],
-                "endPage":   ch["endPage"],
+                "path": str(output_dir / filename),
                 "pageCount": ch["pageCount"],
+                # the file is unchanged: no need to hash it again
+                "sha256": entry.get("sha256") or (row["sha256"] if row else None),
             })
 
-        doc.close()
+        with stage("split", book=bookname, chapters=len(chapters), rebuilt=len(build)) as fields:
+            stage_renames(output_dir, renames)
+            if virtual:
+                # chapter texts are read from the book's sidecar
+                with ensure_book_text(source) as sidecar:
+                    built = [
+                        virtual_chapter(alias["sha256"], ch, sum(
+                            estimate_tokens(sidecar.page(i))
+                            for i in range(ch["startPage"] - 1, min(ch["endPage"], sidecar.page_count))
+                        ))
+                        for ch in build
+                    ]
+                for c in built:
+                    c["path"] = str(output_dir / c["filename"])
+            elif not build:
+                built = []
+            elif epub is not None:
+                book = open_epub(epub)
+                built = [write_epub_chapter(book, output_dir, ch) for ch in build]
+            else:
+                doc = fitz.open(pdf_path)
+                try:
+                    if workers > 1 and len(build) > 1 and len(doc) >= SPLIT_MIN_PAGES:
+                        built = write_chapters_parallel(pdf_path, output_dir, build, min(workers, len(build)))
+                    else:
+                        built = [write_chapter(doc, output_dir, ch) for ch in build]
+                finally:
+                    doc.close()
+            finish_renames(output_dir, renames)
+            # virtual chapters have no file: one left by an earlier split would shadow the range
+            files = set() if virtual else {c["filename"] for c in built + reused}
+            removed = remove_stale(output_dir, files)
+            fields["mode"] = "virtual" if virtual else "epub" if epub is not None else "pdf"
+
+        created = sorted(built + reused, key=lambda c: c["chapterNumber"])
+        # results generated from the previous version of these files are stale now
+        get_generation_cache().invalidate_paths(
+            [c["path"] for c in built]
+            + [str(output_dir / name) for name in removed]
+            + [str(output_dir / name) for pair in renames.items() for name in pair]
+        )
+        catalog.add_chapters(
+            bookname, created, title=alias.get("title"), author=alias.get("author"), sha256=alias.get("sha256")
+        )
+        catalog.prune_chapters(bookname, [c["chapterNumber"] for c in created])
+        write_manifest(output_dir, {
+            "source": source_hash,
+            "chapters": [{k: v for k, v in c.items() if k != "path"} for c in created],
+        })
+        try:
+            # only the chapters written now are read: kept ones are already indexed
+            searchable = get_search_index().index_book(bookname)
+        except Exception as e:  # the split is done: a search index problem must not undo it
+            searchable = {"status": "error", "message": str(e)}
         return {
             "status": "success",
             "bookname": bookname,
             "outputDirectory": str(output_dir),
             "totalChapters": len(created),
             "createdFiles": created,
-            "message": f"PDF split into {len(created)} chapters",
+            "virtual": virtual,
+            "diff": {
+                "created": [c["filename"] for c in built],
+                "kept": [c["filename"] for c in reused],
+                "renamed": {new: old for old, new in renames.items()},
+                "removed": removed,
+            },
+            "searchIndex": searchable,
+            "message": f"PDF split into {len(created)} {'virtual ' if virtual else ''}chapters "
+                       f"({len(built)} written, {len(reused)} kept, {len(removed)} removed)",
         }
 
     except Exception as e:
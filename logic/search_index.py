@@ -0,0 +1,223 @@
+import re
+import sys
+import html
+import json
+import sqlite3
+import argparse
+import threading
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from logic.catalog import get_catalog
+from logic.gemini_generation import chapter_pages
+from logic.metrics import stage
+
+#This file provide the full-text search over the processed books (bookstore/search.sqlite):
+#an SQLite FTS5 inverted index with one row per chapter page, filled from the text sidecars
+#right after a split, so a query never opens a PDF. Pages are keyed by the chapter's sha256:
+#a re-split only indexes the chapters whose content changed, renamed/renumbered ones just get
+#their new number and filename. Hits are ranked by bm25 and come with a highlighted snippet.
+#
+# rebuild from the catalog: python logic/search_index.py --rebuild
+# query:                    python logic/search_index.py "il piccolo principe" [--book name]
+
+SEARCH_DB = Path("bookstore") / "search.sqlite"
+SEARCH_PAGE_SIZE = 20
+SNIPPET_TOKENS = 16
+# control characters never found in page text: the snippet is escaped, then they become <mark>
+_MARK_OPEN, _MARK_CLOSE = "\x02", "\x03"
+_TERM = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def fts_query(query):
+    """User input -> FTS5 query: words AND-ed, "quoted phrases" kept, a trailing * is a prefix."""
+    terms = []
+    for phrase, word in _TERM.findall(query):
+        if phrase:
+            words = re.findall(r"\w+", phrase)
+            if words:
+                terms.append('"' + " ".join(words) + '"')
+            continue
+        parts = re.findall(r"\w+", word)
+        if parts:
+            terms.extend(f'"{part}"' for part in parts)
+            if word.endswith("*"):
+                terms[-1] += "*"
+    return " ".join(terms)
+
+
+def chapter_key(row):
+    # chapters split before hashing have no sha256: their file identity is the next best thing
+    return row["sha256"] or f"{row['filename']}@{row['size']}"
+
+
+class SearchIndex:
+    def __init__(self, db_path=SEARCH_DB):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS chapters (
+                    book TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    number INTEGER NOT NULL,
+                    title TEXT,
+                    filename TEXT NOT NULL,
+                    PRIMARY KEY (book, key)
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS pages USING fts5(
+                    text, book UNINDEXED, key UNINDEXED, page UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                );
+                """
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.db_path, timeout=30)
+
+    # -- writes ---------------------------------------------------------------
+
+    def index_book(self, book, rows=None):
+        """Bring the pages of book in line with its catalogued chapters (rows): pages of chapters
+        that are gone are dropped, new chapters are read from their sidecars, the others kept."""
+        if rows is None:
+            rows = get_catalog().chapters(book)[0]
+        book_dir = Path("bookstore") / "elaboratebook" / book
+        current = {chapter_key(row): row for row in rows}
+        with stage("search_index", book=book, chapters=len(rows)) as fields:
+            with self._connect() as conn:
+                indexed = {key for (key,) in conn.execute("SELECT key FROM chapters WHERE book = ?", (book,))}
+            # read the new texts before taking the lock: virtual chapters may extract the whole book
+            added, failed = {}, []
+            for key in current.keys() - indexed:
+                row = current[key]
+                try:
+                    added[key] = chapter_pages(book, book_dir / row["filename"], row)
+                except (OSError, ValueError) as e:
+                    failed.append({"filename": row["filename"], "message": str(e)})
+            stale = indexed - current.keys()
+            with self._lock, self._connect() as conn:
+                for key in stale:
+                    conn.execute("DELETE FROM pages WHERE book = ? AND key = ?", (book, key))
+                conn.executemany(
+                    "INSERT INTO pages (text, book, key, page) VALUES (?, ?, ?, ?)",
+                    [(text, book, key, i + 1) for key, texts in added.items() for i, text in enumerate(texts) if text.strip()],
+                )
+                conn.execute("DELETE FROM chapters WHERE book = ?", (book,))
+                conn.executemany(
+                    "INSERT INTO chapters (book, key, number, title, filename) VALUES (?, ?, ?, ?, ?)",
+                    [(book, key, row["number"], row["title"], row["filename"])
+                     for key, row in current.items() if key in indexed or key in added],
+                )
+            fields.update(added=len(added), removed=len(stale), pages=sum(len(t) for t in added.values()))
+        return {
+            "status": "success" if not failed else "partial",
+            "book": book,
+            "added": len(added),
+            "kept": len(current) - len(added) - len(failed),
+            "removed": len(stale),
+            "failed": failed,
+        }
+
+    def remove_book(self, book):
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM pages WHERE book = ?", (book,))
+            return conn.execute("DELETE FROM chapters WHERE book = ?", (book,)).rowcount > 0
+
+    def rebuild(self):
+        """Index every catalogued book from scratch."""
+        with self._lock, self._connect() as conn:
+            conn.execute("DELETE FROM pages")
+            conn.execute("DELETE FROM chapters")
+        catalog = get_catalog()
+        books, _ = catalog.books()
+        counts = {"books": 0, "chapters": 0, "failed": 0}
+        for book in books:
+            result = self.index_book(book["name"])
+            counts["books"] += 1
+            counts["chapters"] += result["added"]
+            counts["failed"] += len(result["failed"])
+        with self._lock, self._connect() as conn:
+            conn.execute("INSERT INTO pages (pages) VALUES ('optimize')")
+        return counts
+
+    # -- reads ----------------------------------------------------------------
+
+    def search(self, query, book=None, limit=SEARCH_PAGE_SIZE, offset=0):
+        """(hits, total) for query, best first. Raises ValueError on a query with no words."""
+        match = fts_query(query)
+        if not match:
+            raise ValueError("Query has no searchable words")
+        where = "pages MATCH ?" + (" AND pages.book = ?" if book else "")
+        params = (match, book) if book else (match,)
+        with stage("search", book=book) as fields, self._connect() as conn:
+            total = conn.execute(f"SELECT COUNT(*) FROM pages WHERE {where}", params).fetchone()[0]
+            conn.row_factory = sqlite3.Row
+            rows = conn.execute(
+                "SELECT pages.book, pages.page, c.number, c.title, c.filename, bm25(pages) AS score, "
+                f"snippet(pages, 0, ?, ?, '…', {SNIPPET_TOKENS}) AS snippet "
+                "FROM pages JOIN chapters c ON c.book = pages.book AND c.key = pages.key "
+                f"WHERE {where} ORDER BY score LIMIT ? OFFSET ?",
+                (_MARK_OPEN, _MARK_CLOSE, *params, limit, offset),
+            ).fetchall()
+            fields.update(total=total, hits=len(rows))
+        hits = [
+            {
+                "book": row["book"],
+                "chapterNumber": row["number"],
+                "title": row["title"],
+                "filename": row["filename"],
+                "page": row["page"],
+                "score": round(-row["score"], 4),  # bm25 is lower-is-better
+                "snippet": html.escape(row["snippet"]).replace(_MARK_OPEN, "<mark>").replace(_MARK_CLOSE, "</mark>"),
+            }
+            for row in rows
+        ]
+        return hits, total
+
+    def stats(self):
+        with self._connect() as conn:
+            return {
+                "books": conn.execute("SELECT COUNT(DISTINCT book) FROM chapters").fetchone()[0],
+                "chapters": conn.execute("SELECT COUNT(*) FROM chapters").fetchone()[0],
+                "pages": conn.execute("SELECT COUNT(*) FROM pages").fetchone()[0],
+            }
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+
+
+def get_search_index():
+    global _search_index
+    with _search_index_lock:
+        if _search_index is None:
+            _search_index = SearchIndex()
+        return _search_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Full-text search over the processed books")
+    parser.add_argument("query", nargs="?")
+    parser.add_argument("--book")
+    parser.add_argument("--limit", type=int, default=SEARCH_PAGE_SIZE)
+    parser.add_argument("--rebuild", action="store_true", help="index every book of the catalog again")
+    args = parser.parse_args()
+    index = SearchIndex()
+    if args.rebuild:
+        print(json.dumps({"status": "success", **index.rebuild()}))
+    elif args.query:
+        try:
+            hits, total = index.search(args.query, args.book, args.limit)
+        except (ValueError, sqlite3.OperationalError) as e:
+            print(json.dumps({"status": "error", "message": str(e)}))
+            sys.exit(1)
+        print(json.dumps({"status": "success", "total": total, "hits": hits}, ensure_ascii=False, indent=2))
+    else:
+        print(json.dumps({"status": "success", **index.stats()}))
+
+
+if __name__ == "__main__":
+    main()
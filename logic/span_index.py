@@ -0,0 +1,238 @@
+import os
+import json
+import zlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+import fitz
+
+from logic.blob_store import artifact_path
+from logic.metrics import stage, WORKERS_BUSY
+
+#This file provide the span index of a book: one pass over get_text("dict"), stored in columns
+#next to the PDF (<bookname>.spans, or <sha256>.spans next to the blob of an uploaded book). For every page and every (font, size) pair it keeps the
+#number of spans and the first text, which is all find_max_font / find_chapter_pages need.
+
+INDEX_VERSION = 1
+SCAN_WORKERS = int(os.environ.get("CHAPTER_SCAN_WORKERS", os.cpu_count() or 1))
+SCAN_MIN_PAGES = int(os.environ.get("CHAPTER_SCAN_MIN_PAGES", 300))
+_MEMORY_SLOTS = 8
+
+_memory = OrderedDict()
+_memory_lock = threading.Lock()
+_build_locks = {}
+
+
+def index_path(pdf_path):
+    return artifact_path(pdf_path, ".spans")
+
+
+def _source_stamp(pdf_path):
+    st = os.stat(pdf_path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+class SpanIndex:
+    def __init__(self, columns):
+        self.page_count = columns["pageCount"]
+        self.fonts = columns["fonts"]
+        self.pages = columns["page"]
+        self.font_ids = columns["font"]
+        self.sizes = columns["size"]
+        self.counts = columns["count"]
+        self.texts = columns["text"]
+
+    def _rows(self, page_number):
+        return range(bisect_left(self.pages, page_number), bisect_right(self.pages, page_number))
+
+    def max_font(self, page_number):
+        rows = self._rows(page_number)
+        if not rows:
+            return None, None
+        max_size = max(self.sizes[r] for r in rows)
+        counts = {}
+        for r in rows:
+            if self.sizes[r] == max_size:
+                font = self.fonts[self.font_ids[r]]
+                counts[font] = counts.get(font, 0) + self.counts[r]
+        # ties go to the font seen first on the page, like Counter.most_common
+        best = max(counts.values())
+        common_font = next(f for f, c in counts.items() if c == best)
+        return common_font, max_size
+
+    def chapter_pages(self, target_font, target_size):
+        if target_font not in self.fonts:
+            return [], []
+        font_id = self.fonts.index(target_font)
+        found_pages, found_titles = [], []
+        for r in range(len(self.pages)):
+            if self.font_ids[r] == font_id and self.sizes[r] == target_size:
+                if not found_pages or found_pages[-1] != self.pages[r]:
+                    found_pages.append(self.pages[r])
+                    found_titles.append(self.texts[r])
+        return found_pages, found_titles
+
+
+def scan_pages(doc, start, end):
+    """Rows for pages [start, end) in (page, font, size, count, text) form."""
+    rows = []
+    for i in range(start, end):
+        seen = {}
+        content = doc.load_page(i).get_text("dict")
+        for block in content["blocks"]:
+            for line in block.get("lines", []):
+                for span in line.get("spans", []):
+                    text = span["text"].strip()
+                    if not text:
+                        continue
+                    key = (span["font"], span["size"])
+                    if key in seen:
+                        seen[key][3] += 1
+                    else:
+                        seen[key] = [i + 1, span["font"], span["size"], 1, text]
+        rows.extend(seen.values())
+    return rows
+
+
+def _scan_shard(pdf_path, start, end):
+    doc = fitz.open(pdf_path)
+    try:
+        return scan_pages(doc, start, end)
+    finally:
+        doc.close()
+
+
+def plan_shards(page_count, workers):
+    # a few shards per worker so one slow (image heavy) range doesn't stall the others
+    shard_count = min(page_count, workers * 4)
+    bounds = [page_count * k // shard_count for k in range(shard_count + 1)]
+    return [(bounds[k], bounds[k + 1]) for k in range(shard_count) if bounds[k] < bounds[k + 1]]
+
+
+def scan_pages_parallel(pdf_path, page_count, workers=None):
+    """Scan the whole book split across a process pool, each worker with its own fitz handle."""
+    workers = SCAN_WORKERS if workers is None else workers
+    shards = plan_shards(page_count, workers)
+    # spawn: the Flask process has threads (engine, renderer) that fork would copy mid-flight
+    busy = min(workers, len(shards))
+    WORKERS_BUSY.inc(busy, pool="span_scan")
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = [pool.submit(_scan_shard, str(pdf_path), start, end) for start, end in shards]
+            rows = []
+            for future in futures:  # shards are already in page order
+                rows.extend(future.result())
+    finally:
+        WORKERS_BUSY.dec(busy, pool="span_scan")
+    return rows
+
+
+def _columns_from_rows(rows, page_count, stamp):
+    fonts, font_ids = [], {}
+    columns = {
+        "version": INDEX_VERSION,
+        "source": stamp,
+        "pageCount": page_count,
+        "fonts": fonts,
+        "page": [],
+        "font": [],
+        "size": [],
+        "count": [],
+        "text": [],
+    }
+    for page, font, size, count, text in rows:
+        if font not in font_ids:
+            font_ids[font] = len(fonts)
+            fonts.append(font)
+        columns["page"].append(page)
+        columns["font"].append(font_ids[font])
+        columns["size"].append(size)
+        columns["count"].append(count)
+        columns["text"].append(text)
+    return columns
+
+
+def build_span_index(pdf_path, doc=None, workers=None):
+    workers = SCAN_WORKERS if workers is None else workers
+    own_doc = doc is None
+    if own_doc:
+        doc = fitz.open(str(pdf_path))
+    try:
+        stamp = _source_stamp(pdf_path)
+        page_count = len(doc)
+        with stage("span_scan", file=os.path.basename(str(pdf_path)), pages=page_count) as fields:
+            if workers > 1 and page_count >= SCAN_MIN_PAGES:
+                fields["workers"] = workers
+                rows = scan_pages_parallel(pdf_path, page_count, workers)
+            else:
+                rows = scan_pages(doc, 0, page_count)
+            fields["spans"] = len(rows)
+        columns = _columns_from_rows(rows, page_count, stamp)
+    finally:
+        if own_doc:
+            doc.close()
+    _save(pdf_path, columns)
+    return SpanIndex(columns)
+
+
+def _save(pdf_path, columns):
+    target = index_path(pdf_path)
+    tmp = target.with_name(target.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(zlib.compress(json.dumps(columns, separators=(",", ":")).encode("utf-8"), 6))
+    os.replace(tmp, target)
+    _remember(str(pdf_path), columns)
+
+
+def _remember(key, columns):
+    with _memory_lock:
+        _memory[key] = columns
+        _memory.move_to_end(key)
+        while len(_memory) > _MEMORY_SLOTS:
+            _memory.popitem(last=False)
+
+
+def load_span_index(pdf_path):
+    """Index for pdf_path if it exists and matches the file on disk, else None."""
+    stamp = _source_stamp(pdf_path)
+    with _memory_lock:
+        columns = _memory.get(str(pdf_path))
+    if columns is None or columns["source"] != stamp:
+        target = index_path(pdf_path)
+        if not target.exists():
+            return None
+        try:
+            with open(target, "rb") as f:
+                columns = json.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, zlib.error):
+            return None
+        if columns.get("version") != INDEX_VERSION or columns.get("source") != stamp:
+            return None
+        _remember(str(pdf_path), columns)
+    return SpanIndex(columns)
+
+
+def get_span_index(pdf_path, doc=None):
+    """Load the index of pdf_path, building it (once, even with concurrent callers) if missing."""
+    key = str(pdf_path)
+    with _memory_lock:
+        lock = _build_locks.setdefault(key, threading.Lock())
+    with lock:
+        index = load_span_index(pdf_path)
+        if index is None:
+            index = build_span_index(pdf_path, doc)
+    # the index is on disk now: a later caller with a fresh lock just loads it. After a failed
+    # build the lock stays, so the next attempts still go one at a time
+    with _memory_lock:
+        if _build_locks.get(key) is lock:
+            del _build_locks[key]
+    return index
+
+
+def discard_span_index(pdf_path):
+    with _memory_lock:
+        _memory.pop(str(pdf_path), None)
+    index_path(pdf_path).unlink(missing_ok=True)
@@ -0,0 +1,159 @@
+import os
+import re
+import gzip
+import json
+import hashlib
+import argparse
+import mimetypes
+import threading
+from pathlib import Path
+
+from flask import request, send_from_directory
+from werkzeug.exceptions import NotFound
+from werkzeug.security import safe_join
+
+try:
+    import brotli  # optional, gzip only without it
+except ImportError:
+    brotli = None
+
+#This file provide the delivery of frontend/ and assets/:
+# 1. JS/CSS/HTML/SVG are precompressed once next to the source (.gz, and .br with brotli)
+#    and the variant the browser accepts is served with Vary: Accept-Encoding
+# 2. every asset has a content hash; index.html links CSS/JS as <file>?v=<hash> and a request
+#    carrying the current hash gets an immutable one-year cache, the rest revalidates (ETag/304)
+#
+# build ahead of a deploy: python logic/static_assets.py
+
+COMPRESSIBLE = {".js", ".css", ".html", ".svg", ".json", ".txt"}
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+VERSIONED_LINK = re.compile(r'(href|src)="((?:styles|js)/[^"?#]+\.(?:css|js))"')
+
+
+def _compress(path, encoding, suffix):
+    target = path.with_name(path.name + suffix)
+    data = path.read_bytes()
+    if encoding == "br":
+        out = brotli.compress(data, quality=11)
+    else:
+        out = gzip.compress(data, compresslevel=9, mtime=0)
+    if len(out) >= len(data):
+        target.unlink(missing_ok=True)  # not worth it, the identity file is served
+        return None
+    tmp = target.with_name(target.name + ".tmp")
+    tmp.write_bytes(out)
+    os.replace(tmp, target)
+    return target
+
+
+class AssetStore:
+    def __init__(self, root):
+        self.root = Path(root)
+        self._entries = {}  # relative path -> {"stamp", "hash", "encodings"}
+        self._lock = threading.Lock()
+
+    def _encodings(self):
+        return [(name, suffix) for name, suffix in ENCODINGS if name != "br" or brotli is not None]
+
+    def _build(self, rel, path, st):
+        digest = hashlib.sha256(path.read_bytes()).hexdigest()[:12]
+        encodings = {}
+        if path.suffix in COMPRESSIBLE:
+            for name, suffix in self._encodings():
+                variant = path.with_name(path.name + suffix)
+                fresh = variant.exists() and variant.stat().st_mtime_ns >= st.st_mtime_ns
+                if fresh or _compress(path, name, suffix):
+                    encodings[name] = variant.name
+        entry = {"stamp": (st.st_size, st.st_mtime_ns), "hash": digest, "encodings": encodings}
+        self._entries[rel] = entry
+        return entry
+
+    def entry(self, rel):
+        """Hash and compressed variants of root/rel, rebuilt when the file changed on disk."""
+        joined = safe_join(str(self.root), rel)
+        if joined is None or not os.path.isfile(joined):
+            raise NotFound()
+        path = Path(joined)
+        st = path.stat()
+        with self._lock:
+            entry = self._entries.get(rel)
+            if entry is None or entry["stamp"] != (st.st_size, st.st_mtime_ns):
+                entry = self._build(rel, path, st)
+            return entry
+
+    def build_all(self):
+        files = [
+            f for f in self.root.rglob("*")
+            if f.is_file() and f.suffix not in {".gz", ".br", ".tmp"}
+        ]
+        for f in files:
+            self.entry(f.relative_to(self.root).as_posix())
+        with self._lock:
+            return {
+                "files": len(files),
+                "compressed": sum(1 for e in self._entries.values() if e["encodings"]),
+                "brotli": brotli is not None,
+            }
+
+    def version(self, rel):
+        return self.entry(rel)["hash"]
+
+    def render_index(self, filename="index.html"):
+        """index.html with its CSS/JS links versioned by content hash."""
+        html = (self.root / filename).read_text(encoding="utf-8")
+        return VERSIONED_LINK.sub(
+            lambda m: f'{m.group(1)}="{m.group(2)}?v={self.version(m.group(2))}"'
+            if (self.root / m.group(2)).exists() else m.group(0),
+            html,
+        )
+
+    def send(self, rel):
+        """Response for root/rel: best accepted encoding, conditional and range aware."""
+        entry = self.entry(rel)
+        accepted = request.accept_encodings
+        filename = rel
+        encoding = None
+        for name, _ in self._encodings():
+            if name in entry["encodings"] and accepted[name]:
+                encoding = name
+                filename = str(Path(rel).parent / entry["encodings"][name])
+                break
+        mimetype = mimetypes.guess_type(rel)[0] or "application/octet-stream"
+        immutable = request.args.get("v") == entry["hash"]
+        response = send_from_directory(
+            self.root.resolve(), filename, mimetype=mimetype, max_age=IMMUTABLE_MAX_AGE if immutable else None
+        )
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+            response.headers.pop("Content-Disposition", None)  # would name the .gz/.br file
+        if entry["encodings"]:
+            response.vary.add("Accept-Encoding")
+        if immutable:
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def get_asset_store(root):
+    root = str(root)
+    with _stores_lock:
+        if root not in _stores:
+            _stores[root] = AssetStore(root)
+        return _stores[root]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Precompress and hash the static assets")
+    parser.add_argument("roots", nargs="*", default=["frontend", "assets"])
+    args = parser.parse_args()
+    print(json.dumps({root: AssetStore(root).build_all() for root in args.roots}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+import mmap
+import zlib
+import struct
+from pathlib import Path
+
+#This file provide the text sidecar of a chapter PDF (<chapter>.text, next to the PDF).
+#Written once by the splitter, it holds the text of every page compressed on its own plus a
+#table of offsets, so any page range is read from a memory map without opening the PDF.
+#
+# layout: header (magic, pdf size, pdf mtime_ns, page count) | page_count + 1 offsets | zlib pages
+
+MAGIC = b"ARBTXT1\0"
+HEADER = struct.Struct("<8sQqI")
+OFFSET = struct.Struct("<Q")
+
+
+def sidecar_path(pdf_path):
+    return Path(pdf_path).with_suffix(".text")
+
+
+def write_text_sidecar(pdf_path, page_texts):
+    """Store page_texts for pdf_path (the PDF must already be saved: its stamp goes in the header)."""
+    st = os.stat(pdf_path)
+    blocks = [zlib.compress(text.encode("utf-8"), 6) for text in page_texts]
+    offsets, position = [], 0
+    for block in blocks:
+        offsets.append(position)
+        position += len(block)
+    offsets.append(position)
+
+    target = sidecar_path(pdf_path)
+    tmp = target.with_name(target.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(HEADER.pack(MAGIC, st.st_size, st.st_mtime_ns, len(blocks)))
+        f.write(b"".join(OFFSET.pack(o) for o in offsets))
+        f.writelines(blocks)
+    os.replace(tmp, target)
+    return target
+
+
+def page_texts(doc, start=0, end=None):
+    end = len(doc) - 1 if end is None else end
+    return [doc.load_page(p).get_text() for p in range(start, end + 1)]
+
+
+class TextSidecar:
+    """Memory-mapped sidecar; pages are decompressed only when asked for."""
+
+    def __init__(self, pdf_path):
+        self.path = sidecar_path(pdf_path)
+        self._file = open(self.path, "rb")
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise
+        magic, self.pdf_size, self.pdf_mtime_ns, self.page_count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"Not a text sidecar: {self.path}")
+        self._data_start = HEADER.size + OFFSET.size * (self.page_count + 1)
+
+    def matches(self, pdf_path):
+        st = os.stat(pdf_path)
+        return (st.st_size, st.st_mtime_ns) == (self.pdf_size, self.pdf_mtime_ns)
+
+    def _offset(self, i):
+        return OFFSET.unpack_from(self._map, HEADER.size + OFFSET.size * i)[0]
+
+    def page(self, i):
+        """Text of page i (0-based)."""
+        if not 0 <= i < self.page_count:
+            raise IndexError(f"Page {i + 1} out of range (1-{self.page_count})")
+        start, end = self._offset(i), self._offset(i + 1)
+        return zlib.decompress(self._map[self._data_start + start:self._data_start + end]).decode("utf-8")
+
+    def text(self, start=0, end=None):
+        """Text of pages start..end (0-based, inclusive), joined like the PDF extraction."""
+        end = self.page_count - 1 if end is None else min(end, self.page_count - 1)
+        return "".join(self.page(i) for i in range(start, end + 1))
+
+    def close(self):
+        if getattr(self, "_map", None) is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_sidecar(pdf_path):
+    """Sidecar of pdf_path if present and written for the current file, else None."""
+    if not sidecar_path(pdf_path).exists():
+        return None
+    try:
+        sidecar = TextSidecar(pdf_path)
+    except (OSError, ValueError, struct.error):
+        return None
+    if not sidecar.matches(pdf_path):
+        sidecar.close()
+        return None
+    return sidecar
@@ -0,0 +1,99 @@
+import os
+import re
+import math
+
+#This file provide the token budget of Gemini requests, computed locally before any call:
+# 1. estimate_tokens(): a fast upper-leaning estimate (no tokenizer download, no network)
+# 2. chunk_pages()/chunk_text(): split a chapter on page, then paragraph, then line boundaries
+#    so every chunk fits the per-request budget
+# 3. estimate_cost(): expected price and latency of a set of requests
+#
+# The estimate is ~4 characters per token for Latin text, but never less than one token per
+# word or punctuation mark, which keeps it on the safe side for short words and numbers.
+
+CHARS_PER_TOKEN = 4
+REQUEST_TOKEN_BUDGET = int(os.environ.get("GEMINI_REQUEST_TOKENS", 200_000))
+OUTPUT_TOKENS_PER_REQUEST = int(os.environ.get("GEMINI_OUTPUT_TOKENS", 2_000))
+INPUT_USD_PER_MTOKEN = float(os.environ.get("GEMINI_INPUT_USD_PER_MTOKEN", 0.30))
+OUTPUT_USD_PER_MTOKEN = float(os.environ.get("GEMINI_OUTPUT_USD_PER_MTOKEN", 2.50))
+INPUT_TOKENS_PER_SECOND = float(os.environ.get("GEMINI_INPUT_TOKENS_PER_SECOND", 20_000))
+OUTPUT_TOKENS_PER_SECOND = float(os.environ.get("GEMINI_OUTPUT_TOKENS_PER_SECOND", 150))
+REQUEST_OVERHEAD_SECONDS = 1.0
+
+WORD = re.compile(r"\w+|[^\w\s]")
+SEPARATORS = ["\n\n", "\n", ". ", " "]
+
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    return max(math.ceil(len(text) / CHARS_PER_TOKEN), len(WORD.findall(text)))
+
+
+def chunk_text(text, budget=REQUEST_TOKEN_BUDGET, separators=SEPARATORS):
+    """Pieces of text of at most budget tokens each, cut at the coarsest boundary that works."""
+    if estimate_tokens(text) <= budget:
+        return [text] if text else []
+    if not separators:
+        step = budget * CHARS_PER_TOKEN // 2  # no boundary left: hard cut, well under the budget
+        return [text[i:i + step] for i in range(0, len(text), step)]
+    separator, finer = separators[0], separators[1:]
+    parts = text.split(separator)
+    chunks, current, current_tokens = [], "", 0
+    for k, part in enumerate(parts):
+        piece = part + (separator if k < len(parts) - 1 else "")
+        tokens = estimate_tokens(piece)
+        if tokens > budget:
+            if current:
+                chunks.append(current)
+                current, current_tokens = "", 0
+            chunks.extend(chunk_text(piece, budget, finer))
+            continue
+        if current and current_tokens + tokens > budget:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current += piece
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def chunk_pages(pages, budget=REQUEST_TOKEN_BUDGET):
+    """Consecutive pages packed into chunks of at most budget tokens; a page too big on its own
+    is cut at paragraph boundaries."""
+    chunks, current, current_tokens = [], "", 0
+    for page in pages:
+        tokens = estimate_tokens(page)
+        if tokens > budget:
+            if current:
+                chunks.append(current)
+                current, current_tokens = "", 0
+            chunks.extend(chunk_text(page, budget))
+            continue
+        if current and current_tokens + tokens > budget:
+            chunks.append(current)
+            current, current_tokens = "", 0
+        current += page
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def estimate_cost(input_tokens, requests, output_tokens=None, parallel=1):
+    """Expected price (USD) and wall time of requests sending input_tokens in total."""
+    output_tokens = OUTPUT_TOKENS_PER_REQUEST * requests if output_tokens is None else output_tokens
+    cost = input_tokens / 1e6 * INPUT_USD_PER_MTOKEN + output_tokens / 1e6 * OUTPUT_USD_PER_MTOKEN
+    busy = (
+        requests * REQUEST_OVERHEAD_SECONDS
+        + input_tokens / INPUT_TOKENS_PER_SECOND
+        + output_tokens / OUTPUT_TOKENS_PER_SECOND
+    )
+    return {
+        "inputTokens": input_tokens,
+        "outputTokens": output_tokens,
+        "requests": requests,
+        "costUsd": round(cost, 6),
+        "latencySeconds": round(busy / max(1, min(parallel, requests)), 1),
+    }
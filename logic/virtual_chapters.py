@@ -0,0 +1,128 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import fitz
+
+from logic.blob_store import alias_of, blob_path
+from logic.chapter_engine import get_engine
+from logic.text_store import open_sidecar, write_text_sidecar, page_texts
+
+#This file provide virtual chapters: a chapter that is only (book, startPage, endPage).
+#The PDF of a virtual chapter is built on demand from the source book (kept in the blob
+#store) and the last ones built stay in a small LRU of byte buffers; its text comes from the
+#text sidecar of the whole book. export_chapter() writes a real chapter file when asked.
+
+CHAPTER_BUFFER_BYTES = int(os.environ.get("VIRTUAL_CHAPTER_CACHE_BYTES", 64 * 1024 * 1024))
+SAVE_OPTIONS = {"garbage": 3, "deflate": True}
+
+
+def source_pdf(bookname):
+    """The blob behind bookname: virtual chapters need a source that /api/cleanup leaves alone."""
+    alias = alias_of(bookname)
+    if alias is None or alias["ext"] != ".pdf":
+        return None
+    path = blob_path(alias["sha256"], ".pdf")
+    return path if path.exists() else None
+
+
+def chapter_hash(source_sha256, start_page, end_page):
+    """Content key of a virtual chapter: the source content and the page range."""
+    return hashlib.sha256(f"{source_sha256}:{start_page}-{end_page}".encode()).hexdigest()
+
+
+def chapter_bytes(doc, start, end):
+    """PDF of pages start..end (0-based, inclusive) of doc."""
+    chapter_doc = fitz.open()
+    try:
+        chapter_doc.insert_pdf(doc, from_page=start, to_page=end)
+        return chapter_doc.tobytes(**SAVE_OPTIONS)
+    finally:
+        chapter_doc.close()
+
+
+def ensure_book_text(source):
+    """Text sidecar of the whole source book, written the first time a virtual chapter needs it."""
+    sidecar = open_sidecar(source)
+    if sidecar is None:
+        with get_engine().documents.borrow(source) as doc:
+            texts = page_texts(doc)
+        write_text_sidecar(source, texts)
+        sidecar = open_sidecar(source)
+    return sidecar
+
+
+class ChapterBuffers:
+    """LRU of built virtual chapters, bounded by their total size."""
+
+    def __init__(self, max_bytes=CHAPTER_BUFFER_BYTES):
+        self.max_bytes = max_bytes
+        self._buffers = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, bookname, chapter):
+        source = source_pdf(bookname)
+        if source is None:
+            raise FileNotFoundError(f"Source of {bookname} not found")
+        key = chapter["sha256"]
+        with self._lock:
+            data = self._buffers.get(key)
+            if data is not None:
+                self._buffers.move_to_end(key)
+                self.counters["hits"] += 1
+                return data
+            self.counters["misses"] += 1
+        with get_engine().documents.borrow(source) as doc:
+            data = chapter_bytes(doc, chapter["start_page"] - 1, min(chapter["end_page"], len(doc)) - 1)
+        with self._lock:
+            if key not in self._buffers:
+                self._buffers[key] = data
+                self._bytes += len(data)
+            while self._bytes > self.max_bytes and len(self._buffers) > 1:
+                _, evicted = self._buffers.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.counters["evictions"] += 1
+        return data
+
+    def text(self, bookname, chapter, start=0, end=None):
+        """Text of pages start..end (0-based, within the chapter) of a virtual chapter."""
+        source = source_pdf(bookname)
+        if source is None:
+            raise FileNotFoundError(f"Source of {bookname} not found")
+        first = chapter["start_page"] - 1
+        last = chapter["end_page"] - 1 if end is None else min(first + end, chapter["end_page"] - 1)
+        with ensure_book_text(source) as sidecar:
+            return sidecar.text(first + start, last)
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, "entries": len(self._buffers), "bytes": self._bytes, "maxBytes": self.max_bytes}
+
+
+def export_chapter(bookname, chapter, book_dir):
+    """Materialize a virtual chapter as a file in book_dir (+ its text sidecar); returns the path."""
+    path = Path(book_dir) / chapter["filename"]
+    data = get_chapter_buffers().get(bookname, chapter)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_bytes(data)
+    os.replace(tmp, path)
+    with ensure_book_text(source_pdf(bookname)) as sidecar:
+        last = min(chapter["end_page"], sidecar.page_count)
+        write_text_sidecar(path, [sidecar.page(i) for i in range(chapter["start_page"] - 1, last)])
+    return path
+
+
+_buffers = None
+_buffers_lock = threading.Lock()
+
+
+def get_chapter_buffers():
+    global _buffers
+    with _buffers_lock:
+        if _buffers is None:
+            _buffers = ChapterBuffers()
+        return _buffers
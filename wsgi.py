@@ -0,0 +1,41 @@
+import os
+import sys
+
+from app import app, FRONTEND_DIR, ASSETS_DIR
+from logic import epub_book
+from logic.static_assets import get_asset_store
+
+#This file provide the production entry point, loaded once in the gunicorn master (preload_app)
+#and inherited by every worker through fork:
+#
+# python -m gunicorn -c gunicorn.conf.py wsgi:app
+#
+# 1. preload(): the logic modules, the hashed/precompressed assets and, when a key is set,
+#    google.genai are loaded before forking, so workers start warm and share those pages
+# 2. reset_after_fork(): singletons owning threads, open documents or sockets are dropped in the
+#    child, which builds its own on first use (a thread pool does not survive a fork)
+
+# module, global holding the singleton
+FORK_UNSAFE = (
+    ("logic.chapter_engine", "_engine"),
+    ("logic.page_renderer", "_renderer"),
+    ("logic.generation_jobs", "_queue"),
+    ("logic.gemini_client", "_service"),
+)
+
+
+def preload():
+    get_asset_store(FRONTEND_DIR).build_all()
+    get_asset_store(ASSETS_DIR).build_all()
+    if os.environ.get("GEMINI_API_KEY") and not os.environ.get("GEMINI_FAKE"):
+        import google.genai.types  # noqa: F401  imported lazily by the dev server, here once for all workers
+
+
+def reset_after_fork():
+    for module, name in FORK_UNSAFE:
+        setattr(sys.modules[module], name, None)
+    with epub_book._open_lock:
+        epub_book._open.clear()  # zip handles share their file offset with the parent
+
+
+preload()